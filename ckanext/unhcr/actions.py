@@ -5,13 +5,11 @@ import logging
 import requests
 from urlparse import urljoin
 from dateutil.parser import parse as parse_date
-from sqlalchemy import and_, desc, or_, select
-from sqlalchemy.dialects.postgresql import array
-from sqlalchemy.orm import aliased
+from sqlalchemy import and_, cast, desc, exists, func, not_, or_, select, union
+from sqlalchemy.dialects.postgresql import array, JSONB
 from ckan import model
 from ckan.authz import has_user_permission_for_group_or_org
 from ckan.plugins import toolkit
-from ckan.lib import mailer as core_mailer
 from ckan.lib.mailer import MailerException
 import ckan.lib.plugins as lib_plugins
 from ckan.lib.search import index_for, commit
@@ -23,13 +21,14 @@ import ckan.logic.action.update as update_core
 import ckan.logic.action.patch as patch_core
 import ckan.lib.activity_streams as activity_streams
 import ckan.lib.dictization.model_dictize as model_dictize
-from ckanext.collaborators.logic import action as collaborators_action
-from ckanext.unhcr import helpers, mailer, utils
+from ckanext.unhcr import cache, helpers, hierarchy, jobs, mailer, microdata, utils
 from ckanext.unhcr.models import AccessRequest
 from ckanext.scheming.helpers import scheming_get_dataset_schema
 
 log = logging.getLogger(__name__)
 
+USER_AUTOCOMPLETE_CACHE_TTL = 30  # seconds
+
 
 def _get_user_obj(context):
     if 'user_obj' in context:
@@ -73,7 +72,6 @@ def package_update(context, data_dict):
 
 
 def package_publish_microdata(context, data_dict):
-    default_error = 'Unknown microdata error'
 
     # Get data
     dataset_id = data_dict.get('id')
@@ -87,72 +85,45 @@ def package_publish_microdata(context, data_dict):
         raise toolkit.NotAuthorized('Microdata API Key is not set')
 
     # Get dataset/survey
-    headers = {'X-Api-Key': api_key}
     dataset = toolkit.get_action('package_show')(context, {'id': dataset_id})
     survey = helpers.convert_dataset_to_microdata_survey(dataset, nation, repoid)
     idno = survey['study_desc']['title_statement']['idno']
 
+    # Publish dataset
     try:
-
-        # Publish dataset
-        url = 'https://microdata.unhcr.org/index.php/api/datasets/create/survey/%s' % idno
-        response = requests.post(url, headers=headers, json=survey).json()
-        if response.get('status') != 'success':
-            raise RuntimeError(str(response.get('errors', default_error)))
-        template = 'https://microdata.unhcr.org/index.php/catalog/%s'
-        survey['url'] = template % response['dataset']['id']
-        survey['resources'] = []
-        survey['files'] = []
-
-        # Pubish resources/files
-        file_name_counter = {}
-        if dataset.get('resources', []):
-            url = 'https://microdata.unhcr.org/index.php/api/datasets/%s/%s'
-            for resource in dataset.get('resources', []):
-
-                # resource
-                resouce_url = url % (idno, 'resources')
-                md_resource = helpers.convert_resource_to_microdata_resource(resource)
-                response = requests.post(
-                    resouce_url, headers=headers, json=md_resource).json()
-                if response.get('status') != 'success':
-                    raise RuntimeError(str(response.get('errors', default_error)))
-                survey['resources'].append(response['resource'])
-
-                # file
-                file_url = url % (idno, 'files')
-                file_name = resource['url'].split('/')[-1]
-                file_path = helpers.get_resource_file_path(resource)
-                file_mime = resource['mimetype']
-                if not file_name or not file_path:
-                    continue
-                file_name_counter.setdefault(file_name, 0)
-                file_name_counter[file_name] += 1
-                if file_name_counter[file_name] > 1:
-                    file_name = helpers.add_file_name_suffix(
-                        file_name, file_name_counter[file_name] - 1)
-                with open(file_path, 'rb') as file_obj:
-                    file = (file_name, file_obj, file_mime)
-                    response = requests.post(
-                        file_url, headers=headers, files={'file': file}).json()
-                # TODO: update
-                # it's a hack to overcome incorrect Microdata responses
-                # unsupported file types fail this way and we are skipping them
-                if not isinstance(response, dict):
-                    continue
-                if response.get('status') != 'success':
-                    raise RuntimeError(str(response.get('errors', default_error)))
-                survey['files'].append(response)
-
-    except requests.exceptions.HTTPError as exception:
+        survey['url'] = microdata.create_survey(survey, api_key)
+    except requests.exceptions.RequestException as exception:
         log.exception(exception)
         raise RuntimeError('Microdata connection failed')
+    except ValueError as exception:
+        log.exception(exception)
+        raise RuntimeError('Microdata returned an invalid response')
+
+    # Publish resources/files in the background
+    survey['job_id'] = None
+    if dataset.get('resources', []):
+        microdata.init_publish_status(dataset, idno)
+        job = toolkit.enqueue_job(
+            jobs.publish_microdata_resources,
+            [dataset['id'], idno],
+            title='Publish resources of {} to Microdata'.format(dataset['name']))
+        survey['job_id'] = job.id
 
     return survey
 
 
+@toolkit.side_effect_free
+def package_get_microdata_publish_status(context, data_dict):
+
+    # Check access
+    toolkit.check_access('sysadmin', context)
+
+    # Get status
+    dataset = toolkit.get_action('package_show')(context, {'id': data_dict.get('id')})
+    return microdata.get_publish_status(dataset)
+
+
 def package_get_microdata_collections(context, data_dict):
-    default_error = 'Unknown microdata error'
 
     # Check access
     toolkit.check_access('sysadmin', context)
@@ -160,17 +131,10 @@ def package_get_microdata_collections(context, data_dict):
     if not api_key:
         raise toolkit.NotAuthorized('Microdata API Key is not set')
 
+    # Get collections
     try:
-
-        # Get collections
-        headers = {'X-Api-Key': api_key}
-        url = 'https://microdata.unhcr.org/index.php/api/collections'
-        response = requests.get(url, headers=headers).json()
-        if response.get('status') != 'success':
-            raise RuntimeError(str(response.get('errors', default_error)))
-        collections = response['collections']
-
-    except requests.exceptions.HTTPError as exception:
+        collections = microdata.get_collections(api_key)
+    except requests.exceptions.RequestException as exception:
         log.exception(exception)
         raise RuntimeError('Microdata connection failed')
 
@@ -215,7 +179,10 @@ def organization_create(context, data_dict):
         context['__unhcr_state_pending'] = True
         org_dict = patch_core.organization_patch(context,
             {'id': org_dict['id'], 'state': 'approval_needed'})
+        helpers.invalidate_pending_requests_total()
         notify_sysadmins = True
+    else:
+        hierarchy.invalidate()
     if notify_sysadmins:
         try:
             for user in helpers.get_sysadmins():
@@ -234,6 +201,71 @@ def organization_create(context, data_dict):
     return org_dict
 
 
+@toolkit.chained_action
+def organization_update(up_func, context, data_dict):
+    ancestors = _get_subtree_ancestors(data_dict.get('id'))
+    org_dict = up_func(context, data_dict)
+    _update_hierarchy(org_dict['id'], ancestors)
+    return org_dict
+
+
+@toolkit.chained_action
+def organization_delete(up_func, context, data_dict):
+    ancestors = _get_subtree_ancestors(data_dict.get('id'))
+    up_func(context, data_dict)
+    _update_hierarchy(data_dict.get('id'), ancestors)
+
+
+@toolkit.chained_action
+def member_create(up_func, context, data_dict):
+    if data_dict.get('object_type') != 'group':
+        return up_func(context, data_dict)
+    ancestors = _get_subtree_ancestors(data_dict.get('object'))
+    member = up_func(context, data_dict)
+    _update_hierarchy(data_dict.get('object'), ancestors)
+    return member
+
+
+@toolkit.chained_action
+def member_delete(up_func, context, data_dict):
+    if data_dict.get('object_type') != 'group':
+        return up_func(context, data_dict)
+    ancestors = _get_subtree_ancestors(data_dict.get('object'))
+    up_func(context, data_dict)
+    _update_hierarchy(data_dict.get('object'), ancestors)
+
+
+def _get_subtree_ancestors(container_id):
+    container = hierarchy.get_container(container_id) if container_id else None
+    if not container:
+        return {}
+    ids = [container['id']] + [c['id'] for c in hierarchy.get_descendants(container['id'])]
+    return dict((id, [a['id'] for a in hierarchy.get_ancestors(id)]) for id in ids)
+
+
+def _update_hierarchy(container_id, prev_ancestors):
+    # Datasets are indexed with the ancestors of their container
+    # so they need reindexing when a container moves in the hierarchy
+    hierarchy.invalidate()
+    next_ancestors = _get_subtree_ancestors(container_id)
+    moved_ids = [
+        id for id in set(prev_ancestors) | set(next_ancestors)
+        if prev_ancestors.get(id) != next_ancestors.get(id)
+    ]
+    if not moved_ids:
+        return
+    package_ids = [
+        r[0] for r in model.Session.query(model.Package.id)
+        .filter(model.Package.owner_org.in_(moved_ids))
+        .filter(model.Package.state != 'deleted')
+    ]
+    if package_ids:
+        toolkit.enqueue_job(
+            jobs.reindex_datasets,
+            [package_ids],
+            title='Reindex datasets of moved data containers')
+
+
 def organization_member_create(context, data_dict):
 
     m = context.get('model', model)
@@ -257,7 +289,10 @@ def organization_member_create(context, data_dict):
         body = mailer.compose_membership_email_body(container, user, 'create')
         mailer.mail_user_by_id(user['id'], subj, body)
 
-    return create_core.organization_member_create(context, data_dict)
+    member = create_core.organization_member_create(context, data_dict)
+    helpers.invalidate_pending_requests_total()
+
+    return member
 
 
 def organization_member_delete(context, data_dict):
@@ -273,7 +308,102 @@ def organization_member_delete(context, data_dict):
         body = mailer.compose_membership_email_body(container, user, 'delete')
         mailer.mail_user_by_id(user['id'], subj, body)
 
-    return delete_core.organization_member_delete(context, data_dict)
+    delete_core.organization_member_delete(context, data_dict)
+    helpers.invalidate_pending_requests_total()
+
+
+def organization_member_create_many(context, data_dict):
+    '''Make a user a member of many data containers at once.
+
+    All the memberships are saved in one transaction and the user gets
+    one notification for all of them.
+
+    :param username: name or id of the user
+    :type username: string
+    :param ids: names or ids of the data containers
+    :type ids: list of strings
+    :param role: the role of the user in all the containers,
+        eg ``'member'``, ``'editor'`` or ``'admin'``
+    :type role: string
+    :param not_notify: don't email the user (optional, default: ``False``)
+    :type not_notify: bool
+
+    :returns: the containers (``'id'``, ``'name'`` and ``'title'``)
+    :rtype: list of dictionaries
+    '''
+    m = context.get('model', model)
+    username = toolkit.get_or_bust(data_dict, 'username')
+    role = toolkit.get_or_bust(data_dict, 'role')
+    ids = data_dict.get('ids')
+    if not isinstance(ids, list):
+        ids = [ids] if ids else []
+    if not ids:
+        raise toolkit.ValidationError({'ids': ['Missing value']})
+
+    user = m.User.get(username)
+    if not user:
+        raise toolkit.ObjectNotFound("User not found")
+    if user.external:
+        message = 'Partner users can not be an organisation member'
+        raise toolkit.ValidationError({'message': message}, error_summary=message)
+
+    roles = [r['value'] for r in toolkit.get_action('member_roles_list')(
+        context, {'group_type': 'organization'})]
+    if role not in roles:
+        raise toolkit.ValidationError({'role': ['Role "{}" does not exist'.format(role)]})
+
+    # Containers
+    containers = (m.Session.query(m.Group)
+        .filter(or_(m.Group.id.in_(ids), m.Group.name.in_(ids)))
+        .filter(m.Group.is_organization == True)
+        .filter(m.Group.type == 'data-container')
+        .filter(m.Group.state == 'active')
+        .order_by(m.Group.title)
+        .all())
+    found = set([c.id for c in containers] + [c.name for c in containers])
+    missing = [id for id in ids if id not in found]
+    if missing:
+        raise toolkit.ValidationError(
+            {'ids': ['Data containers not found: {}'.format(', '.join(missing))]})
+    for container in containers:
+        toolkit.check_access('organization_member_create', context, {'id': container.id})
+
+    # Memberships
+    members = dict(
+        (member.group_id, member) for member in m.Session.query(m.Member)
+        .filter(m.Member.table_name == 'user')
+        .filter(m.Member.table_id == user.id)
+        .filter(m.Member.group_id.in_([c.id for c in containers]))
+        .filter(m.Member.state == 'active')
+    )
+    rev = m.repo.new_revision()
+    rev.author = context.get('user')
+    rev.message = 'Add member {} to {} data containers'.format(user.name, len(containers))
+    for container in containers:
+        member = members.get(container.id)
+        if member is None:
+            member = m.Member(
+                table_name='user',
+                table_id=user.id,
+                group_id=container.id,
+                state='active')
+            m.Session.add(member)
+        member.capacity = role
+    m.repo.commit()
+    helpers.invalidate_pending_requests_total()
+
+    containers = [
+        {'id': c.id, 'name': c.name, 'title': c.title or c.name} for c in containers]
+
+    # Notify the user
+    if not data_dict.get('not_notify'):
+        user_dict = {'name': user.name, 'fullname': user.fullname}
+        subj = mailer.compose_membership_email_subj({'title': 'multiple containers'})
+        body = mailer.compose_membership_email_body(
+            [dict(c) for c in containers], user_dict, 'create_multiple')
+        mailer.mail_user_by_id(user.id, subj, body)
+
+    return containers
 
 
 def organization_list_all_fields(context, data_dict):
@@ -295,48 +425,42 @@ def organization_list_all_fields(context, data_dict):
     group_type = data_dict.get('type', 'data-container')
     order_by = data_dict.get('order_by', 'title')
 
-    extra_cols = [rec[0] for rec in session.query(m.GroupExtra.key).distinct()]
     group_table = m.meta.metadata.tables['group']
-    group_extra_table = m.meta.metadata.tables['group_extra']
-    allowed_cols = [col.key for col in group_table.columns] + extra_cols
+    group_cols = [col.key for col in group_table.columns]
+    extra_cols = utils.get_group_extra_keys()
+    if order_by not in group_cols and order_by not in extra_cols:
+        # The key may have been added since the keys were cached
+        extra_cols = utils.get_group_extra_keys(refresh=True)
+    allowed_cols = group_cols + extra_cols
     if order_by not in allowed_cols:
         raise toolkit.Invalid("'order_by' must be one of {}".format(allowed_cols))
 
-    join_obj = group_table
-    select_cols = [col for col in group_table.columns]
-    for col in extra_cols:
-        extras_alias = aliased(group_extra_table, name='extras_{}'.format(col))
-        select_cols.append(extras_alias.c.value.label(col))
-        join_obj = join_obj.join(
-            extras_alias,
-            and_(
-                group_table.c.id==extras_alias.c.group_id,
-                extras_alias.c.key==col,
-                extras_alias.c.state=='active',
-            ), isouter=True,
-        )
-
-    sql = select(
-        select_cols
-    ).select_from(
-        join_obj
-    ).where(
-        and_(
-            group_table.c.type==group_type,
-            group_table.c.state=='active',
-            group_table.c.is_organization==True,
-        )
-    ).order_by(
-        order_by
-    )
+    sql = utils.select_organizations_with_extras(group_type, order_by=order_by)
     result = session.execute(sql).fetchall()
 
     organization_plugin = lib_plugins.lookup_group_plugin(group_type)
     schema = organization_plugin.form_to_db_schema()
 
-    out_list = []
-    for row in result:
-        raw_dict = {k:v for k,v in row.items()}
+    return [
+        _validate_organization_row(
+            context,
+            organization_plugin,
+            schema,
+            utils.organization_row_to_dict(row, extra_cols),
+        )
+        for row in result
+    ]
+
+
+# Rows validated for output are cached by their raw content,
+# as the output validators don't depend on anything else
+_validated_organizations = {}
+_VALIDATED_ORGANIZATIONS_MAX = 10000
+def _validate_organization_row(context, organization_plugin, schema, raw_dict):
+    key = json.dumps(raw_dict, sort_keys=True, default=str)
+    validated_dict = _validated_organizations.get(key)
+
+    if validated_dict is None:
         validated_dict, errors = organization_plugin.validate(
             context,
             raw_dict,
@@ -346,115 +470,278 @@ def organization_list_all_fields(context, data_dict):
         if errors:
             raise toolkit.ValidationError(errors)
         validated_dict['display_name'] = validated_dict['title'] or validated_dict['name']
-        out_list.append(validated_dict)
-
-    return out_list
+        if len(_validated_organizations) >= _VALIDATED_ORGANIZATIONS_MAX:
+            _validated_organizations.clear()
+        _validated_organizations[key] = validated_dict
+
+    # Callers may modify the dict in place
+    return dict(
+        (k, list(v) if isinstance(v, list) else v)
+        for k, v in validated_dict.items()
+    )
 
 
 # Pending requests
 
 def container_request_list(context, data_dict):
-    all_fields = data_dict.get('all_fields', False)
+    """
+    Return the data containers waiting for approval, ordered by name
+
+    With ``all_fields`` every container is returned as a dict with its
+    extras, its creator (``users``) and its parent (``groups``), all from
+    a single query rather than an ``organization_show`` per container.
+
+    :param all_fields: return container dicts instead of ids
+      (optional, default: ``False``)
+    :type all_fields: bool
+    :param limit: the maximum number of containers to return (optional)
+    :type limit: int
+    :param offset: the number of containers to skip (optional)
+    :type offset: int
+    :returns: a dict with the page of ``containers`` and the total ``count``
+    :rtype: dict
+    """
+    all_fields = toolkit.asbool(data_dict.get('all_fields', False))
+    limit = _get_non_negative_int(data_dict, 'limit')
+    offset = _get_non_negative_int(data_dict, 'offset')
 
     # Check permissions
     toolkit.check_access('sysadmin', context)
 
+    m = context.get('model', model)
+    session = context.get('session', m.Session)
+    count = (session
+        .query(func.count(m.Group.id))
+        .filter(m.Group.state == 'approval_needed')
+        .filter(m.Group.is_organization == True)
+        .scalar())
+
     # Containers
-    containers = []
-    query = (model.Session
-        .query(model.Group.id)
-        .filter(model.Group.state == 'approval_needed')
-        .filter(model.Group.is_organization == True)
-        .order_by(model.Group.name))
-    for item in query.all():
-        if all_fields:
-            container = toolkit.get_action('organization_show')(context, {'id': item.id})
-        else:
-            container = item.id
-        containers.append(container)
+    if not all_fields:
+        query = (session
+            .query(m.Group.id)
+            .filter(m.Group.state == 'approval_needed')
+            .filter(m.Group.is_organization == True)
+            .order_by(m.Group.name))
+        if limit is not None:
+            query = query.limit(limit)
+        if offset:
+            query = query.offset(offset)
+        containers = [item.id for item in query]
+    else:
+        sql = utils.select_organizations_with_members(order_by='name')
+        if limit is not None:
+            sql = sql.limit(limit)
+        if offset:
+            sql = sql.offset(offset)
+        containers = []
+        extra_cols = utils.get_group_extra_keys()
+        organization_plugins = {}
+        for row in session.execute(sql).fetchall():
+            raw_dict = utils.organization_row_to_dict(row, extra_cols)
+            users = raw_dict.pop('users') or []
+            groups = raw_dict.pop('groups') or []
+            if raw_dict['type'] not in organization_plugins:
+                organization_plugin = lib_plugins.lookup_group_plugin(raw_dict['type'])
+                organization_plugins[raw_dict['type']] = (
+                    organization_plugin, organization_plugin.form_to_db_schema())
+            organization_plugin, schema = organization_plugins[raw_dict['type']]
+            container = _validate_organization_row(context, organization_plugin, schema, raw_dict)
+            container['users'] = users
+            container['groups'] = groups
+            containers.append(container)
 
     return {
         'containers': containers,
-        'count': len(containers),
+        'count': count,
     }
 
 
+# Mail
+
+@toolkit.side_effect_free
+def mail_queue_status(context, data_dict):
+    """
+    Return the depth of the outgoing mail queue: the number of ``pending``,
+    ``sent`` and ``failed`` emails and the creation date of the oldest
+    pending one (``oldest_pending``)
+    """
+    toolkit.check_access('sysadmin', context)
+    return mailer.get_mail_queue_status()
+
+
 # Activity
 
 
-def _package_admin_activity_list(full_list):
-    return [
-        a for a in full_list
-        if 'curation_activity' in a.get('data', {})
-        or a["activity_type"] == "download resource"
-    ]
+# Internal activities (curation and downloads) are filtered out in the
+# activity query itself so the pages are always complete
+
+def _curation_activity_filter():
+    return func.coalesce(
+        cast(model.Activity.data, JSONB).has_key('curation_activity'), False)
+
+
+def _download_activity_filter():
+    return model.Activity.activity_type == 'download resource'
+
 
-def _package_curation_activity_list(full_list):
+def _curation_detail_filter():
+    # Updates that only changed the curation_state/curator_id extras
+    # (besides the package row itself, which changes on every update)
+    detail = model.ActivityDetail
+    is_curation_detail = and_(
+        detail.object_type == 'PackageExtra',
+        cast(detail.data, JSONB)['package_extra']['key'].astext.in_(
+            ['curation_state', 'curator_id']),
+    )
+    return and_(
+        exists().where(and_(
+            detail.activity_id == model.Activity.id,
+            is_curation_detail,
+        )),
+        not_(exists().where(and_(
+            detail.activity_id == model.Activity.id,
+            detail.object_type != 'Package',
+            not_(is_curation_detail),
+        ))),
+    )
+
+
+def _normal_activity_filter():
+    return and_(
+        not_(_curation_activity_filter()),
+        not_(_download_activity_filter()),
+    )
+
+
+def _hidden_users_activity_filter():
+    # Same setting as core's activity streams (the site user by default)
+    user_names = toolkit.aslist(toolkit.config.get(
+        'ckan.hide_activity_from_users', toolkit.config.get('ckan.site_id')))
+    hidden_user_ids = select([model.User.id]).where(model.User.name.in_(user_names))
+    return not_(model.Activity.user_id.in_(hidden_user_ids))
+
+
+def _activity_list(context, data_dict, *queries):
+    '''
+    Return a page of the activities matched by any of `queries`
+
+    Every query is cut to the end of the page before they are merged,
+    so no query contributes more activities than the page can show.
+    '''
+    offset = int(data_dict.get('offset', 0))
+    limit = min(
+        int(data_dict.get('limit', toolkit.config.get('ckan.activity_list_limit', 31))),
+        int(toolkit.config.get('ckan.activity_list_limit_max', 100)),
+    )
+    queries = [query.filter(_hidden_users_activity_filter()) for query in queries]
+    if len(queries) == 1:
+        query = queries[0]
+    else:
+        # UNION also drops the activities matched by several queries
+        query = model.Session.query(model.Activity).select_entity_from(union(*[
+            query
+                .order_by(desc(model.Activity.timestamp))
+                .limit(offset + limit)
+                .subquery().select()
+            for query in queries
+        ]))
+    activities = (query
+        .order_by(desc(model.Activity.timestamp))
+        .offset(offset)
+        .limit(limit)
+        .all())
+    return model_dictize.activity_list_dictize(activities, context)
+
+
+def _user_activity_queries(user_id):
+    query = model.Session.query(model.Activity).filter(_normal_activity_filter())
     return [
-        a for a in full_list
-        if 'curation_activity' in a.get('data', {})
+        query.filter(model.Activity.user_id == user_id),
+        query.filter(model.Activity.object_id == user_id),
     ]
 
-def _package_normal_activity_list(context, full_list):
-    activities = [
-        a for a in full_list
-        if 'curation_activity' not in a.get('data', {})
-        and a["activity_type"] != "download resource"
+
+def _dashboard_activity_queries(user_id):
+    def followees(follower_class):
+        return (select([follower_class.object_id])
+            .where(follower_class.follower_id == user_id))
+
+    followed_users = followees(model.UserFollowingUser)
+    followed_groups = followees(model.UserFollowingGroup)
+    # The public datasets of the followed groups, as in core
+    followed_group_datasets = (select([model.Member.table_id])
+        .where(and_(
+            model.Member.table_name == 'package',
+            model.Member.group_id.in_(followed_groups),
+            model.Member.table_id == model.Package.id,
+            model.Package.private == False,
+        )))
+
+    query = model.Session.query(model.Activity).filter(_normal_activity_filter())
+    return _user_activity_queries(user_id) + [
+        query.filter(model.Activity.user_id.in_(followed_users)),
+        query.filter(model.Activity.object_id.in_(followed_users)),
+        query.filter(model.Activity.object_id.in_(followees(model.UserFollowingDataset))),
+        query.filter(model.Activity.object_id.in_(followed_groups)),
+        query.filter(model.Activity.object_id.in_(followed_group_datasets)),
     ]
-    # Filter out the activities that are related to `curation_state`
-    activities = list(
-        filter(
-            lambda activity: get_core.activity_detail_list(
-                context, {'id': activity['id']}).pop()
-                .get('data', {})
-                .get('package_extra', {})
-                .get('key') not in ('curation_state', 'curator_id'),
-            activities
-        )
-    )
-    return activities
 
 
 @toolkit.side_effect_free
-@toolkit.chained_action
-def package_activity_list(up_func, context, data_dict):
+def package_activity_list(context, data_dict):
     toolkit.check_access('package_activity_list', context, data_dict)
     get_internal_activities = toolkit.asbool(
         data_dict.get('get_internal_activities'))
     package_id = toolkit.get_or_bust(data_dict, 'id')
 
     package = model.Package.get(package_id)
+    if package is None:
+        raise toolkit.ObjectNotFound('Package not found')
     user_is_container_admin = has_user_permission_for_group_or_org(
         package.owner_org,
         context['user'],
         'admin',
-    ) if package else False
+    )
 
-    full_list = up_func(context, data_dict)
+    query = (model.Session
+        .query(model.Activity)
+        .filter(model.Activity.object_id == package.id))
     if get_internal_activities and user_is_container_admin:
-        return _package_admin_activity_list(full_list)
-    if get_internal_activities and not user_is_container_admin:
-        return _package_curation_activity_list(full_list)
-    return _package_normal_activity_list(context, full_list)
+        query = query.filter(or_(_curation_activity_filter(), _download_activity_filter()))
+    elif get_internal_activities:
+        query = query.filter(_curation_activity_filter())
+    else:
+        query = query.filter(_normal_activity_filter()).filter(~_curation_detail_filter())
+    return _activity_list(context, data_dict, query)
 
 
 @toolkit.side_effect_free
 def dashboard_activity_list(context, data_dict):
-    full_list = get_core.dashboard_activity_list(context, data_dict)
-    return [
-        a for a in full_list
-        if "curation_activity" not in a.get("data", {})
-        and a["activity_type"] != "download resource"
-    ]
+    toolkit.check_access('dashboard_activity_list', context, data_dict)
+    user_id = model.User.get(context['user']).id
+
+    activities = _activity_list(
+        context, data_dict, *_dashboard_activity_queries(user_id))
+
+    # Mark the new (not yet seen by user) activities
+    last_viewed = model.Dashboard.get(user_id).activity_stream_last_viewed
+    for activity in activities:
+        if activity['user_id'] == user_id:
+            activity['is_new'] = False
+        else:
+            activity['is_new'] = (parse_date(activity['timestamp']) > last_viewed)
+    return activities
+
 
 @toolkit.side_effect_free
 def user_activity_list(context, data_dict):
-    full_list = get_core.user_activity_list(context, data_dict)
-    return [
-        a for a in full_list
-        if "curation_activity" not in a.get("data", {})
-        and a["activity_type"] != "download resource"
-    ]
+    toolkit.check_access('user_show', context, data_dict)
+    user = model.User.get(data_dict.get('id'))
+    if user is None:
+        raise toolkit.ObjectNotFound('User not found')
+
+    return _activity_list(context, data_dict, *_user_activity_queries(user.id))
 
 
 @toolkit.side_effect_free
@@ -623,10 +910,9 @@ def _fail_task(context, task, error):
 
 
 def _task_is_stale(task):
-    assume_task_stale_after = datetime.timedelta(seconds=3600)
     updated = datetime.datetime.strptime(task['last_updated'], '%Y-%m-%dT%H:%M:%S.%f')
     time_since_last_updated = datetime.datetime.utcnow() - updated
-    return time_since_last_updated > assume_task_stale_after
+    return time_since_last_updated > utils.CLAMAV_TASK_STALE_AFTER
 
 
 def _should_resubmit(context, task, metadata):
@@ -753,7 +1039,7 @@ def scan_submit(context, data_dict):
 
     task['value'] = r.text
     task['state'] = 'pending'
-    task['last_updated'] = str(datetime.datetime.utcnow()),
+    task['last_updated'] = str(datetime.datetime.utcnow())
     toolkit.get_action('task_status_update')(context, task)
 
     return True
@@ -783,7 +1069,7 @@ def scan_hook(context, data_dict):
         recipients = toolkit.aslist(toolkit.config.get('ckanext.unhcr.error_emails', []))
         for address in recipients:
             subj = '[UNHCR RIDL] Error performing Clam AV Scan'
-            core_mailer.mail_recipient(
+            mailer.queue_mail(
                 'admin',
                 address,
                 subj,
@@ -817,6 +1103,57 @@ def scan_hook(context, data_dict):
     return data_dict
 
 
+def scan_all(context, data_dict):
+    '''
+    Queue a background job submitting all the uploaded resources
+    lacking a recent Clam AV verdict for scanning
+
+    :param max_age: re-scan resources whose last verdict is older than this
+        number of days (optional, default: ``ckanext.unhcr.clamav_rescan_max_age``
+        or ``30``)
+    :type max_age: int
+    :param limit: maximum number of resources to submit (optional)
+    :type limit: int
+    :param max_in_flight: maximum number of tasks waiting for a verdict
+        at any time (optional, default: ``ckanext.unhcr.clamav_max_in_flight``
+        or ``10``)
+    :type max_in_flight: int
+    :param resume: continue from where the last run stopped (optional,
+        default: ``False``)
+    :type resume: bool
+
+    :returns: The number of resources to scan and the id of the queued job
+    :rtype: dict
+    '''
+    toolkit.check_access('scan_all', context, data_dict)
+
+    if not toolkit.config.get('ckanext.unhcr.clamav_url'):
+        raise toolkit.ValidationError({'message': 'Clam AV Service is not configured.'})
+
+    kwargs = {'resume': toolkit.asbool(data_dict.get('resume', False))}
+    for key in ['max_age', 'limit', 'max_in_flight']:
+        if data_dict.get(key) is None:
+            continue
+        try:
+            kwargs[key] = int(data_dict[key])
+        except ValueError:
+            raise toolkit.ValidationError({key: ['Must be an integer']})
+        if kwargs[key] < 1:
+            raise toolkit.ValidationError({key: ['Must be a positive integer']})
+
+    max_age = kwargs.get('max_age') or toolkit.asint(
+        toolkit.config.get('ckanext.unhcr.clamav_rescan_max_age', 30))
+    # Count what the job will walk through (from where it stopped if resuming)
+    after = jobs.get_scan_all_progress().get('last_id') if kwargs['resume'] else None
+    count = utils.count_resources_to_scan(
+        datetime.timedelta(days=max_age), after=after, limit=kwargs.get('limit'))
+
+    job = toolkit.enqueue_job(
+        jobs.scan_all_resources, kwargs=kwargs, title='Clam AV scan all resources')
+
+    return {'count': count, 'job_id': job.id}
+
+
 @toolkit.chained_action
 def resource_create(up_func, context, data_dict):
     toolkit.check_access('resource_create', context, data_dict)
@@ -859,25 +1196,24 @@ def access_request_list_for_user(context, data_dict):
     """
     Return a list of all access requests the user can see
 
+    Requests are sorted newest first. Pages can be requested either with
+    ``offset`` or, more efficiently for deep pages, with ``after`` set to the
+    id of the last request of the previous page.
+
     :param status: ``'requested'``, ``'approved'`` or ``'rejected'``
       (default: ``'requested'``)
     :type status: string
+    :param limit: the maximum number of requests to return (optional)
+    :type limit: int
+    :param offset: the number of requests to skip (optional)
+    :type offset: int
+    :param after: return the requests following this request id (optional)
+    :type after: string
 
     :returns: A list of AccessRequest objects
     :rtype: list of dictionaries
     """
     m = context.get('model', model)
-    user_id = toolkit.get_or_bust(context, "user")
-    status = data_dict.get("status", "requested")
-    if status not in ['requested', 'approved', 'rejected']:
-        raise toolkit.ValidationError('Invalid status {}'.format(status))
-
-    user = m.User.get(user_id)
-    if not user:
-        raise toolkit.ObjectNotFound("User not found")
-
-    toolkit.check_access('access_request_list_for_user', context, data_dict)
-
     access_requests_table = m.meta.metadata.tables["access_requests"]
     group_table = m.meta.metadata.tables["group"]
     package_table = m.meta.metadata.tables["package"]
@@ -885,18 +1221,89 @@ def access_request_list_for_user(context, data_dict):
 
     select_cols = (
         [c for c in access_requests_table.columns] +
-        [c for c in group_table.columns] +
-        [c for c in package_table.columns] +
-        [
-            c for c in user_table.columns
-            if c.name != 'plugin_extras'
-            and c.name != 'password'
-            and c.name != 'apikey'
-        ]
+        [group_table.c[c] for c in ['id', 'name', 'title', 'type']] +
+        [package_table.c[c] for c in ['id', 'name', 'title', 'type', 'owner_org']] +
+        [user_table.c[c] for c in ['id', 'name', 'fullname', 'email']]
+    )
+    join_obj = access_requests_table.join(
+        package_table,
+        and_(
+            access_requests_table.c.object_type == "package",
+            access_requests_table.c.object_id == package_table.c.id,
+        ), isouter=True,
+    ).join(
+        group_table,
+        and_(
+            access_requests_table.c.object_type == "organization",
+            access_requests_table.c.object_id == group_table.c.id,
+        ), isouter=True,
+    ).join(
+        user_table,
+        access_requests_table.c.user_id == user_table.c.id
     )
 
+    where = _get_access_request_list_filter(context, data_dict)
+    if where is None:
+        return []
+
     sql = select(
         select_cols, use_labels=True,
+    ).select_from(
+        join_obj
+    ).where(
+        where
+    ).order_by(
+        desc(access_requests_table.c.timestamp),
+        desc(access_requests_table.c.id),
+    )
+
+    # Pagination
+    after = data_dict.get('after')
+    if after:
+        marker = m.Session.query(AccessRequest).get(after)
+        if not marker:
+            raise toolkit.ObjectNotFound("Access Request not found")
+        sql = sql.where(
+            or_(
+                access_requests_table.c.timestamp < marker.timestamp,
+                and_(
+                    access_requests_table.c.timestamp == marker.timestamp,
+                    access_requests_table.c.id < marker.id,
+                )
+            )
+        )
+    limit = _get_non_negative_int(data_dict, 'limit')
+    if limit is not None:
+        sql = sql.limit(limit)
+    offset = _get_non_negative_int(data_dict, 'offset')
+    if offset:
+        sql = sql.offset(offset)
+
+    return [dictize_access_request(req) for req in m.Session.execute(sql).fetchall()]
+
+
+@toolkit.side_effect_free
+def access_request_count_for_user(context, data_dict):
+    """
+    Return the number of access requests the user can see
+
+    :param status: ``'requested'``, ``'approved'`` or ``'rejected'``
+      (default: ``'requested'``)
+    :type status: string
+
+    :returns: The number of access requests
+    :rtype: int
+    """
+    m = context.get('model', model)
+    access_requests_table = m.meta.metadata.tables["access_requests"]
+    package_table = m.meta.metadata.tables["package"]
+
+    where = _get_access_request_list_filter(context, data_dict)
+    if where is None:
+        return 0
+
+    sql = select(
+        [func.count()]
     ).select_from(
         access_requests_table.join(
             package_table,
@@ -904,33 +1311,45 @@ def access_request_list_for_user(context, data_dict):
                 access_requests_table.c.object_type == "package",
                 access_requests_table.c.object_id == package_table.c.id,
             ), isouter=True,
-        ).join(
-            group_table,
-            and_(
-                access_requests_table.c.object_type == "organization",
-                access_requests_table.c.object_id == group_table.c.id,
-            ), isouter=True,
-        ).join(
-            user_table,
-            access_requests_table.c.user_id == user_table.c.id
         )
-    ).order_by(
-        desc(access_requests_table.c.timestamp)
     ).where(
-        access_requests_table.c.status == status
+        where
     )
 
+    return m.Session.execute(sql).scalar()
+
+
+def _get_access_request_list_filter(context, data_dict):
+    # Returns the filter for the access requests the user can see,
+    # or None if there are none (the package table must be joined)
+    m = context.get('model', model)
+    user_id = toolkit.get_or_bust(context, "user")
+    status = data_dict.get("status", "requested")
+    if status not in ['requested', 'approved', 'rejected']:
+        raise toolkit.ValidationError('Invalid status {}'.format(status))
+
+    user = m.User.get(user_id)
+    if not user:
+        raise toolkit.ObjectNotFound("User not found")
+
+    toolkit.check_access('access_request_list_for_user', context, data_dict)
+
+    access_requests_table = m.meta.metadata.tables["access_requests"]
+    package_table = m.meta.metadata.tables["package"]
+    where = access_requests_table.c.status == status
+
     if user.sysadmin:
-        return [dictize_access_request(req) for req in m.Session.execute(sql).fetchall()]
+        return where
 
     organizations = toolkit.get_action("organization_list_for_user")(
         context, {"id": user_id, "permission": "admin"}
     )
     containers = [o["id"] for o in organizations]
     if not containers:
-        return []
+        return None
 
-    sql = sql.where(
+    return and_(
+        where,
         or_(
             and_(
                 access_requests_table.c.object_type == "package",
@@ -947,7 +1366,18 @@ def access_request_list_for_user(context, data_dict):
         )
     )
 
-    return [dictize_access_request(req) for req in m.Session.execute(sql).fetchall()]
+
+def _get_non_negative_int(data_dict, key):
+    value = data_dict.get(key)
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise toolkit.ValidationError({key: ['Must be a non-negative integer']})
+    return value
 
 
 def _validate_status(status):
@@ -990,12 +1420,94 @@ def access_request_update(context, data_dict):
 
     toolkit.check_access('access_request_update', context, data_dict)
 
+    _action_access_request(context, request, status)
+
+    request.status = status
+    request.actioned_by = model.User.by_name(context['user']).id
+    model.Session.commit()
+    model.Session.refresh(request)
+    helpers.invalidate_pending_requests_total()
+
+    return {
+        col.name: getattr(request, col.name)
+        for col in request.__table__.columns
+    }
+
+
+def access_request_update_many(context, data_dict):
+    """
+    Approve or reject many requests for access at once
+
+    All the requests are loaded and authorized before any of them is
+    actioned. The requests are then actioned in order: every one is
+    committed and its notification email queued as soon as it succeeds,
+    so if one fails the ones before it stay actioned.
+
+    :param ids: access request ids
+    :type ids: list of strings
+    :param status: new status value ('approved', 'rejected')
+    :type status: string
+    :param message: message to the requesting users, required when rejecting
+    :type message: string
+
+    :returns: The updated access requests
+    :rtype: list of dictionaries
+    """
+    m = context.get('model', model)
+    ids = utils.normalize_list(toolkit.get_or_bust(data_dict, "ids"))
+    status = toolkit.get_or_bust(data_dict, "status")
+    message = data_dict.get('message')
+    _validate_status(status)
+    if not ids:
+        raise toolkit.ValidationError({'ids': ["'ids' is required"]})
+    if status == 'rejected' and not message:
+        raise toolkit.ValidationError({'message': ["'message' is required"]})
+
+    requests = m.Session.query(AccessRequest).filter(AccessRequest.id.in_(ids)).all()
+    requests.sort(key=lambda request: ids.index(request.id))
+    missing = set(ids) - set(request.id for request in requests)
+    if missing:
+        raise toolkit.ObjectNotFound(
+            "Access Request not found: {}".format(', '.join(sorted(missing))))
+    actioned = [request.id for request in requests if request.status != 'requested']
+    if actioned:
+        raise toolkit.ValidationError(
+            {'ids': ['Access Request already actioned: {}'.format(', '.join(actioned))]})
+
+    # Actions may store objects in the context
+    # so every call gets its own copy
+    for request in requests:
+        toolkit.check_access('access_request_update', dict(context), {'id': request.id})
+
+    # The actions commit the session themselves so every request
+    # is committed on its own
+    actioned_by = m.User.by_name(context['user']).id
+    try:
+        for request in requests:
+            _action_access_request(dict(context), request, status, notify=False)
+            request.status = status
+            request.actioned_by = actioned_by
+            m.Session.commit()
+            recipient_id, subj, body = _get_access_request_email(request, status, message)
+            mailer.mail_user_by_id(recipient_id, subj, body)
+    finally:
+        helpers.invalidate_pending_requests_total()
+
+    return [
+        {col.name: getattr(request, col.name) for col in request.__table__.columns}
+        for request in requests
+    ]
+
+
+def _action_access_request(context, request, status, notify=True):
+    m = context.get('model', model)
+
     if request.object_type == 'package':
         _data_dict = {
             'id': request.object_id,
             'user_id': request.user_id,
             'capacity': request.role,
-            'send_mail': True,
+            'send_mail': notify,
         }
         if status == 'approved':
             toolkit.get_action('dataset_collaborator_create')(
@@ -1007,6 +1519,8 @@ def access_request_update(context, data_dict):
             'username': request.user_id,
             'role': request.role,
         }
+        if not notify:
+            _data_dict['not_notify'] = True
         if status == 'approved':
             toolkit.get_action('organization_member_create')(
                 context, _data_dict
@@ -1018,7 +1532,7 @@ def access_request_update(context, data_dict):
             context, _data_dict
         )
 
-        if status == 'approved':
+        if status == 'approved' and notify:
             # Notify the user
             subj = mailer.compose_account_approved_email_subj()
             body = mailer.compose_account_approved_email_body(user)
@@ -1026,15 +1540,33 @@ def access_request_update(context, data_dict):
     else:
         raise toolkit.Invalid("Unknown Object Type")
 
-    request.status = status
-    request.actioned_by = model.User.by_name(context['user']).id
-    model.Session.commit()
-    model.Session.refresh(request)
 
-    return {
-        col.name: getattr(request, col.name)
-        for col in request.__table__.columns
-    }
+def _get_access_request_email(request, status, message=None):
+    # Returns the recipient id, subject and body of the email
+    # notifying the requesting user of the decision
+    context = {'model': model, 'ignore_auth': True}
+    recipient = toolkit.get_action('user_show')(context, {'id': request.user_id})
+    obj = toolkit.get_action('{}_show'.format(request.object_type))(
+        context, {'id': request.object_id})
+
+    if status == 'rejected':
+        if request.object_type == 'user':
+            subj = '[UNHCR RIDL] - User account rejected'
+        else:
+            subj = mailer.compose_request_rejected_email_subj(obj)
+        body = mailer.compose_request_rejected_email_body(
+            request.object_type, recipient, obj, message)
+    elif request.object_type == 'package':
+        subj = mailer.compose_collaborator_email_subj(obj)
+        body = mailer.compose_collaborator_email_body(obj, recipient, request.role)
+    elif request.object_type == 'organization':
+        subj = mailer.compose_membership_email_subj(obj)
+        body = mailer.compose_membership_email_body(obj, recipient, 'create')
+    else:
+        subj = mailer.compose_account_approved_email_subj()
+        body = mailer.compose_account_approved_email_body(recipient)
+
+    return recipient['id'], subj, body
 
 
 def access_request_create(context, data_dict):
@@ -1098,6 +1630,7 @@ def access_request_create(context, data_dict):
         model.Session.refresh(request)
     else:
         model.Session.flush()
+    helpers.invalidate_pending_requests_total()
 
     return {
         col.name: getattr(request, col.name)
@@ -1113,6 +1646,7 @@ def external_user_update_state(context, data_dict):
     - The target user is external
     - The target user's current status is 'pending'
     Additionally, a sysadmin may change the status of another user at any time.
+    Reactivating an expired external user extends their account from today.
 
     :param id: The id or name of the target user
     :type id: string
@@ -1131,8 +1665,13 @@ def external_user_update_state(context, data_dict):
     if not user_obj:
         raise toolkit.ObjectNotFound("User not found")
     user_obj.state = state
+    plugin_extras = _init_plugin_extras(user_obj.plugin_extras)
+    if state == m.State.ACTIVE and plugin_extras['unhcr'].pop('expired', None):
+        plugin_extras['unhcr']['expiry_date'] = _get_external_user_expiry_date().isoformat()
+        user_obj.plugin_extras = plugin_extras
     m.Session.commit()
     m.Session.refresh(user_obj)
+    cache.invalidate('user_autocomplete')
 
     return model_dictize.user_dictize(user_obj, context)
 
@@ -1162,6 +1701,7 @@ def user_update_sysadmin(context, data_dict):
     user_obj.sysadmin = is_sysadmin
     m.Session.commit()
     m.Session.refresh(user_obj)
+    cache.invalidate('user_autocomplete')
 
     return model_dictize.user_dictize(user_obj, context)
 
@@ -1237,24 +1777,23 @@ def user_autocomplete(context, data_dict):
     q = data_dict['q']
     limit = data_dict.get('limit', 20)
 
-    query = model.User.search(q)
-    query = query.filter(model.User.state != model.State.DELETED)
-    if not include_external_users:
-        conditions = [
-            model.User.email.ilike('%@{}'.format(domain))
-            for domain in utils.get_internal_domains()
-        ]
-        query = query.filter(or_(*conditions))
-    query = query.limit(limit)
+    # The pickers repeat the same prefixes while typing. Every query
+    # expires on its own, and the users changed by this extension's
+    # actions drop the whole cache
+    cache_key = json.dumps([q.strip().lower(), limit, bool(include_external_users)])
+    user_list = cache.get('user_autocomplete', cache_key)
+    if user_list is not None:
+        return user_list
 
     user_list = []
-    for user in query.all():
+    for user in utils.search_users(q, include_external_users, limit):
         result_dict = {}
         for k in ['id', 'name', 'fullname']:
             result_dict[k] = getattr(user, k)
 
         user_list.append(result_dict)
 
+    cache.put('user_autocomplete', cache_key, user_list, ttl=USER_AUTOCOMPLETE_CACHE_TTL)
     return user_list
 
 
@@ -1263,31 +1802,94 @@ def user_list(up_func, context, data_dict):
     users = up_func(context, data_dict)
     m = context.get('model', model)
 
-    if type(users[0]) == dict:
-        users_db = (
-            m.Session.query(m.User)
+    if users and type(users[0]) == dict:
+        rows = (
+            m.Session.query(m.User.id, utils.internal_users_filter())
             .filter(m.User.id.in_([u['id'] for u in users]))
             .all()
         )
-        id_to_external = {u.id: u.external for u in users_db}
+        id_to_external = {id: not internal for id, internal in rows}
         for user in users:
             user['external'] = id_to_external[user['id']]
 
     return users
 
 
+MEMBERSHIP_USERS_LIMIT = 20
+
+
+@toolkit.side_effect_free
+def membership_user_list(context, data_dict):
+    '''Return a page of users for the membership management pages.
+
+    Sysadmins only. Users are sorted by display name.
+
+    :param q: only users whose name or full name contain this (optional)
+    :type q: string
+    :param include_external: include external users (optional,
+        default: ``False``)
+    :type include_external: bool
+    :param limit: the number of users to return (optional, default: ``20``)
+    :type limit: int
+    :param offset: the number of users to skip (optional)
+    :type offset: int
+
+    :returns: an object with the total ``count`` and ``users``, a list of
+        dictionaries with keys ``'id'``, ``'name'``, ``'display_name'``
+        and ``'external'``
+    :rtype: dict
+    '''
+    toolkit.check_access('sysadmin', context)
+    q = data_dict.get('q', '').strip()
+    include_external = toolkit.asbool(data_dict.get('include_external', False))
+    limit = _get_non_negative_int(data_dict, 'limit')
+    if limit is None:
+        limit = MEMBERSHIP_USERS_LIMIT
+    offset = _get_non_negative_int(data_dict, 'offset') or 0
+
+    display_name = func.coalesce(func.nullif(model.User.fullname, ''), model.User.name)
+    query = (model.Session
+        .query(
+            model.User.id,
+            model.User.name,
+            display_name.label('display_name'),
+            not_(utils.internal_users_filter()).label('external'))
+        .filter(model.User.state != model.State.DELETED)
+        .filter(model.User.name != toolkit.config.get('ckan.site_id')))
+    if not include_external:
+        query = query.filter(utils.internal_users_filter())
+    if q:
+        pattern = u'%{}%'.format(utils.escape_like(q))
+        query = query.filter(or_(
+            model.User.name.ilike(pattern),
+            model.User.fullname.ilike(pattern),
+        ))
+
+    count = query.count()
+    rows = (query
+        .order_by(func.lower(display_name), model.User.name)
+        .offset(offset)
+        .limit(limit)
+        .all())
+
+    return {
+        'count': count,
+        'users': [{
+            'id': row.id,
+            'name': row.name,
+            'display_name': row.display_name,
+            'external': bool(row.external),
+        } for row in rows],
+    }
+
+
 @toolkit.chained_action
 def user_show(up_func, context, data_dict):
     user = up_func(context, data_dict)
+    # core user_show leaves the shown user in context['user_obj']
     user_obj = _get_user_obj(context)
     user['external'] = user_obj.external
-
-    extras = _init_plugin_extras(user_obj.plugin_extras)
-    extras = _validate_plugin_extras(extras['unhcr'])
-
-    user['focal_point'] = extras['focal_point']
-    user['expiry_date'] = extras['expiry_date']
-    user['default_containers'] = extras['default_containers']
+    user.update(utils.get_user_extras(user_obj))
 
     return user
 
@@ -1307,6 +1909,7 @@ def user_create(up_func, context, data_dict):
 
     user = up_func(context, data_dict)
     user_obj = _get_user_obj(context)
+    cache.invalidate('user_autocomplete')
 
     if not user_obj.external:
         return user
@@ -1318,13 +1921,7 @@ def user_create(up_func, context, data_dict):
         raise toolkit.ValidationError({'default_containers': ["Specify one or more containers"]})
 
     plugin_extras = _init_plugin_extras(user_obj.plugin_extras)
-    expiry_date = datetime.date.today() + datetime.timedelta(
-        days=toolkit.config.get(
-            'ckanext.unhcr.external_accounts_expiry_delta',
-            180  # six months-ish
-        )
-    )
-    plugin_extras['unhcr']['expiry_date'] = expiry_date.isoformat()
+    plugin_extras['unhcr']['expiry_date'] = _get_external_user_expiry_date().isoformat()
     plugin_extras['unhcr']['focal_point'] = data_dict['focal_point']
     plugin_extras['unhcr']['default_containers'] = data_dict['default_containers']
     user_obj.plugin_extras = plugin_extras
@@ -1339,6 +1936,15 @@ def user_create(up_func, context, data_dict):
     return user
 
 
+def _get_external_user_expiry_date():
+    return datetime.date.today() + datetime.timedelta(
+        days=toolkit.asint(toolkit.config.get(
+            'ckanext.unhcr.external_accounts_expiry_delta',
+            180  # six months-ish
+        ))
+    )
+
+
 def _init_plugin_extras(plugin_extras):
     out_dict = copy.deepcopy(plugin_extras)
     if not out_dict:
@@ -1346,17 +1952,3 @@ def _init_plugin_extras(plugin_extras):
     if 'unhcr' not in out_dict:
         out_dict['unhcr'] = {}
     return out_dict
-
-
-def _validate_plugin_extras(extras):
-    CUSTOM_FIELDS = [
-        {'name': 'focal_point', 'default': ''},
-        {'name': 'expiry_date', 'default': None},
-        {'name': 'default_containers',  'default': []},
-    ]
-    if not extras:
-        extras = {}
-    out_dict = {}
-    for field in CUSTOM_FIELDS:
-        out_dict[field['name']] = extras.get(field['name'], field['default'])
-    return out_dict
@@ -324,6 +324,10 @@ def scan_submit(context, data_dict):
         return {'success': False}
 
 
+def scan_all(context, data_dict):
+    return {'success': False}
+
+
 def scan_hook(context, data_dict):
     try:
         toolkit.check_access('resource_update', context, data_dict)
@@ -64,6 +64,35 @@ def reject(request_id):
     return toolkit.redirect_to('dashboard.requests')
 
 
+def bulk():
+    if (not hasattr(toolkit.c, "user") or not toolkit.c.user):
+        return toolkit.abort(403, "Forbidden")
+
+    request_ids = toolkit.request.form.getlist('request_ids')
+    status = toolkit.request.form.get('status')
+    message = toolkit.request.form.get('message')
+    if not request_ids:
+        toolkit.h.flash_error('No Access Requests selected')
+        return toolkit.redirect_to('dashboard.requests')
+
+    try:
+        requests = toolkit.get_action('access_request_update_many')(
+            {'user': toolkit.c.user},
+            {'ids': request_ids, 'status': status, 'message': message}
+        )
+    except toolkit.ObjectNotFound as e:
+        return toolkit.abort(404, toolkit._(str(e)))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, toolkit._(u'Not Authorized to update these requests'))
+    except toolkit.ValidationError as e:
+        return toolkit.abort(400, str(e.error_summary))
+
+    toolkit.h.flash_success('{} Access Requests {}'.format(
+        len(requests), 'Approved' if status == 'approved' else 'Rejected'))
+
+    return toolkit.redirect_to('dashboard.requests')
+
+
 unhcr_access_requests_blueprint.add_url_rule(
     rule=u'/approve/<request_id>',
     view_func=approve,
@@ -75,3 +104,9 @@ unhcr_access_requests_blueprint.add_url_rule(
     view_func=reject,
     methods=['POST',]
 )
+
+unhcr_access_requests_blueprint.add_url_rule(
+    rule=u'/bulk',
+    view_func=bulk,
+    methods=['POST',]
+)
@@ -52,6 +52,7 @@ def approve(container_id):
 
     # organization_patch state=active
     org_dict = patch_core.organization_patch({}, {'id': container_id, 'state': 'active'})
+    helpers.invalidate_pending_requests_total()
 
     # send approve email
     for member in get_core.member_list(context, {'id': org_dict['id']}):
@@ -85,6 +86,7 @@ def reject(container_id):
 
     # call organization_purge
     delete_core.organization_purge({'model': model}, {'id': container_id})
+    helpers.invalidate_pending_requests_total()
 
     # show flash message and redirect
     toolkit.h.flash_error(u'Data container "{}" rejected'.format(org_dict['title']))
@@ -105,10 +107,8 @@ def membership():
         message = 'Not authorized to manage membership'
         return toolkit.abort(403, message)
 
-    # Get users
-    users = toolkit.get_action('user_list')(
-        context, {'order_by': 'display_name'})
-    users = [u for u in users if not u['external']]
+    # The users are loaded page by page by the
+    # user select (see the membership_user_list action)
 
     # Get user
     user = None
@@ -152,7 +152,6 @@ def membership():
 
     return toolkit.render('organization/membership.html', {
         'membership': {
-            'users': users,
             'user': user,
             'containers': containers,
             'roles': roles,
@@ -180,28 +179,23 @@ def membership_add():
         message = 'Not authorized to add membership'
         return toolkit.abort(403, message)
 
-    # Add membership
-    containers = []
-    for contname in contnames:
-        try:
-            container = toolkit.get_action('organization_show')(context, {'id': contname})
-            data_dict = {'id': contname, 'username': username, 'role': role, 'not_notify': True}
-            toolkit.get_action('organization_member_create')(context, data_dict)
-            containers.append(container)
-        except (toolkit.ObjectNotFound, toolkit.ValidationError):
-            message = 'User "%s" NOT added to the following data container: "%s"'
-            toolkit.h.flash_error(message % (username, contname))
-
-    # Notify by flash
-    titles = ['"%s"' % cont.get('title', cont['name']) for cont in containers]
-    message = 'User "%s" added to the following data containers: %s'
-    toolkit.h.flash_success(message % (username, ', '.join(titles)))
-
-    # Notify by email
-    user = toolkit.get_action('user_show')(context, {'id': username})
-    subj = mailer.compose_membership_email_subj({'title': 'multiple containers'})
-    body = mailer.compose_membership_email_body(containers, user, 'create_multiple')
-    mailer.mail_user_by_id(username, subj, body)
+    # Add membership (the user is notified by email)
+    try:
+        data_dict = {'username': username, 'ids': contnames, 'role': role}
+        containers = toolkit.get_action('organization_member_create_many')(context, data_dict)
+    except toolkit.ObjectNotFound as e:
+        message = 'User "%s" NOT added to the following data containers: %s (%s)'
+        toolkit.h.flash_error(message % (
+            username, ', '.join('"%s"' % c for c in contnames), e.message or 'Not found'))
+    except toolkit.ValidationError as e:
+        message = 'User "%s" NOT added to the following data containers: %s (%s)'
+        toolkit.h.flash_error(message % (
+            username, ', '.join('"%s"' % c for c in contnames), e.error_summary))
+    else:
+        # Notify by flash
+        titles = ['"%s"' % cont['title'] for cont in containers]
+        message = 'User "%s" added to the following data containers: %s'
+        toolkit.h.flash_success(message % (username, ', '.join(titles)))
 
     # Redirect
     return toolkit.redirect_to('unhcr_data_container.membership', username=username)
@@ -12,7 +12,7 @@ from ckan.views.user import (
     login as core_login
 )
 from ckanext.unhcr.helpers import get_data_deposit
-from ckanext.unhcr.utils import get_internal_domains
+from ckanext.unhcr.utils import get_email_domain, get_internal_domain_set
 from ckanext.unhcr import mailer
 
 log = logging.getLogger(__name__)
@@ -84,13 +84,12 @@ class RegisterView(BaseRegisterView):
             toolkit.h.flash_error(error_msg)
             return self.get(data_dict)
 
-        try:
-            domain = toolkit.request.form['email'].split('@')[1]
-        except IndexError:
+        domain = get_email_domain(toolkit.request.form['email'])
+        if not domain:
             error_message = 'Please enter an email address'
             return self.get(data_dict, {'email': [error_message]}, {'email': error_message})
 
-        if domain in get_internal_domains():
+        if domain in get_internal_domain_set():
             error_message = (
                 'Users with an @{domain} email may not register for a partner account. '.format(
                     domain=domain
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+log = logging.getLogger(__name__)
+
+
+# Module API
+
+# Values are kept in Redis hashes so they are shared by all the web
+# processes and workers, and an invalidation reaches all of them at once.
+# Every value carries its own expiry time, and a hash is deleted once its
+# oldest value has expired so it can't grow forever.
+# Redis errors are logged and handled as cache misses.
+
+def get(name, field):
+    '''
+    Return the cached value of `field` in the hash `name`, or None
+    if it is not cached or it has expired
+    '''
+    try:
+        value = connect_to_redis().hget(_get_key(name), field)
+    except RedisError as exception:
+        log.warning('Cache read failed: {}'.format(exception))
+        return None
+    if value is None:
+        return None
+    value = json.loads(value)
+    if not isinstance(value, dict) or 'value' not in value:
+        return None
+    if value.get('expires') and value['expires'] < time.time():
+        return None
+    return value['value']
+
+
+def put(name, field, value, ttl=None):
+    '''
+    Cache a JSON-serializable value as `field` in the hash `name`
+
+    The value expires after `ttl` seconds. The hash itself expires `ttl`
+    seconds after it was created, so values are never kept longer than
+    that even if they are not read again.
+    '''
+    expires = time.time() + ttl if ttl else None
+    try:
+        redis_conn = connect_to_redis()
+        pipeline = redis_conn.pipeline()
+        pipeline.hset(_get_key(name), field, json.dumps({'value': value, 'expires': expires}))
+        pipeline.ttl(_get_key(name))
+        key_ttl = pipeline.execute()[1]
+        # Only set when the hash is created, so later writes don't extend it
+        if ttl and (key_ttl is None or key_ttl < 0):
+            redis_conn.expire(_get_key(name), ttl)
+    except RedisError as exception:
+        log.warning('Cache write failed: {}'.format(exception))
+
+
+def invalidate(*names):
+    '''
+    Drop all the cached values of the given hashes
+    '''
+    try:
+        connect_to_redis().delete(*[_get_key(name) for name in names])
+    except RedisError as exception:
+        log.warning('Cache invalidation failed: {}'.format(exception))
+
+
+def clear():
+    '''
+    Drop all the cached values of this site
+    '''
+    try:
+        redis_conn = connect_to_redis()
+        keys = list(redis_conn.scan_iter(_get_key('*')))
+        if keys:
+            redis_conn.delete(*keys)
+    except RedisError as exception:
+        log.warning('Cache invalidation failed: {}'.format(exception))
+
+
+# Internal
+
+def _get_key(name):
+    return '{}:unhcr:{}'.format(toolkit.config.get('ckan.site_id'), name)
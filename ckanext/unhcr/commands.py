@@ -1,17 +1,30 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import time
+from datetime import timedelta
 
 from ckan.plugins import toolkit
 import ckan.model as model
 
+from ckanext.unhcr.jobs import (
+    expire_external_users,
+    scan_all_resources,
+    sweep_stale_clamav_tasks,
+)
 from ckanext.unhcr.models import create_tables, TimeSeriesMetric
 from ckanext.unhcr.mailer import (
-    compose_summary_email_body,
+    compose_summary_emails,
+    get_mail_queue_status,
     get_summary_email_recipients,
-    mail_user_by_id
+    mail_user_by_id,
+    purge_sent_mail,
+    send_queued_mail,
 )
 
+MAIL_POLL_INTERVAL = 5  # seconds
+MAIL_KEEP_SENT = timedelta(days=30)
+
 
 class Unhcr(toolkit.CkanCommand):
     u'''Utilities for the CKAN UNHCR extension
@@ -24,8 +37,24 @@ class Unhcr(toolkit.CkanCommand):
             Take a snapshot of time-series metrics
 
         paster unhcr send-summary-emails
-            Send a summary of activity over the last 7 days
-            to sysadmins and curators
+            Queue a summary of activity over the last 7 days
+            to sysadmins and curators (delivered by send-mail)
+
+        paster unhcr scan-all [--max-age=DAYS] [--limit=N]
+                [--max-in-flight=N] [--rate=N] [--resume]
+            Submit all uploaded resources without a Clam AV verdict
+            from the last DAYS days (default 30) for scanning
+
+        paster unhcr sweep-clamav-tasks [--max-in-flight=N]
+            Resubmit or fail Clam AV tasks stuck waiting for a verdict
+
+        paster unhcr send-mail [--loop]
+            Send the queued emails. With --loop keep polling the queue
+            (to be run as a service next to the jobs worker)
+
+        paster unhcr expire-external-users
+            Deactivate the external users whose account expired
+            and notify them (to be run daily)
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -34,6 +63,18 @@ class Unhcr(toolkit.CkanCommand):
 
     def __init__(self, name):
         super(Unhcr, self).__init__(name)
+        self.parser.add_option('--max-age', dest='max_age', type='int', default=None,
+            help='Re-scan resources whose last verdict is older than this number of days')
+        self.parser.add_option('--limit', dest='limit', type='int', default=None,
+            help='Maximum number of resources to submit')
+        self.parser.add_option('--max-in-flight', dest='max_in_flight', type='int', default=None,
+            help='Maximum number of scans waiting for a verdict at any time')
+        self.parser.add_option('--rate', dest='rate', type='float', default=None,
+            help='Maximum number of submissions per second')
+        self.parser.add_option('--resume', dest='resume', action='store_true', default=False,
+            help='Continue from where the last scan-all run stopped')
+        self.parser.add_option('--loop', dest='loop', action='store_true', default=False,
+            help='Keep sending queued emails as they arrive')
 
     def command(self):
         self._load_config()
@@ -49,6 +90,14 @@ class Unhcr(toolkit.CkanCommand):
             self.snapshot_metrics()
         elif cmd == 'send-summary-emails':
             self.send_summary_emails()
+        elif cmd == 'scan-all':
+            self.scan_all()
+        elif cmd == 'sweep-clamav-tasks':
+            self.sweep_clamav_tasks()
+        elif cmd == 'send-mail':
+            self.send_mail()
+        elif cmd == 'expire-external-users':
+            self.expire_external_users()
         else:
             self.parser.print_usage()
             sys.exit(1)
@@ -89,22 +138,55 @@ class Unhcr(toolkit.CkanCommand):
             print('ckanext.unhcr.send_summary_emails is False. Not sending anything.')
             return
 
-        recipients = get_summary_email_recipients()
+        recipients = [r for r in get_summary_email_recipients() if r['email']]
+        emails = compose_summary_emails(recipients)
         subject = '[UNHCR RIDL] Weekly Summary'
 
-        for recipient in recipients:
-            if recipient['email']:
-                email = compose_summary_email_body(recipient)
+        for recipient, email in zip(recipients, emails):
+            if email['total_events'] == 0:
+                print('SKIPPING summary email to: {}'.format(recipient['email']))
+                continue
 
-                if email['total_events'] == 0:
-                    print('SKIPPING summary email to: {}'.format(recipient['email']))
-                    continue
+            print('SENDING summary email to: {}'.format(recipient['email']))
+            if self.verbose > 1:
+                print(email['body'])
+                print('')
 
-                print('SENDING summary email to: {}'.format(recipient['email']))
-                if self.verbose > 1:
-                    print(email['body'])
-                    print('')
+            mail_user_by_id(recipient['id'], subject, email['body'])
 
-                mail_user_by_id(recipient['id'], subject, email['body'])
+        # Delivered by the send-mail service
+        print('Queued weekly summary emails.')
 
-        print('Sent weekly summary emails.')
+    def scan_all(self):
+        progress = scan_all_resources(
+            max_age=self.options.max_age,
+            limit=self.options.limit,
+            max_in_flight=self.options.max_in_flight,
+            rate=self.options.rate,
+            resume=self.options.resume,
+        )
+        print('{total} resources to scan: {submitted} submitted, '
+            '{skipped} skipped, {failed} failed'.format(**progress))
+
+    def sweep_clamav_tasks(self):
+        counts = sweep_stale_clamav_tasks(max_in_flight=self.options.max_in_flight)
+        print('{stale} stale Clam AV tasks: {resubmitted} resubmitted, '
+            '{failed} failed, {deferred} deferred. '
+            '{in_flight} tasks waiting for a verdict'.format(**counts))
+
+    def send_mail(self):
+        purge_sent_mail(MAIL_KEEP_SENT)
+        while True:
+            counts = send_queued_mail()
+            if sum(counts.values()):
+                print('{sent} emails sent, {retried} to retry, {failed} failed'.format(**counts))
+            if not self.options.loop:
+                break
+            if not counts['sent']:
+                time.sleep(MAIL_POLL_INTERVAL)
+        status = get_mail_queue_status()
+        print('{pending} emails pending, {failed} failed'.format(**status))
+
+    def expire_external_users(self):
+        count = expire_external_users()
+        print('{} expired external users deactivated'.format(count))
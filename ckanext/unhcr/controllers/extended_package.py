@@ -186,6 +186,8 @@ class ExtendedPackageController(PackageController):
         # Show flash message and redirect
         if not error:
             message = 'Dataset "%s" published to the Microdata library at the following address: "%s"'
+            if survey.get('job_id'):
+                message += '. Resources and files are being uploaded in the background'
             toolkit.h.flash_success(message % (dataset['title'], survey['url']))
         else:
             message = 'Dataset "%s" publishing to the Microdata library is not completed for the following reason: "%s"'
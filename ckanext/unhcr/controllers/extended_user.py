@@ -5,6 +5,9 @@ from ckan.controllers.user import UserController
 from ckanext.unhcr import helpers
 log = logging.getLogger(__name__)
 
+CONTAINER_REQUESTS_PER_PAGE = 20
+ACCESS_REQUESTS_PER_PAGE = 20
+
 
 class ExtendedUserController(UserController):
 
@@ -17,19 +20,37 @@ class ExtendedUserController(UserController):
         context = {'model': model, 'user': toolkit.c.user}
         self._custom_setup_template_variables(context)
 
+        page = self._get_page_param('page')
+        requests_page = self._get_page_param('requests_page')
         try:
             new_container_requests = toolkit.get_action('container_request_list')(
-                context, {'all_fields': True}
+                context, {
+                    'all_fields': True,
+                    'limit': CONTAINER_REQUESTS_PER_PAGE,
+                    'offset': (page - 1) * CONTAINER_REQUESTS_PER_PAGE,
+                }
             )
+            new_container_requests['page'] = page
+            new_container_requests['has_next'] = (
+                page * CONTAINER_REQUESTS_PER_PAGE < new_container_requests['count'])
         except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
             new_container_requests = []
 
+        # One more request than shown tells if there's a next page
         try:
             access_requests = toolkit.get_action('access_request_list_for_user')(
-                context, {}
+                context, {
+                    'limit': ACCESS_REQUESTS_PER_PAGE + 1,
+                    'offset': (requests_page - 1) * ACCESS_REQUESTS_PER_PAGE,
+                }
             )
         except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
             access_requests = []
+        access_requests_pager = {
+            'page': requests_page,
+            'has_next': len(access_requests) > ACCESS_REQUESTS_PER_PAGE,
+        }
+        access_requests = access_requests[:ACCESS_REQUESTS_PER_PAGE]
 
         container_access_requests = [
             req for req in access_requests if req['object_type'] == 'organization'
@@ -47,10 +68,17 @@ class ExtendedUserController(UserController):
             'container_access_requests': container_access_requests,
             'dataset_access_requests': dataset_access_requests,
             'user_account_requests': user_account_requests,
+            'access_requests_pager': access_requests_pager,
         })
 
     # Private
 
+    def _get_page_param(self, name):
+        try:
+            return max(int(toolkit.request.params.get(name, 1)), 1)
+        except ValueError:
+            return 1
+
     def _custom_setup_template_variables(self, context):
         context = {'model': model, 'session': model.Session,
                    'user': toolkit.c.user, 'auth_user_obj': toolkit.c.userobj,
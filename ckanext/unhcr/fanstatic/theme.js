@@ -138,12 +138,31 @@ $( document ).ready(function() {
 $( document ).ready(function() {
 
   // Activate select2 widget
+  // The users are loaded page by page
+  var usersPerPage = 20;
   $('#membership-username')
     .on('change', function(ev) {
       $(ev.target.form).submit();
     })
     .select2({
       placeholder: 'Click or start typing a user name',
+      ajax: {
+        url: $('#membership-username').data('source'),
+        dataType: 'json',
+        quietMillis: 250,
+        data: function(term, page) {
+          return {q: term, limit: usersPerPage, offset: (page - 1) * usersPerPage};
+        },
+        results: function(data, page) {
+          var users = $.map(data.result.users, function(user) {
+            return {id: user.name, text: user.display_name};
+          });
+          return {results: users, more: page * usersPerPage < data.result.count};
+        },
+      },
+      initSelection: function(element, callback) {
+        callback({id: element.val(), text: element.data('display-name')});
+      },
     });
 
   // Activate select2 widget
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import re
@@ -14,7 +15,7 @@ from ckanext.hierarchy import helpers as hierarchy_helpers
 from ckanext.scheming.helpers import (
     scheming_get_dataset_schema, scheming_field_by_name
 )
-from ckanext.unhcr import utils
+from ckanext.unhcr import cache, hierarchy, utils
 from ckanext.unhcr import __VERSION__
 from ckanext.unhcr.models import AccessRequest
 
@@ -134,43 +135,48 @@ def get_allowable_parent_groups(group_id):
     return groups
 
 
+_rendered_tree = {'version': None, 'html': None}
 def render_tree(top_nodes=None):
-    '''Returns HTML for a hierarchy of all data containers'''
-    context = {'model': model, 'session': model.Session}
-    if not top_nodes:
-        top_nodes = toolkit.get_action('group_tree')(
-            context,
-            data_dict={'type': 'data-container'})
+    '''Returns HTML for a hierarchy of all data containers
 
-    # Remove data deposit
-    deposit = get_data_deposit()
-    top_nodes = filter(lambda node: node['id'] != deposit['id'], top_nodes)
+    The HTML of the whole hierarchy is cached until the
+    hierarchy changes (see :py:func:`hierarchy.invalidate`).
+    '''
+    if top_nodes:
+        return _render_tree(top_nodes)
 
-    return _render_tree(top_nodes)
+    version = hierarchy.get_version()
+    if _rendered_tree['version'] != version:
+        html = _render_tree(hierarchy.get_tree())
+        _rendered_tree.update({'version': version, 'html': html})
+    return _rendered_tree['html']
 
 
 def _render_tree(top_nodes):
-    html = '<ul class="hierarchy-tree-top">'
+    # Remove data deposit
+    deposit = get_data_deposit()
+    top_nodes = filter(lambda node: node['id'] != deposit['id'], top_nodes)
+
+    html = [u'<ul class="hierarchy-tree-top">']
     for node in top_nodes:
-        html += _render_tree_node(node)
-    return html + '</ul>'
+        _render_tree_node(node, html)
+    html.append(u'</ul>')
+    return u''.join(html)
 
 
-def _render_tree_node(node):
-    html = '<a href="/data-container/{}">{}</a>'.format(
-        node['name'], node['title'])
-    if node['children']:
-        html += '<ul class="hierarchy-tree">'
-        for child in node['children']:
-            html += _render_tree_node(child)
-        html += '</ul>'
-
+def _render_tree_node(node, html):
     if node['highlighted']:
-        html = '<li id="node_{}" class="highlighted">{}</li>'.format(
-            node['name'], html)
+        html.append(u'<li id="node_{}" class="highlighted">'.format(escape(node['name'])))
     else:
-        html = '<li id="node_{}">{}</li>'.format(node['name'], html)
-    return html
+        html.append(u'<li id="node_{}">'.format(escape(node['name'])))
+    html.append(u'<a href="/data-container/{}">{}</a>'.format(
+        escape(node['name']), escape(node['title'])))
+    if node['children']:
+        html.append(u'<ul class="hierarchy-tree">')
+        for child in node['children']:
+            _render_tree_node(child, html)
+        html.append(u'</ul>')
+    html.append(u'</li>')
 
 
 # Access restriction
@@ -299,8 +305,22 @@ def get_linked_datasets_for_display(value, context=None):
 
 # Access requests
 
+PENDING_REQUESTS_CACHE_TTL = 3600  # seconds
+
 def get_pending_requests_total(context=None):
+    '''
+    Return the number of pending requests the user can approve
+
+    Totals are cached per user and invalidated by every event that
+    changes them (see :py:func:`invalidate_pending_requests_total`)
+    '''
     context = context or {'model': model, 'user': toolkit.c.user}
+    user = context.get('user')
+    if user:
+        total = cache.get('pending_requests_total', user)
+        if total is not None:
+            return total
+
     total = 0
 
     try:
@@ -312,16 +332,22 @@ def get_pending_requests_total(context=None):
         pass
 
     try:
-        access_requests = toolkit.get_action('access_request_list_for_user')(
-            context, {}
-        )
-        total += len(access_requests)
+        total += toolkit.get_action('access_request_count_for_user')(context, {})
     except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
         pass
 
+    if user:
+        cache.put('pending_requests_total', user, total, ttl=PENDING_REQUESTS_CACHE_TTL)
+
     return total
 
 
+def invalidate_pending_requests_total():
+    # A request can be visible to many users (sysadmins, container admins)
+    # so the totals of all users are invalidated together
+    cache.invalidate('pending_requests_total')
+
+
 def get_existing_access_request(user_id, object_id, status):
     return model.Session.query(AccessRequest).filter(
         AccessRequest.user_id==user_id,
@@ -456,6 +482,19 @@ def get_deposited_dataset_user_curation_status(dataset, user_id):
             `curator`: an object with the assigned curator user details
     :rtype: dict
     '''
+    # Templates, auth and controllers ask for it several times per request
+    memo = utils.get_request_memo('curation_status')
+    key = (dataset.get('id'), dataset.get('metadata_modified'), user_id)
+    if memo is not None and key in memo:
+        return memo[key]
+
+    status = _get_deposited_dataset_user_curation_status(dataset, user_id)
+    if memo is not None:
+        memo[key] = status
+    return status
+
+
+def _get_deposited_dataset_user_curation_status(dataset, user_id):
     deposit = get_data_deposit()
     context = {'user': user_id, 'model': model, 'session': model.Session}
 
@@ -692,10 +731,9 @@ def get_user_deposited_drafts():
 
 
 def get_default_container_for_user():
-    context = {'model': model, 'user': toolkit.c.user}
-    user = toolkit.get_action('user_show')(context, {'id': toolkit.c.user})
-    if len(user['default_containers']) > 0:
-        return user['default_containers'][0]
+    default_containers = utils.get_user_extras(toolkit.c.userobj)['default_containers']
+    if len(default_containers) > 0:
+        return default_containers[0]
     return 'unknown'
 
 
@@ -989,8 +1027,21 @@ def normalize_list(value):
 
 
 def can_download(package_dict):
+    # The decision only depends on the user and the dataset so it's
+    # memoized for the request (templates call it once per resource)
+    user = toolkit.c.user
+    key = (user, package_dict.get('id'))
+    memo = utils.get_request_memo('can_download')
+    if memo is None:
+        return _can_download(user, package_dict)
+    if key not in memo:
+        memo[key] = _can_download(user, package_dict)
+    return memo[key]
+
+
+def _can_download(user, package_dict):
     try:
-        context = {'user': toolkit.c.user}
+        context = {'user': user}
         resource_dict = package_dict.get('resources', [])[0]
         toolkit.check_access('resource_download', context, resource_dict)
         return True
@@ -998,6 +1049,54 @@ def can_download(package_dict):
         return False
 
 
+def check_access_many(checks):
+    '''
+    Check many auth functions at once for the current user
+
+    The checks share the user object and the lookups of the user
+    memberships, and their results are cached for the request.
+
+    :param checks: An object mapping a key of the caller's choice to an
+        action name or an (action name, data dict) pair, eg
+        `{'edit': ('package_update', {'id': pkg.id}), 'admin': 'sysadmin'}`,
+        or a list of action names or pairs
+    :type checks: dict or list
+
+    :returns: An object mapping every key to whether the user is
+        authorized, eg `{'edit': True, 'admin': False}`, or a list of
+        booleans in the order of the checks if `checks` is a list
+    :rtype: dict or list
+    '''
+    user = toolkit.c.user
+    userobj = toolkit.c.userobj
+    memo = utils.get_request_memo('check_access')
+
+    def check(action, data_dict):
+        key = (user, action, json.dumps(data_dict, sort_keys=True))
+        if memo is not None and key in memo:
+            return memo[key]
+        context = {'model': model, 'user': user, 'auth_user_obj': userobj}
+        try:
+            toolkit.check_access(action, context, dict(data_dict))
+            authorized = True
+        except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
+            authorized = False
+        if memo is not None:
+            memo[key] = authorized
+        return authorized
+
+    def parse(item):
+        if isinstance(item, basestring):
+            return item, {}
+        return item
+
+    with utils.shared_permission_checks():
+        if isinstance(checks, dict):
+            return dict(
+                (key, check(*parse(item))) for key, item in checks.items())
+        return [check(*parse(item)) for item in checks]
+
+
 def get_resource_file_path(resource):
     if resource.get(u'url_type') == u'upload':
         upload = uploader.get_resource_uploader(resource)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import uuid
+
+from sqlalchemy import text
+
+from ckan import model
+from ckanext.unhcr import cache
+
+HIERARCHY_TTL = 3600  # seconds
+
+
+# Module API
+
+# The hierarchy of the active data containers is loaded with one
+# recursive query into in-memory maps (parents, children, ancestors,
+# descendants) and kept per process. A version stored in the shared
+# cache tells every process when it has to reload it (see invalidate).
+
+def get_tree():
+    '''
+    Return the top level data containers with their `children`,
+    in the same format as the `group_tree` action
+    '''
+    hierarchy = _get_hierarchy()
+    return [_get_tree_node(hierarchy, id) for id in hierarchy['top']]
+
+
+def get_container(container_id):
+    '''
+    Return a data container (a dict with "id", "name" and "title") from
+    its id or name, or None if it's not an active data container
+    '''
+    hierarchy = _get_hierarchy()
+    id = _get_id(hierarchy, container_id)
+    if id is None:
+        return None
+    return dict(hierarchy['nodes'][id])
+
+
+def get_root(container_id):
+    '''
+    Return the root data container (a dict with "id", "name" and "title")
+    of a container (its id or name). A top level container is its own root.
+    Returns None if it's not an active data container.
+    '''
+    hierarchy = _get_hierarchy()
+    id = _get_id(hierarchy, container_id)
+    if id is None:
+        return None
+    return dict(hierarchy['nodes'][hierarchy['roots'][id]])
+
+
+def get_ancestors(container_id):
+    '''
+    Return the ancestors of a container from its parent up to its root
+    '''
+    hierarchy = _get_hierarchy()
+    id = _get_id(hierarchy, container_id)
+    if id is None:
+        return []
+    return [dict(hierarchy['nodes'][ancestor]) for ancestor in hierarchy['ancestors'][id]]
+
+
+def get_descendants(container_id):
+    '''
+    Return all the descendants of a container, depth first
+    '''
+    hierarchy = _get_hierarchy()
+    id = _get_id(hierarchy, container_id)
+    if id is None:
+        return []
+    return [dict(hierarchy['nodes'][descendant]) for descendant in hierarchy['descendants'][id]]
+
+
+def get_version():
+    '''
+    Return the version of the hierarchy currently in use,
+    it changes every time the hierarchy is invalidated
+    '''
+    _get_hierarchy()
+    return _hierarchy['version']
+
+
+def invalidate():
+    '''
+    Make every process reload the hierarchy on its next use
+
+    Call it once the change to the containers or their parents
+    has been committed.
+    '''
+    cache.put('hierarchy', 'version', uuid.uuid4().hex)
+
+
+# Internal
+
+_hierarchy = {'version': None, 'fetched': 0, 'data': None}
+_hierarchy_lock = threading.Lock()
+def _get_hierarchy():
+    version = cache.get('hierarchy', 'version')
+    with _hierarchy_lock:
+        if (version is None or
+                version != _hierarchy['version'] or
+                time.time() - _hierarchy['fetched'] > HIERARCHY_TTL):
+            if version is None:
+                version = uuid.uuid4().hex
+                cache.put('hierarchy', 'version', version)
+            _hierarchy.update({
+                'version': version,
+                'fetched': time.time(),
+                'data': _load_hierarchy(),
+            })
+        return _hierarchy['data']
+
+
+def _load_hierarchy():
+    sql = text('''
+        WITH RECURSIVE containers AS (
+            SELECT id, name, title FROM "group"
+            WHERE type = 'data-container' AND state = 'active' AND is_organization
+        ), closure(descendant_id, ancestor_id, depth) AS (
+            SELECT id, id, 0 FROM containers
+            UNION ALL
+            SELECT c.descendant_id, m.group_id, c.depth + 1
+            FROM closure AS c
+            JOIN member AS m ON m.table_id = c.ancestor_id
+                AND m.table_name = 'group' AND m.state = 'active'
+            JOIN containers AS p ON p.id = m.group_id
+            WHERE c.depth < 100
+        )
+        SELECT c.descendant_id, c.ancestor_id, c.depth, g.name, g.title
+        FROM closure AS c JOIN containers AS g ON g.id = c.descendant_id
+        ORDER BY c.descendant_id, c.depth
+    ''')
+
+    nodes = {}
+    ancestors = {}
+    for row in model.Session.execute(sql):
+        if row.depth == 0:
+            nodes[row.descendant_id] = {'id': row.descendant_id, 'name': row.name, 'title': row.title}
+            ancestors[row.descendant_id] = []
+        else:
+            ancestors[row.descendant_id].append(row.ancestor_id)
+
+    title = lambda id: (nodes[id]['title'] or nodes[id]['name']).lower()
+    children = dict((id, []) for id in nodes)
+    for id, node_ancestors in ancestors.items():
+        if node_ancestors:
+            children[node_ancestors[0]].append(id)
+    for ids in children.values():
+        ids.sort(key=title)
+
+    def _walk(id):
+        descendants = []
+        for child in children[id]:
+            descendants.append(child)
+            descendants.extend(_walk(child))
+        return descendants
+
+    return {
+        'nodes': nodes,
+        'names': dict((node['name'], id) for id, node in nodes.items()),
+        'top': sorted([id for id in nodes if not ancestors[id]], key=title),
+        'children': children,
+        'ancestors': ancestors,
+        'descendants': dict((id, _walk(id)) for id in nodes),
+        'roots': dict((id, (ancestors[id] or [id])[-1]) for id in nodes),
+    }
+
+
+def _get_id(hierarchy, container_id):
+    if container_id in hierarchy['nodes']:
+        return container_id
+    return hierarchy['names'].get(container_id)
+
+
+def _get_tree_node(hierarchy, id):
+    node = dict(hierarchy['nodes'][id])
+    node['highlighted'] = False
+    node['children'] = [_get_tree_node(hierarchy, child) for child in hierarchy['children'][id]]
+    return node
@@ -1,11 +1,18 @@
+import datetime
+import json
 import logging
 import time
 
+from sqlalchemy import not_, text
 from ckan import model
-from ckanext.unhcr import utils
+from ckan.lib import search
+from ckanext.unhcr import cache, helpers, mailer, microdata, utils
 import ckan.plugins.toolkit as toolkit
+from ckanext.collaborators.model import DatasetMember
 log = logging.getLogger(__name__)
 
+SCAN_ALL_POLL_INTERVAL = 5  # seconds
+
 
 # Module API
 
@@ -53,8 +60,251 @@ def process_dataset_on_update(package_id):
     _delete_link_package_back_references(package_id, removed_link_package_ids)
 
 
+def reindex_datasets(package_ids):
+    package_index = search.index_for(model.Package)
+    context = {'model': model, 'ignore_auth': True, 'validate': False, 'use_cache': False}
+    for package_id in package_ids:
+        try:
+            package_index.update_dict(
+                toolkit.get_action('package_show')(context, {'id': package_id}),
+                defer_commit=True
+            )
+        except Exception as exception:
+            log.error('Unable to reindex dataset {}: {}'.format(package_id, repr(exception)))
+    search.commit()
+
+
+def scan_all_resources(max_age=None, limit=None, max_in_flight=None, rate=None, resume=False):
+    '''
+    Submit every uploaded resource lacking a recent Clam AV verdict for scanning
+
+    Submissions are throttled to ``rate`` per second and paused while
+    ``max_in_flight`` tasks are still waiting for the scanner callback.
+    Progress is stored after every resource so an interrupted run can be
+    continued with ``resume=True``.
+
+    :returns: A dict with the keys "total", "submitted", "skipped",
+        "failed" and "last_id"
+    '''
+    if max_age is None:
+        max_age = toolkit.asint(
+            toolkit.config.get('ckanext.unhcr.clamav_rescan_max_age', 30))
+    if max_in_flight is None:
+        max_in_flight = toolkit.asint(
+            toolkit.config.get('ckanext.unhcr.clamav_max_in_flight', 10))
+    if rate is None:
+        rate = float(toolkit.config.get('ckanext.unhcr.clamav_submit_rate', 2))
+
+    after = get_scan_all_progress().get('last_id') if resume else None
+    resource_ids = utils.get_resource_ids_to_scan(
+        datetime.timedelta(days=max_age), after=after, limit=limit)
+    progress = {
+        'total': len(resource_ids),
+        'submitted': 0,
+        'skipped': 0,
+        'failed': 0,
+        'last_id': after,
+    }
+    log.info('Submitting {} resources to Clam AV'.format(progress['total']))
+
+    if not toolkit.config.get('ckanext.unhcr.clamav_url'):
+        log.error('ckanext.unhcr.clamav_url is not set, not submitting anything')
+        return progress
+
+    interval = 1.0 / rate if rate else 0
+    last_submitted = 0
+    for resource_id in resource_ids:
+
+        # Wait for the scanner to catch up
+        while utils.count_clamav_tasks_in_flight() >= max_in_flight:
+            time.sleep(SCAN_ALL_POLL_INTERVAL)
+
+        # Rate limit
+        wait = last_submitted + interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        last_submitted = time.time()
+
+        context = {'model': model, 'ignore_auth': True, 'job': True}
+        try:
+            if toolkit.get_action('scan_submit')(context, {'id': resource_id}):
+                progress['submitted'] += 1
+            else:
+                progress['skipped'] += 1
+        except toolkit.ValidationError as error:
+            log.warning('Could not submit resource {} to Clam AV: {}'.format(
+                resource_id, error.error_dict))
+            progress['failed'] += 1
+
+        progress['last_id'] = resource_id
+        _save_scan_all_progress(progress)
+
+    # A completed run starts from scratch next time
+    _save_scan_all_progress(dict(progress, last_id=None))
+    log.info('Clam AV submission finished: {}'.format(progress))
+
+    return progress
+
+
+def sweep_stale_clamav_tasks(max_in_flight=None):
+    '''
+    Resubmit or fail the Clam AV tasks stuck in "submitting" or "pending"
+
+    Tasks whose resource is still active are resubmitted (as long as the
+    number of tasks waiting for a verdict stays under ``max_in_flight``,
+    the rest are left for the next sweep). Tasks for deleted resources, or
+    all of them if the Clam AV service is not configured, are failed with
+    a single UPDATE.
+
+    :returns: A dict with the keys "stale", "resubmitted", "failed",
+        "deferred" and "in_flight"
+    '''
+    if max_in_flight is None:
+        max_in_flight = toolkit.asint(
+            toolkit.config.get('ckanext.unhcr.clamav_max_in_flight', 10))
+    can_resubmit = bool(toolkit.config.get('ckanext.unhcr.clamav_url'))
+
+    tasks = utils.get_stale_clamav_tasks()
+    counts = {
+        'stale': len(tasks),
+        'resubmitted': 0,
+        'failed': 0,
+        'deferred': 0,
+    }
+
+    to_fail = []
+    for task in tasks:
+        if not can_resubmit or task.resource_state != 'active':
+            to_fail.append(task.id)
+            continue
+        if utils.count_clamav_tasks_in_flight() >= max_in_flight:
+            counts['deferred'] += 1
+            continue
+        context = {'model': model, 'ignore_auth': True, 'job': True}
+        try:
+            if toolkit.get_action('scan_submit')(context, {'id': task.entity_id}):
+                counts['resubmitted'] += 1
+            else:
+                to_fail.append(task.id)
+        except toolkit.ValidationError:
+            # scan_submit has already failed the task
+            counts['failed'] += 1
+
+    counts['failed'] += utils.fail_clamav_tasks(
+        to_fail, {'message': 'Task went stale before the scan was completed.'})
+    counts['in_flight'] = utils.count_clamav_tasks_in_flight()
+    log.info('Clam AV stale task sweep finished: {}'.format(counts))
+
+    return counts
+
+
+def expire_external_users(today=None):
+    '''
+    Deactivate the external users whose account expired before `today`
+    (default: the current date) and let them know by email
+
+    The deactivation date is kept as "expired" in the user's plugin_extras
+    so sysadmins can tell expired accounts apart and reactivate them (see
+    `external_user_update_state`). Like `user_delete`, their container
+    memberships and dataset collaborations are removed.
+
+    Returns the number of deactivated users.
+    '''
+    today = today or datetime.date.today()
+    user_table = model.User.__table__
+    statement = (user_table.update()
+        .where(user_table.c.state == model.State.ACTIVE)
+        .where(text(
+            "((plugin_extras -> 'unhcr') ->> 'expiry_date') < :today"
+        ).bindparams(today=today.isoformat()))
+        .where(not_(utils.internal_users_filter()))
+        .values(
+            state=model.State.DELETED,
+            plugin_extras=text(
+                "jsonb_set(plugin_extras, '{unhcr,expired}', to_jsonb(CAST(:expired AS text)))"
+            ).bindparams(expired=today.isoformat()))
+        .returning(user_table.c.id, user_table.c.name, user_table.c.fullname, user_table.c.email))
+    users = model.Session.execute(statement).fetchall()
+    if not users:
+        model.Session.commit()
+        return 0
+
+    user_ids = [user.id for user in users]
+    (model.Session.query(model.Member)
+        .filter(model.Member.table_name == 'user')
+        .filter(model.Member.table_id.in_(user_ids))
+        .filter(model.Member.state == model.State.ACTIVE)
+        .update({'state': model.State.DELETED}, synchronize_session=False))
+    (model.Session.query(DatasetMember)
+        .filter(DatasetMember.user_id.in_(user_ids))
+        .delete(synchronize_session=False))
+    model.Session.commit()
+
+    # Notify the users
+    subj = mailer.compose_account_expired_email_subj()
+    mailer.queue_mails([{
+        'recipient_name': user.fullname or user.name,
+        'recipient_email': user.email,
+        'subject': subj,
+        'body': mailer.compose_account_expired_email_body(
+            {'name': user.name, 'fullname': user.fullname}),
+        'headers': {'Content-Type': 'text/html; charset=UTF-8'},
+    } for user in users if user.email])
+
+    # Their pending requests counts and autocomplete results are cached
+    helpers.invalidate_pending_requests_total()
+    cache.invalidate('user_autocomplete')
+
+    log.info('{} expired external users deactivated'.format(len(users)))
+    return len(users)
+
+
+def publish_microdata_resources(dataset_id, idno):
+    context = {'model': model, 'ignore_auth': True, 'job': True}
+    api_key = toolkit.config.get('ckanext.unhcr.microdata_api_key')
+    dataset = toolkit.get_action('package_show')(context, {'id': dataset_id})
+
+    results = microdata.publish_resources(dataset, idno, api_key)
+    failed = [result['resource_id'] for result in results if result['state'] == 'error']
+    log.info('Published {} of {} resources of dataset {} to Microdata'.format(
+        len(results) - len(failed), len(results), dataset_id))
+    if failed:
+        log.error('Microdata upload failed for resources: {}'.format(', '.join(failed)))
+
+    return results
+
+
+def get_scan_all_progress():
+    '''
+    Return the progress stored by the last run of
+    :py:func:`scan_all_resources` (empty if there wasn't any)
+    '''
+    try:
+        task = toolkit.get_action('task_status_show')({'ignore_auth': True}, {
+            'entity_id': 'scan_all',
+            'task_type': 'clamav_scan_all',
+            'key': 'progress',
+        })
+        return json.loads(task['value'])
+    except (toolkit.ObjectNotFound, ValueError):
+        return {}
+
+
 # Internal
 
+def _save_scan_all_progress(progress):
+    toolkit.get_action('task_status_update')({'ignore_auth': True}, {
+        'entity_id': 'scan_all',
+        'entity_type': 'site',
+        'task_type': 'clamav_scan_all',
+        'key': 'progress',
+        'value': json.dumps(progress),
+        'state': 'complete' if progress['last_id'] is None else 'running',
+        'last_updated': str(datetime.datetime.utcnow()),
+        'error': 'null',
+    })
+
+
 def _process_dataset_fields(package_id):
 
     # Get package
@@ -1,21 +1,45 @@
 from datetime import datetime, timedelta
+from email import utils as email_utils
+from email.header import Header
+from email.mime.text import MIMEText
 import itertools
 import logging
+import multiprocessing
+import smtplib
+import socket
+import time
+import ckan
 from ckan import model
 from ckan.plugins import toolkit
 from ckan.lib import mailer as core_mailer
 from ckan.lib.base import render_jinja2
+from ckan.lib.plugins import get_permission_labels
 from ckan.lib.dictization import model_dictize
-from ckanext.unhcr import helpers
+from sqlalchemy import func
+from ckanext.unhcr import helpers, hierarchy
+from ckanext.unhcr.models import MailOutbox
 log = logging.getLogger(__name__)
 
+MAIL_BATCH_SIZE = 50
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_BACKOFF = 60  # seconds, doubled on every attempt
+SMTP_TIMEOUT = 30  # seconds
+
 
 # General
 
+# Emails are not sent within the web request: they are stored in the
+# mail_outbox table and delivered by `paster unhcr send-mail`
+# (see send_queued_mail) so a slow or unavailable mail server
+# doesn't affect the users.
+
 def mail_user(user, subj, body, headers={}):
     try:
+        if not user.email:
+            raise core_mailer.MailerException('No recipient email address available!')
+        headers = dict(headers)
         headers.setdefault('Content-Type', 'text/html; charset=UTF-8')
-        core_mailer.mail_user(user, subj, body, headers=headers)
+        queue_mail(user.display_name, user.email, subj, body, headers=headers)
     except Exception as exception:
         log.exception(exception)
 
@@ -25,6 +49,126 @@ def mail_user_by_id(user_id, subj, body, headers={}):
     return mail_user(user, subj, body, headers=headers)
 
 
+def queue_mail(recipient_name, recipient_email, subj, body, headers=None):
+    '''
+    Add an email to the outbox
+
+    The email is stored in its own transaction so it doesn't depend on
+    (or commit) the current session.
+    '''
+    with model.meta.engine.begin() as connection:
+        connection.execute(MailOutbox.__table__.insert().values(
+            recipient_name=recipient_name,
+            recipient_email=recipient_email,
+            subject=subj,
+            body=body,
+            headers=headers or {},
+        ))
+
+
+def queue_mails(messages):
+    '''
+    Add many emails to the outbox in one transaction
+
+    :param messages: objects with the "recipient_name", "recipient_email",
+        "subject", "body" and "headers" of every email
+    :type messages: list of dicts
+    '''
+    if not messages:
+        return
+    with model.meta.engine.begin() as connection:
+        connection.execute(MailOutbox.__table__.insert(), messages)
+
+
+def send_queued_mail(batch_size=MAIL_BATCH_SIZE):
+    '''
+    Send a batch of the pending emails which are due, reusing a single
+    SMTP connection
+
+    Failed emails are retried with an exponential backoff and marked
+    as failed after MAIL_MAX_ATTEMPTS attempts. The batch is locked
+    with SKIP LOCKED so several senders can run at the same time.
+
+    :returns: A dict with the number of emails "sent", "retried"
+        and "failed"
+    :rtype: dict
+    '''
+    now = datetime.utcnow()
+    messages = (model.Session
+        .query(MailOutbox)
+        .filter(MailOutbox.status == 'pending')
+        .filter(MailOutbox.next_attempt <= now)
+        .order_by(MailOutbox.next_attempt, MailOutbox.created)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all())
+
+    counts = {'sent': 0, 'retried': 0, 'failed': 0}
+    connection = None
+    try:
+        for message in messages:
+            try:
+                if connection is None:
+                    connection = _get_smtp_connection()
+                connection.sendmail(
+                    toolkit.config.get('smtp.mail_from'),
+                    [message.recipient_email],
+                    _compose_mime_message(message).as_string())
+            except Exception as exception:
+                # Any error is recorded so a broken email can't block the queue
+                log.warning('Email to {} failed: {}'.format(message.recipient_email, exception))
+                _set_mail_error(message, exception)
+                if message.status == 'failed':
+                    counts['failed'] += 1
+                else:
+                    counts['retried'] += 1
+                # Recipient errors leave the connection usable
+                if not isinstance(exception, (smtplib.SMTPRecipientsRefused,
+                        smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+                    connection = _close_smtp_connection(connection)
+                continue
+            message.status = 'sent'
+            message.sent = datetime.utcnow()
+            message.attempts += 1
+            message.last_error = None
+            counts['sent'] += 1
+    finally:
+        _close_smtp_connection(connection)
+        model.Session.commit()
+
+    return counts
+
+
+def get_mail_queue_status():
+    '''
+    Return the number of emails in the outbox by status and the creation
+    date of the oldest pending one
+    '''
+    status = {'pending': 0, 'sent': 0, 'failed': 0, 'oldest_pending': None}
+    query = (model.Session
+        .query(MailOutbox.status, func.count(MailOutbox.id), func.min(MailOutbox.created))
+        .group_by(MailOutbox.status))
+    for state, count, oldest in query:
+        status[state] = count
+        if state == 'pending':
+            status['oldest_pending'] = oldest.isoformat()
+    return status
+
+
+def purge_sent_mail(max_age):
+    '''
+    Delete the emails sent more than ``max_age`` (a timedelta) ago
+    '''
+    cutoff = datetime.utcnow() - max_age
+    count = (model.Session
+        .query(MailOutbox)
+        .filter(MailOutbox.status == 'sent')
+        .filter(MailOutbox.sent < cutoff)
+        .delete(synchronize_session=False))
+    model.Session.commit()
+    return count
+
+
 # Data Container
 
 def compose_container_email_subj(container, event):
@@ -94,120 +238,101 @@ def compose_membership_email_body(container, user_dict, event):
     return render_jinja2('emails/membership/%s.html' % event, context)
 
 
+# Collaborators
+
+def compose_collaborator_email_subj(dataset):
+    return '[UNHCR RIDL] Collaborator: %s' % dataset.get('title')
+
+
+def compose_collaborator_email_body(dataset, user_dict, role):
+    context = {}
+    context['recipient'] = user_dict.get('fullname') or user_dict.get('name')
+    context['site_title'] = toolkit.config.get('ckan.site_title')
+    context['site_url'] = toolkit.config.get('ckan.site_url')
+    context['dataset'] = dataset
+    context['dataset_url'] = toolkit.url_for('dataset_read', id=dataset['name'], qualified=True)
+    context['role'] = role
+    return render_jinja2('emails/collaborator/create.html', context)
+
+
 # Weekly Summary
 
-def _get_new_packages(context, start_time):
-    data_dict = {
-        'q': '*:*',
-        'fq': (
-            '-type:deposited-dataset AND ' +\
-            'metadata_created:[{} TO NOW]'.format(start_time)
-        ),
-        'sort': 'metadata_created desc',
-        'include_private': True,
-    }
-    query = toolkit.get_action('package_search')(context, data_dict)
-    packages = query['results']
-
-    for package in packages:
-        group = model.Group.get(package['organization']['id'])
-        parents = group.get_parent_group_hierarchy(type='data-container')
-        if not parents:
-            root_parent = group
-        else:
-            root_parent = parents[0]
-        package['root_parent'] = root_parent
+SUMMARY_EMAIL_ROWS = 10  # datasets listed per section
+SUMMARY_SEARCH_ROWS = 1000
 
-    packages = sorted(packages, key=lambda x: x['root_parent'].id)
-    grouped_packages = itertools.groupby(packages, lambda x: x['root_parent'])
 
-    return [
-        {"container": container, "datasets": list(packages)}
-        for container, packages in grouped_packages
-    ]
+def get_summary_email_data(start_time=None):
+    '''
+    Run the searches of the summary email once for all the recipients
 
+    The datasets are searched without permission labels, and the labels
+    of every dataset are kept so each recipient's view can be filtered
+    in memory (see :py:func:`compose_summary_email_body`).
+    '''
+    start_time = start_time or datetime.now() - timedelta(days=7)
+    query_start_time = start_time.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-def _get_new_deposits(context, start_time):
-    data_dict = {
-        'q': '*:*',
-        'fq': (
+    data = {
+        'start_time': start_time,
+        'query_start_time': query_start_time,
+        'new_datasets': _search_summary_datasets(
+            '-type:deposited-dataset AND ' +\
+            'metadata_created:[{} TO NOW]'.format(query_start_time)
+        ),
+        'new_deposits': _search_summary_datasets(
             'type:deposited-dataset AND ' +\
             '-curation_state:review AND ' +\
-            'metadata_created:[{} TO NOW]'.format(start_time)
+            'metadata_created:[{} TO NOW]'.format(query_start_time)
         ),
-        'sort': 'metadata_created desc',
-        'include_private': True,
-    }
-    packages = toolkit.get_action('package_search')(context, data_dict)
-    return packages['results']
-
-
-def _get_deposits_awaiting_review(context, start_time):
-    data_dict = {
-        'q': '*:*',
-        'fq': (
+        'awaiting_review': _search_summary_datasets(
             'type:deposited-dataset AND ' +\
             'curation_state:review AND ' +\
-            'metadata_created:[{} TO NOW]'.format(start_time)
+            'metadata_created:[{} TO NOW]'.format(query_start_time)
         ),
-        'sort': 'metadata_created desc',
-        'include_private': True,
     }
-    packages = toolkit.get_action('package_search')(context, data_dict)
-    return packages['results']
 
+    for package in data['new_datasets']:
+        package['root_parent'] = (
+            hierarchy.get_root(package['owner_org']) or package['organization'])
 
-def compose_summary_email_body(user_dict):
-    context = {}
+    data['labels'] = _get_summary_dataset_labels(
+        data['new_datasets'] + data['new_deposits'] + data['awaiting_review'])
 
-    start_time = datetime.now() - timedelta(days=7)
-    context['start_date'] = start_time.strftime('%A %B %e %Y')
-    query_start_time = start_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return data
 
-    context['recipient'] = user_dict.get('fullname') or user_dict.get('name')
-    context['site_title'] = toolkit.config.get('ckan.site_title')
-    context['site_url'] = toolkit.config.get('ckan.site_url')
 
-    context['datasets_url'] = toolkit.url_for(
-        'search',
-        q=(
-            '-type:deposited-dataset AND ' +\
-            'metadata_created:[{} TO NOW]'.format(query_start_time)
-        ),
-        sort='metadata_created desc',
-        qualified=True
-    )
-    context['deposits_url'] = toolkit.url_for(
-        'search',
-        q=(
-            'type:deposited-dataset AND ' +\
-            'metadata_created:[{} TO NOW]'.format(query_start_time)
-        ),
-        sort='metadata_created desc',
-        qualified=True
-    )
+def compose_summary_email_body(user_dict, data=None):
+    '''
+    Return the summary email of a user as a dict with the keys
+    "total_events" and "body"
 
-    action_context = { 'user': user_dict['name'] }
-    context['new_datasets'] = _get_new_packages(action_context, query_start_time)
-    context['new_datasets_total'] = sum([len(n['datasets']) for n in context['new_datasets']])
-    context['new_deposits'] = _get_new_deposits(action_context, query_start_time)
-    context['new_deposits_total'] = len(context['new_deposits'])
-    context['awaiting_review'] = _get_deposits_awaiting_review(
-        action_context,
-        query_start_time
-    )
-    context['awaiting_review_total'] = len(context['awaiting_review'])
+    Pass the result of :py:func:`get_summary_email_data` as `data` to
+    reuse the same searches for all the recipients.
+    '''
+    return _render_summary_email(_get_summary_email_context(user_dict, data))
 
-    context['h'] = toolkit.h
 
-    return {
-        'total_events': (
-            context['new_datasets_total'] +\
-            context['new_deposits_total'] +\
-            context['awaiting_review_total']
-        ),
-        'body': render_jinja2('emails/curation/summary.html', context)
-    }
+def compose_summary_emails(recipients, data=None):
+    '''
+    Return the summary emails (see :py:func:`compose_summary_email_body`)
+    of all the recipients, in the same order
+
+    Emails are rendered by a pool of
+    ``ckanext.unhcr.summary_email_processes`` processes (default 4).
+    '''
+    data = data or get_summary_email_data()
+    contexts = [_get_summary_email_context(recipient, data) for recipient in recipients]
+    processes = toolkit.asint(toolkit.config.get('ckanext.unhcr.summary_email_processes', 4))
+    if processes <= 1 or len(contexts) <= 1:
+        return [_render_summary_email(context) for context in contexts]
+
+    # The database is only used above, so it's safe to fork here
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_render_summary_email, contexts)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def get_summary_email_recipients():
@@ -344,6 +469,19 @@ def compose_account_approved_email_body(recipient):
     return render_jinja2('emails/user/account_approved.html', context)
 
 
+def compose_account_expired_email_subj():
+    return '[UNHCR RIDL] - User account expired'
+
+
+def compose_account_expired_email_body(recipient):
+    context = {}
+    context['recipient'] = recipient
+    context['site_url'] = toolkit.config.get('ckan.site_url')
+    context['h'] = toolkit.h
+
+    return render_jinja2('emails/user/account_expired.html', context)
+
+
 # Clam AV Scan
 
 def get_infected_file_email_recipients():
@@ -370,3 +508,174 @@ def compose_infected_file_email_body(recipient, resource_name, package_id, resou
     context['h'] = toolkit.h
 
     return render_jinja2('emails/resource/infected_file.html', context)
+
+
+# Internal
+
+def _get_smtp_connection():
+    # Same settings as ckan.lib.mailer
+    config = toolkit.config
+    if config.get('smtp.test_server'):
+        smtp_server = config['smtp.test_server']
+        smtp_starttls = False
+        smtp_user = None
+        smtp_password = None
+    else:
+        smtp_server = config.get('smtp.server', 'localhost')
+        smtp_starttls = toolkit.asbool(config.get('smtp.starttls'))
+        smtp_user = config.get('smtp.user')
+        smtp_password = config.get('smtp.password')
+
+    connection = smtplib.SMTP(timeout=SMTP_TIMEOUT)
+    connection.connect(smtp_server)
+    connection.ehlo()
+    if smtp_starttls:
+        if not connection.has_extn('STARTTLS'):
+            connection.close()
+            raise core_mailer.MailerException('SMTP server does not support STARTTLS')
+        connection.starttls()
+        connection.ehlo()
+    if smtp_user:
+        assert smtp_password, ('If smtp.user is configured then '
+            'smtp.password must be configured as well.')
+        connection.login(smtp_user, smtp_password)
+    return connection
+
+
+def _close_smtp_connection(connection):
+    if connection is not None:
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
+    return None
+
+
+def _compose_mime_message(message):
+    # Same message as ckan.lib.mailer._mail_recipient
+    mail_from = toolkit.config.get('smtp.mail_from')
+    reply_to = toolkit.config.get('smtp.reply_to')
+    msg = MIMEText(message.body.encode('utf-8'), 'plain', 'utf-8')
+    for key, value in (message.headers or {}).items():
+        if key in msg.keys():
+            msg.replace_header(key, value)
+        else:
+            msg.add_header(key, value)
+    msg['Subject'] = Header(message.subject.encode('utf-8'), 'utf-8')
+    msg['From'] = '%s <%s>' % (toolkit.config.get('ckan.site_title'), mail_from)
+    msg['To'] = Header(u'%s <%s>' % (message.recipient_name, message.recipient_email), 'utf-8')
+    msg['Date'] = email_utils.formatdate(time.time())
+    msg['X-Mailer'] = 'CKAN %s' % ckan.__version__
+    if reply_to:
+        msg['Reply-to'] = reply_to
+    return msg
+
+
+def _set_mail_error(message, exception):
+    message.attempts += 1
+    message.last_error = str(exception)
+    if message.attempts >= MAIL_MAX_ATTEMPTS:
+        message.status = 'failed'
+    else:
+        backoff = MAIL_RETRY_BACKOFF * 2 ** (message.attempts - 1)
+        message.next_attempt = datetime.utcnow() + timedelta(seconds=backoff)
+
+
+def _search_summary_datasets(fq):
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True})
+    context = {'ignore_auth': True, 'user': site_user['name']}
+    data_dict = {
+        'q': '*:*',
+        'fq': fq,
+        'sort': 'metadata_created desc',
+        'include_private': True,
+        'rows': SUMMARY_SEARCH_ROWS,
+        'start': 0,
+    }
+
+    # Page through all the results, the recipients' filters run afterwards
+    packages = []
+    while True:
+        result = toolkit.get_action('package_search')(dict(context), dict(data_dict))
+        packages.extend(result['results'])
+        data_dict['start'] += SUMMARY_SEARCH_ROWS
+        if not result['results'] or data_dict['start'] >= result['count']:
+            return packages
+
+
+def _get_summary_dataset_labels(packages):
+    labels = {}
+    permission_labels = get_permission_labels()
+    ids = list(set(package['id'] for package in packages))
+    if ids:
+        for dataset_obj in model.Session.query(model.Package).filter(model.Package.id.in_(ids)):
+            labels[dataset_obj.id] = set(permission_labels.get_dataset_labels(dataset_obj))
+    return labels
+
+
+def _get_summary_email_context(user_dict, data=None):
+    data = data or get_summary_email_data()
+    query_start_time = data['query_start_time']
+
+    # Same visibility as a package_search run by the user
+    user_obj = model.User.get(user_dict['id'])
+    if user_obj.sysadmin:
+        visible = lambda packages: packages[:SUMMARY_EMAIL_ROWS]
+    else:
+        user_labels = set(get_permission_labels().get_user_dataset_labels(user_obj))
+        visible = lambda packages: [
+            package for package in packages
+            if data['labels'].get(package['id'], set()) & user_labels
+        ][:SUMMARY_EMAIL_ROWS]
+
+    context = {}
+    context['start_date'] = data['start_time'].strftime('%A %B %e %Y')
+    context['recipient'] = user_dict.get('fullname') or user_dict.get('name')
+    context['site_title'] = toolkit.config.get('ckan.site_title')
+    context['site_url'] = toolkit.config.get('ckan.site_url')
+
+    context['datasets_url'] = toolkit.url_for(
+        'search',
+        q=(
+            '-type:deposited-dataset AND ' +\
+            'metadata_created:[{} TO NOW]'.format(query_start_time)
+        ),
+        sort='metadata_created desc',
+        qualified=True
+    )
+    context['deposits_url'] = toolkit.url_for(
+        'search',
+        q=(
+            'type:deposited-dataset AND ' +\
+            'metadata_created:[{} TO NOW]'.format(query_start_time)
+        ),
+        sort='metadata_created desc',
+        qualified=True
+    )
+
+    packages = sorted(visible(data['new_datasets']), key=lambda x: x['root_parent']['id'])
+    grouped_packages = itertools.groupby(packages, lambda x: x['root_parent']['id'])
+    context['new_datasets'] = []
+    for root_id, root_packages in grouped_packages:
+        root_packages = list(root_packages)
+        context['new_datasets'].append(
+            {"container": root_packages[0]['root_parent'], "datasets": root_packages})
+    context['new_datasets_total'] = sum([len(n['datasets']) for n in context['new_datasets']])
+    context['new_deposits'] = visible(data['new_deposits'])
+    context['new_deposits_total'] = len(context['new_deposits'])
+    context['awaiting_review'] = visible(data['awaiting_review'])
+    context['awaiting_review_total'] = len(context['awaiting_review'])
+
+    return context
+
+
+def _render_summary_email(context):
+    context = dict(context, h=toolkit.h)
+    return {
+        'total_events': (
+            context['new_datasets_total'] +\
+            context['new_deposits_total'] +\
+            context['awaiting_review_total']
+        ),
+        'body': render_jinja2('emails/curation/summary.html', context)
+    }
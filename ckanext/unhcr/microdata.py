@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckanext.unhcr import helpers
+log = logging.getLogger(__name__)
+
+
+MICRODATA_URL = 'https://microdata.unhcr.org/index.php'
+DEFAULT_ERROR = 'Unknown microdata error'
+TIMEOUT = (10, 600)  # connect, read (seconds)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 2  # seconds, doubled on every attempt
+
+
+# General
+
+def get_base_url():
+    return toolkit.config.get('ckanext.unhcr.microdata_url', MICRODATA_URL).rstrip('/')
+
+
+def get_concurrency():
+    return toolkit.asint(toolkit.config.get('ckanext.unhcr.microdata_concurrency', 4))
+
+
+_session = None
+def get_session():
+    '''
+    Return a requests session shared by all the Microdata API calls
+    so connections are pooled and reused
+    '''
+    global _session
+    if _session is None:
+        size = get_concurrency()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
+    return _session
+
+
+def create_survey(survey, api_key):
+    '''
+    Create the Microdata survey and return its catalog url
+    '''
+    idno = survey['study_desc']['title_statement']['idno']
+    url = '%s/api/datasets/create/survey/%s' % (get_base_url(), idno)
+    response, attempts = _post(url, api_key, payload=survey, idempotent=False)
+    response = response.json()
+    if response.get('status') != 'success':
+        raise RuntimeError(str(response.get('errors', DEFAULT_ERROR)))
+    return '%s/catalog/%s' % (get_base_url(), response['dataset']['id'])
+
+
+# Collections
+
+_collections_cache = {}
+_collections_lock = threading.Lock()
+def get_collections(api_key):
+    '''
+    Return the list of Microdata collections
+
+    The list is cached for `ckanext.unhcr.microdata_collections_ttl` seconds.
+    Once expired the cached list is still returned while a fresh one is
+    requested in the background, so only the very first call waits for
+    the Microdata API. If the refresh fails the stale list is kept for
+    another period before trying again.
+    '''
+    with _collections_lock:
+        cached = _collections_cache.get(api_key)
+        if cached and time.time() - cached['fetched'] > get_collections_ttl():
+            if not (cached['refresh'] and cached['refresh'].is_alive()):
+                cached['refresh'] = threading.Thread(
+                    target=_refresh_collections, args=(api_key,))
+                cached['refresh'].daemon = True
+                cached['refresh'].start()
+    if cached is None:
+        return _refresh_collections(api_key)
+    return cached['collections']
+
+
+def get_collections_ttl():
+    return toolkit.asint(toolkit.config.get('ckanext.unhcr.microdata_collections_ttl', 3600))
+
+
+def clear_collections_cache():
+    with _collections_lock:
+        _collections_cache.clear()
+
+
+# Resources
+
+def publish_resources(dataset, idno, api_key):
+    '''
+    Upload all the resources (metadata and file) of a dataset to an
+    existing Microdata survey
+
+    Resources are uploaded concurrently, files are streamed from disk
+    and every request is retried on connection errors and server errors.
+    The outcome of every resource is recorded as a task status
+    (see :py:func:`get_publish_status`).
+
+    :returns: A list of dicts with the keys "resource_id", "state",
+        "attempts" and "error"
+    :rtype: list
+    '''
+    items = _get_publish_items(dataset, idno, api_key)
+    results = []
+    pool = ThreadPool(get_concurrency())
+    try:
+        for result in pool.imap_unordered(_publish_resource, items):
+            _save_publish_task(result)
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def init_publish_status(dataset, idno):
+    for resource in dataset.get('resources', []):
+        _save_publish_task({
+            'resource_id': resource['id'],
+            'idno': idno,
+            'state': 'pending',
+            'attempts': 0,
+        })
+
+
+def get_publish_status(dataset):
+    '''
+    Return the status of the latest Microdata upload of every resource
+    of the dataset
+    '''
+    resource_ids = [resource['id'] for resource in dataset.get('resources', [])]
+    if not resource_ids:
+        return []
+    tasks = (model.Session
+        .query(model.TaskStatus)
+        .filter(model.TaskStatus.entity_id.in_(resource_ids))
+        .filter(model.TaskStatus.task_type == 'microdata')
+        .filter(model.TaskStatus.key == 'publish')
+        .all())
+    status = []
+    for task in tasks:
+        value = json.loads(task.value or '{}')
+        status.append({
+            'resource_id': task.entity_id,
+            'state': task.state,
+            'last_updated': task.last_updated.isoformat() if task.last_updated else None,
+            'file_name': value.get('file_name'),
+            'attempts': value.get('attempts', 0),
+            'error': json.loads(task.error or 'null'),
+        })
+    return status
+
+
+class MultipartFileStream(object):
+    '''
+    A multipart/form-data body with a single file field
+
+    The file is read from disk in chunks while the request is being sent,
+    so it is never loaded in memory as a whole. The total length is known
+    in advance so the request is sent with a Content-Length header.
+    '''
+
+    def __init__(self, field_name, file_name, file_path, file_mime=None):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        head = (
+            u'--{boundary}\r\n'
+            u'Content-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+            u'Content-Type: {file_mime}\r\n\r\n'
+        ).format(
+            boundary=boundary,
+            field_name=field_name,
+            file_name=file_name.replace('"', '\\"'),
+            file_mime=file_mime or 'application/octet-stream',
+        ).encode('utf-8')
+        tail = (u'\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self._length = len(head) + os.path.getsize(file_path) + len(tail)
+        self._parts = [io.BytesIO(head), open(file_path, 'rb'), io.BytesIO(tail)]
+
+    def __len__(self):
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        chunks = []
+        while size > 0 and self._parts:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        while self._parts:
+            self._parts.pop(0).close()
+
+
+# Internal
+
+def _fetch_collections(api_key):
+    url = '%s/api/collections' % get_base_url()
+    response = get_session().get(url, headers={'X-Api-Key': api_key}, timeout=TIMEOUT).json()
+    if response.get('status') != 'success':
+        raise RuntimeError(str(response.get('errors', DEFAULT_ERROR)))
+    return response['collections']
+
+
+def _refresh_collections(api_key):
+    try:
+        collections = _fetch_collections(api_key)
+    except (RuntimeError, ValueError, requests.exceptions.RequestException) as exception:
+        with _collections_lock:
+            cached = _collections_cache.get(api_key)
+        # Keep serving the stale list if there is one
+        if cached is None:
+            raise
+        log.warning('Microdata collections refresh failed: {}'.format(exception))
+        # Don't retry before the next period
+        with _collections_lock:
+            cached['fetched'] = time.time()
+        return cached['collections']
+    with _collections_lock:
+        _collections_cache[api_key] = {
+            'collections': collections,
+            'fetched': time.time(),
+            'refresh': None,
+        }
+    return collections
+
+
+def _get_publish_items(dataset, idno, api_key):
+    items = []
+    file_name_counter = {}
+    for resource in dataset.get('resources', []):
+        item = {
+            'resource_id': resource['id'],
+            'idno': idno,
+            'api_key': api_key,
+            'md_resource': helpers.convert_resource_to_microdata_resource(resource),
+            'file_name': resource['url'].split('/')[-1],
+            'file_path': helpers.get_resource_file_path(resource),
+            'file_mime': resource.get('mimetype'),
+        }
+        if item['file_name'] and item['file_path']:
+            file_name = item['file_name']
+            file_name_counter.setdefault(file_name, 0)
+            file_name_counter[file_name] += 1
+            if file_name_counter[file_name] > 1:
+                item['file_name'] = helpers.add_file_name_suffix(
+                    file_name, file_name_counter[file_name] - 1)
+        else:
+            item['file_path'] = None
+        items.append(item)
+    return items
+
+
+def _publish_resource(item):
+    # This runs in a worker thread so it must not touch the database
+    url = '%s/api/datasets/%s/%%s' % (get_base_url(), item['idno'])
+    result = {
+        'resource_id': item['resource_id'],
+        'idno': item['idno'],
+        'file_name': item['file_name'],
+        'attempts': 0,
+    }
+    try:
+
+        # resource
+        response, attempts = _post(
+            url % 'resources', item['api_key'], payload=item['md_resource'], idempotent=False)
+        result['attempts'] += attempts
+        response = response.json()
+        if response.get('status') != 'success':
+            raise RuntimeError(str(response.get('errors', DEFAULT_ERROR)))
+
+        # file
+        if item['file_path']:
+            upload = (item['file_name'], item['file_path'], item['file_mime'])
+            response, attempts = _post(
+                url % 'files', item['api_key'], upload=upload, idempotent=False)
+            result['attempts'] += attempts
+            try:
+                response = response.json()
+            except ValueError:
+                if response.status_code >= 500:
+                    raise RuntimeError('Server error ({})'.format(response.status_code))
+                # Microdata answers the unsupported file types
+                # without a JSON body, these files are skipped
+                log.warning('Microdata skipped the file of resource {}'.format(
+                    item['resource_id']))
+                response = None
+            if isinstance(response, dict) and response.get('status') != 'success':
+                raise RuntimeError(str(response.get('errors', DEFAULT_ERROR)))
+
+        result['state'] = 'complete'
+
+    except (RuntimeError, ValueError, IOError, OSError, requests.exceptions.RequestException) as exception:
+        log.warning('Microdata upload of resource {} failed: {}'.format(
+            item['resource_id'], exception))
+        result['state'] = 'error'
+        result['error'] = str(exception)
+
+    return result
+
+
+def _post(url, api_key, payload=None, upload=None, idempotent=True):
+    '''
+    POST to the Microdata API retrying on connection errors and server errors
+
+    Requests creating a new object (`idempotent=False`) are only retried
+    when the connection failed, as after a timeout or a server error the
+    object may have been created anyway.
+
+    :returns: The response and the number of attempts it took
+    '''
+    attempts = 0
+    while True:
+        attempts += 1
+        headers = {'X-Api-Key': api_key}
+        try:
+            if upload:
+                with MultipartFileStream('file', *upload) as body:
+                    headers['Content-Type'] = body.content_type
+                    response = get_session().post(
+                        url, headers=headers, data=body, timeout=TIMEOUT)
+            else:
+                response = get_session().post(
+                    url, headers=headers, json=payload, timeout=TIMEOUT)
+            if response.status_code < 500 or not idempotent or attempts > MAX_RETRIES:
+                return response, attempts
+        except requests.exceptions.ConnectionError:
+            if attempts > MAX_RETRIES:
+                raise
+        except requests.exceptions.Timeout:
+            if not idempotent or attempts > MAX_RETRIES:
+                raise
+        time.sleep(RETRY_BACKOFF * 2 ** (attempts - 1))
+
+
+def _save_publish_task(result):
+    task = {
+        'entity_id': result['resource_id'],
+        'entity_type': 'resource',
+        'task_type': 'microdata',
+        'key': 'publish',
+        'state': result['state'],
+        'value': json.dumps({
+            'idno': result['idno'],
+            'file_name': result.get('file_name'),
+            'attempts': result['attempts'],
+        }),
+        'error': json.dumps(result.get('error')),
+        'last_updated': str(datetime.datetime.utcnow()),
+    }
+    toolkit.get_action('task_status_update')({'ignore_auth': True}, task)
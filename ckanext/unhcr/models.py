@@ -5,6 +5,7 @@ import logging
 
 from sqlalchemy import Column, DateTime, Integer
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.types import Enum, UnicodeText
@@ -53,6 +54,27 @@ class AccessRequest(Base):
     actioned_by = Column(UnicodeText, nullable=True)  # user who approved or rejected the request
 
 
+class MailOutbox(Base):
+    __tablename__ = u'mail_outbox'
+
+    id = Column(UnicodeText, primary_key=True, default=make_uuid)
+    created = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    recipient_name = Column(UnicodeText, nullable=True)
+    recipient_email = Column(UnicodeText, nullable=False)
+    subject = Column(UnicodeText, nullable=False)
+    body = Column(UnicodeText, nullable=False)
+    headers = Column(MutableDict.as_mutable(JSONB), nullable=True)
+    status = Column(
+        Enum('pending', 'sent', 'failed', name='mail_outbox_status_enum'),
+        default='pending',
+        nullable=False,
+    )
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    sent = Column(DateTime, nullable=True)
+    last_error = Column(UnicodeText, nullable=True)
+
+
 def create_metric_columns():
     cols = ['datasets_count', 'deposits_count', 'containers_count']
     table = TimeSeriesMetric.__tablename__
@@ -101,6 +123,92 @@ def add_access_request_actioned_by_column():
     )
     model.Session.commit()
 
+def create_task_status_clamav_index():
+    # Used to find stale and in-flight Clam AV tasks without scanning
+    # the whole task_status table
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_task_status_clamav_state "
+        u"ON task_status (state, last_updated) "
+        u"WHERE task_type = 'clamav';"
+    )
+    model.Session.commit()
+
+def create_access_request_indexes():
+    # Support the access request list/count queries: the status filter
+    # sorted by date, lookups by object and the default containers
+    # filter of user account requests
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_access_requests_status_timestamp "
+        u"ON access_requests (status, timestamp DESC, id DESC);"
+    )
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_access_requests_object "
+        u"ON access_requests (object_type, object_id, status);"
+    )
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_access_requests_default_containers "
+        u"ON access_requests USING GIN ((data -> 'default_containers'));"
+    )
+    model.Session.commit()
+
+def create_mail_outbox_index():
+    # The sender picks the due pending emails in order
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_mail_outbox_pending "
+        u"ON mail_outbox (next_attempt, created) "
+        u"WHERE status = 'pending';"
+    )
+    model.Session.commit()
+
+def create_user_email_domain_index():
+    # Internal/external users are told apart by their email domain,
+    # sysadmins being always internal (see utils.user_email_domain)
+    model.Session.execute(u"DROP INDEX IF EXISTS idx_user_email_domain;")
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_user_internal_domain "
+        u"ON \"user\" ((CASE WHEN sysadmin = true THEN '@sysadmin' "
+        u"ELSE lower(split_part(email, '@', 2)) END));"
+    )
+    model.Session.commit()
+
+def create_user_search_indexes():
+    # Trigram indexes for the user autocomplete "contains" search
+    # and text_pattern_ops indexes for its prefix fast path
+    try:
+        model.Session.execute(u"CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        model.Session.commit()
+    except DBAPIError as exception:
+        model.Session.rollback()
+        log.warning(u'pg_trgm extension not available: {}'.format(exception))
+    else:
+        model.Session.execute(
+            u"CREATE INDEX IF NOT EXISTS idx_user_name_trgm "
+            u"ON \"user\" USING GIN (name gin_trgm_ops);"
+        )
+        model.Session.execute(
+            u"CREATE INDEX IF NOT EXISTS idx_user_fullname_trgm "
+            u"ON \"user\" USING GIN (fullname gin_trgm_ops);"
+        )
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_user_name_prefix "
+        u"ON \"user\" (lower(name) text_pattern_ops);"
+    )
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_user_fullname_prefix "
+        u"ON \"user\" (lower(fullname) text_pattern_ops);"
+    )
+    model.Session.commit()
+
+def create_user_expiry_date_index():
+    # Expired external accounts are found by the expiry date
+    # kept in their plugin_extras (ISO dates compare as text)
+    model.Session.execute(
+        u"CREATE INDEX IF NOT EXISTS idx_user_unhcr_expiry_date "
+        u"ON \"user\" (((plugin_extras -> 'unhcr') ->> 'expiry_date')) "
+        u"WHERE state = 'active';"
+    )
+    model.Session.commit()
+
 def create_tables():
     if not TimeSeriesMetric.__table__.exists():
         TimeSeriesMetric.__table__.create()
@@ -116,3 +224,17 @@ def create_tables():
     add_access_request_data_column()
     add_access_request_actioned_by_column()
     extend_access_request_object_type_enum()
+    create_access_request_indexes()
+
+    create_task_status_clamav_index()
+
+
+    if not MailOutbox.__table__.exists():
+        MailOutbox.__table__.create()
+        log.info(u'MailOutbox database table created')
+
+    create_mail_outbox_index()
+
+    create_user_email_domain_index()
+    create_user_search_indexes()
+    create_user_expiry_date_index()
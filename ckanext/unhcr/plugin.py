@@ -18,17 +18,16 @@ from ckan.lib.activity_streams import (
     activity_stream_string_icons,
 )
 
-from ckanext.unhcr import actions, auth, blueprints, helpers, jobs, utils, validators
+from ckanext.unhcr import actions, auth, blueprints, helpers, hierarchy, jobs, utils, validators
 
 from ckanext.scheming.helpers import scheming_get_dataset_schema
-from ckanext.hierarchy.helpers import group_tree_section
 
 log = logging.getLogger(__name__)
 
 _ = toolkit._
 
 
-ALLOWED_ACTIONS = [
+ALLOWED_ACTIONS = frozenset([
     'datastore_create',
     'datastore_delete',
     'datastore_upsert',
@@ -63,7 +62,7 @@ ALLOWED_ACTIONS = [
     'user_show',
     'user_update',
     'user_generate_apikey',
-]
+])
 
 
 def restrict_external(func):
@@ -71,19 +70,53 @@ def restrict_external(func):
     Decorator function to restrict external users to a small number of allowed_actions
     '''
     def unhcr_auth_wrapper(action, context, data_dict=None):
-        user = User.by_name(context.get('user'))
+        if context.get('ignore_auth') or action in ALLOWED_ACTIONS:
+            return func(action, context, data_dict)
+        user = _get_auth_user(context)
         if not user:
             return func(action, context, data_dict)
         if user.sysadmin:
             return func(action, context, data_dict)
-        if context.get('ignore_auth'):
-            return func(action, context, data_dict)
-        if user.external and action not in ALLOWED_ACTIONS:
+        if user.external:
             return {'success': False, 'msg': 'Not allowed to perform this action'}
         return func(action, context, data_dict)
     return unhcr_auth_wrapper
 
 
+def share_permission_checks(func):
+    '''
+    Decorator function reusing the result of a permission check already
+    made within a :py:func:`utils.shared_permission_checks` block
+    '''
+    def unhcr_permission_wrapper(group_id, user_name, permission):
+        checks = utils.get_shared_permission_checks()
+        if checks is None:
+            return func(group_id, user_name, permission)
+        key = (group_id, user_name, permission)
+        if key not in checks:
+            checks[key] = func(group_id, user_name, permission)
+        return checks[key]
+    return unhcr_permission_wrapper
+
+
+def _get_auth_user(context):
+    # Prefer the user already loaded by check_access,
+    # then the users already loaded in this request
+    name = context.get('user')
+    if not name:
+        return None
+    user = context.get('auth_user_obj')
+    if user is not None and user.name == name:
+        return user
+    memo = utils.get_request_memo('auth_users')
+    if memo is not None and name in memo:
+        return memo[name]
+    user = User.by_name(name)
+    if memo is not None and user is not None:
+        memo[name] = user
+    return user
+
+
 _url_for = core_helpers.url_for
 
 def url_for(*args, **kw):
@@ -135,6 +168,9 @@ class UnhcrPlugin(
         User.external = property(utils.user_is_external)
         if (authz.is_authorized.__name__ != 'unhcr_auth_wrapper'):
             authz.is_authorized = restrict_external(authz.is_authorized)
+        if (authz.has_user_permission_for_group_or_org.__name__ != 'unhcr_permission_wrapper'):
+            authz.has_user_permission_for_group_or_org = share_permission_checks(
+                authz.has_user_permission_for_group_or_org)
         core_helpers.url_for = url_for
 
     def update_config_schema(self, schema):
@@ -310,6 +346,7 @@ class UnhcrPlugin(
             'normalize_list': helpers.normalize_list,
             'get_field_label': helpers.get_field_label,
             'can_download': helpers.can_download,
+            'check_access_many': helpers.check_access_many,
             'get_choice_label': helpers.get_choice_label,
             'get_ridl_version': helpers.get_ridl_version,
             'get_envname': helpers.get_envname,
@@ -381,27 +418,29 @@ class UnhcrPlugin(
                                         out.append(choice['label'])
                     pkg_dict['vocab_' + field] = out
 
+        # Index the data container and its ancestors so a container page
+        # can include the datasets of all its sub-containers with one filter
+
+        if pkg_dict.get('owner_org'):
+            pkg_dict['vocab_ancestor_containers'] = [pkg_dict['owner_org']] + [
+                ancestor['id'] for ancestor in hierarchy.get_ancestors(pkg_dict['owner_org'])
+            ]
+
         # Index additional data for deposited dataset
 
         if pkg_dict.get('type') == 'deposited-dataset':
             # curator
             curator_id = pkg_dict.get('curator_id')
             if curator_id:
-                try:
-                    curator = toolkit.get_action('user_show')(
-                        {'ignore_auth': True}, {'id': curator_id})
-                    pkg_dict['curator_display_name'] = curator.get('display_name')
-                except toolkit.ObjectNotFound:
-                    pass
+                curator = User.get(curator_id)
+                if curator:
+                    pkg_dict['curator_display_name'] = curator.display_name
             # depositor
             depositor_id = pkg_dict.get('creator_user_id')
             if depositor_id:
-                try:
-                    depositor = toolkit.get_action('user_show')(
-                        {'ignore_auth': True}, {'id': depositor_id})
-                    pkg_dict['depositor_display_name'] = depositor.get('display_name')
-                except toolkit.ObjectNotFound:
-                    pass
+                depositor = User.get(depositor_id)
+                if depositor:
+                    pkg_dict['depositor_display_name'] = depositor.display_name
             # data-container
             owner_org_dest_id = pkg_dict.get('owner_org_dest')
             if owner_org_dest_id:
@@ -433,29 +472,10 @@ class UnhcrPlugin(
         ):
             toolkit.c.include_children_selected = True
 
-            # helper function
-            def _children_name_list(children):
-                name_list = []
-                for child in children:
-                    name = child.get('name', "")
-                    name_list += [name] + _children_name_list(child.get('children', []))
-                return name_list
-
             # update filter query
-            if toolkit.c.id:
-                children = _children_name_list(
-                    group_tree_section(
-                        toolkit.c.id,
-                        type_='data-container',
-                        include_parents=False,
-                        include_siblings=False
-                    ).get('children',[])
-                )
-                if children:
-                    search_params['fq'] = 'organization:%s' % toolkit.c.id
-                    for name in children:
-                        if name:
-                            search_params['fq'] += ' OR organization:%s' %  name
+            container = hierarchy.get_container(toolkit.c.id) if toolkit.c.id else None
+            if container and hierarchy.get_descendants(container['id']):
+                search_params['fq'] = 'vocab_ancestor_containers:"%s"' % container['id']
 
         return search_params
 
@@ -484,9 +504,8 @@ class UnhcrPlugin(
             if context.get('auth_user_obj'):
                 user_id = context['auth_user_obj'].id
             elif context.get('user'):
-                user = toolkit.get_action('user_show')(
-                    {'ignore_auth': True}, {'id': context['user']})
-                user_id = user['id']
+                user = User.get(context['user'])
+                user_id = user.id if user else None
             if user_id:
                 helpers.create_curation_activity('dataset_deposited', pkg_dict['id'],
                     pkg_dict['name'], user_id)
@@ -538,6 +557,7 @@ class UnhcrPlugin(
         functions['package_create'] = auth.package_create
         functions['package_update'] = auth.package_update
         functions['dataset_collaborator_create'] = auth.dataset_collaborator_create
+        functions['scan_all'] = auth.scan_all
         functions['scan_hook'] = auth.scan_hook
         functions['scan_submit'] = auth.scan_submit
         functions['access_request_list_for_user'] = auth.access_request_list_for_user
@@ -554,17 +574,26 @@ class UnhcrPlugin(
     def get_actions(self):
         functions = {
             'access_request_list_for_user': actions.access_request_list_for_user,
+            'access_request_count_for_user': actions.access_request_count_for_user,
             'access_request_update': actions.access_request_update,
+            'access_request_update_many': actions.access_request_update_many,
             'access_request_create': actions.access_request_create,
             'package_update': actions.package_update,
             'package_publish_microdata': actions.package_publish_microdata,
             'package_get_microdata_collections': actions.package_get_microdata_collections,
+            'package_get_microdata_publish_status': actions.package_get_microdata_publish_status,
             'dataset_collaborator_create': actions.dataset_collaborator_create,
             'organization_create': actions.organization_create,
+            'organization_update': actions.organization_update,
+            'organization_delete': actions.organization_delete,
+            'member_create': actions.member_create,
+            'member_delete': actions.member_delete,
             'organization_member_create': actions.organization_member_create,
             'organization_member_delete': actions.organization_member_delete,
+            'organization_member_create_many': actions.organization_member_create_many,
             'organization_list_all_fields': actions.organization_list_all_fields,
             'container_request_list': actions.container_request_list,
+            'mail_queue_status': actions.mail_queue_status,
             'package_activity_list': actions.package_activity_list,
             'dashboard_activity_list': actions.dashboard_activity_list,
             'user_activity_list': actions.user_activity_list,
@@ -578,6 +607,7 @@ class UnhcrPlugin(
             'organization_activity_list_html': actions.organization_activity_list_html,
             'recently_changed_packages_activity_list_html': actions.recently_changed_packages_activity_list_html,
             'datasets_validation_report': actions.datasets_validation_report,
+            'scan_all': actions.scan_all,
             'scan_hook': actions.scan_hook,
             'scan_submit': actions.scan_submit,
             'resource_create': actions.resource_create,
@@ -587,6 +617,7 @@ class UnhcrPlugin(
             'search_index_rebuild': actions.search_index_rebuild,
             'user_autocomplete': actions.user_autocomplete,
             'user_list': actions.user_list,
+            'membership_user_list': actions.membership_user_list,
             'user_show': actions.user_show,
             'user_create': actions.user_create,
         }
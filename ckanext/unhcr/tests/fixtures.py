@@ -5,8 +5,11 @@ import os
 import pytest
 
 from ckan.config import environment
+from ckan.plugins import toolkit
 
 from ckanext.unhcr.models import create_tables as unhcr_create_tables
+from ckanext.unhcr import cache, microdata
+from ckanext.unhcr.tests import mocks
 from ckanext.collaborators.model import (
     tables_exist as collaborators_tables_exist,
     create_tables as collaborators_create_tables,
@@ -20,6 +23,37 @@ def unhcr_migrate():
         collaborators_create_tables()
 
 
+@pytest.fixture(autouse=True)
+def clear_unhcr_cache():
+    cache.clear()
+
+
+@pytest.fixture
+def fake_microdata_server():
+    server = mocks.FakeMicrodataServer()
+    server.start()
+    toolkit.config['ckanext.unhcr.microdata_url'] = server.url
+    microdata.clear_collections_cache()
+
+    yield server
+
+    toolkit.config.pop('ckanext.unhcr.microdata_url', None)
+    server.stop()
+
+
+@pytest.fixture
+def smtp_server():
+    server = mocks.FakeSmtpServer()
+    server.start()
+    test_server = toolkit.config.get('smtp.test_server')
+    toolkit.config['smtp.test_server'] = server.address
+
+    yield server
+
+    toolkit.config['smtp.test_server'] = test_server
+    server.stop()
+
+
 @pytest.fixture(autouse=True, scope='session')
 def use_test_env():
     # setup
@@ -1,4 +1,11 @@
+import asyncore
+import BaseHTTPServer
 import cgi
+import json
+import smtpd
+import socket
+import SocketServer
+import threading
 from StringIO import StringIO
 
 
@@ -14,3 +21,129 @@ class FakeFileStorage(cgi.FieldStorage, object):
         self.list = list(self.file)
         self.filename = filename
         self.name = "upload"
+
+
+class FakeMicrodataServer(object):
+    '''
+    A local HTTP server mimicking the Microdata API
+
+    Every request is recorded in `calls`. Set `failures[path]` to make
+    the server answer a number of requests to that path with a 500 error.
+    '''
+
+    def __init__(self):
+        self.calls = []
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _make_microdata_handler(self))
+        self.url = 'http://127.0.0.1:%s/index.php' % self.httpd.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_calls(self, path_suffix):
+        return [call for call in self.calls if call['path'].endswith(path_suffix)]
+
+    def respond(self, method, path, headers, body):
+        with self.lock:
+            self.calls.append({
+                'method': method, 'path': path, 'headers': headers, 'body': body})
+            if self.failures.get(path):
+                self.failures[path] -= 1
+                return 500, {'status': 'failed', 'errors': 'Server error'}
+        if path.endswith('/api/collections'):
+            return 200, {'status': 'success', 'collections': [{'id': 1, 'title': 'Collection'}]}
+        if '/api/datasets/create/survey/' in path:
+            return 200, {'status': 'success', 'dataset': {'id': 1}}
+        if path.endswith('/resources'):
+            return 200, {'status': 'success', 'resource': json.loads(body)}
+        if path.endswith('/files'):
+            return 200, {'status': 'success'}
+        return 404, {'status': 'failed', 'errors': 'Not found'}
+
+
+class FakeSmtpServer(smtpd.SMTPServer, object):
+    '''
+    A local debugging SMTP server
+
+    Every email received is recorded in `messages` and every
+    connection is counted in `connections`.
+    '''
+
+    def __init__(self):
+        # Use a private socket map rather than the global asyncore one
+        asyncore.dispatcher.__init__(self, map={})
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('127.0.0.1', 0))
+        self.listen(5)
+        self._localaddr = self.socket.getsockname()
+        self._remoteaddr = None
+        self.messages = []
+        self.connections = 0
+        self.running = False
+        self.address = '%s:%s' % self._localaddr
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            self.connections += 1
+            channel = smtpd.SMTPChannel(self, conn, addr)
+            asyncore.socket_map.pop(channel._fileno, None)
+            channel._map = self._map
+            channel.add_channel()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append({'from': mailfrom, 'to': rcpttos, 'data': data})
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+        self.close()
+
+    def _serve(self):
+        while self.running and self._map:
+            asyncore.loop(timeout=0.1, count=1, map=self._map)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def _make_microdata_handler(server):
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self._respond('GET')
+
+        def do_POST(self):
+            self._respond('POST')
+
+        def log_message(self, *args):
+            pass
+
+        def _respond(self, method):
+            length = int(self.headers.getheader('Content-Length') or 0)
+            body = self.rfile.read(length)
+            status, data = server.respond(method, self.path, dict(self.headers), body)
+            payload = json.dumps(data)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
@@ -280,6 +280,117 @@ class TestAccessRequestUpdate(object):
             self.user_request.actioned_by
         )
 
+    def test_access_request_update_many_approve_container_admin(self):
+        ids = [self.container_request.id, self.dataset_request.id, self.user_request.id]
+        mock_mailer = mock.Mock()
+        with mock.patch('ckanext.unhcr.mailer.mail_user_by_id', mock_mailer):
+            requests = toolkit.get_action("access_request_update_many")(
+                {"model": model, "user": self.container1_admin["name"]},
+                {'ids': ids, 'status': 'approved'}
+            )
+
+            assert 3 == mock_mailer.call_count
+            subjects = [call[0][1] for call in mock_mailer.call_args_list]
+            assert subjects == [
+                "[UNHCR RIDL] Membership: {}".format(self.container1["title"]),
+                "[UNHCR RIDL] Collaborator: {}".format(self.dataset1["title"]),
+                '[UNHCR RIDL] - User account approved',
+            ]
+
+        assert sorted(ids) == sorted(req['id'] for req in requests)
+        for req in [self.container_request, self.dataset_request, self.user_request]:
+            assert 'approved' == req.status
+            assert self.container1_admin["id"] == req.actioned_by
+
+        orgs = toolkit.get_action("organization_list_for_user")(
+            {"ignore_auth": True},
+            {"id": self.requesting_user["name"], "permission": "read"}
+        )
+        assert self.container1['id'] == orgs[0]['id']
+        collaborators = toolkit.get_action("dataset_collaborator_list")(
+            {"ignore_auth": True}, {"id": self.dataset1["id"]}
+        )
+        assert self.requesting_user["id"] == collaborators[0]["user_id"]
+        user = toolkit.get_action("user_show")(
+            {"ignore_auth": True}, {"id": self.pending_user["id"]}
+        )
+        assert model.State.ACTIVE == user['state']
+
+    def test_access_request_update_many_reject_container_admin(self):
+        ids = [self.container_request.id, self.user_request.id]
+        mock_mailer = mock.Mock()
+        with mock.patch('ckanext.unhcr.mailer.mail_user_by_id', mock_mailer):
+            toolkit.get_action("access_request_update_many")(
+                {"model": model, "user": self.container1_admin["name"]},
+                {'ids': ids, 'status': 'rejected', 'message': 'nope'}
+            )
+
+            assert 2 == mock_mailer.call_count
+            subjects = [call[0][1] for call in mock_mailer.call_args_list]
+            assert subjects == [
+                '[UNHCR RIDL] - Request for access to: "{}"'.format(self.container1['name']),
+                '[UNHCR RIDL] - User account rejected',
+            ]
+            assert all('nope' in call[0][2] for call in mock_mailer.call_args_list)
+
+        assert 'rejected' == self.container_request.status
+        assert 'rejected' == self.user_request.status
+        assert 'requested' == self.dataset_request.status
+
+    def test_access_request_update_many_partial_failure(self):
+        external_user = factories.ExternalUser()
+        external_request = AccessRequest(
+            user_id=external_user["id"],
+            object_id=self.container1["id"],
+            object_type="organization",
+            message="",
+            role="member",
+        )
+        model.Session.add(external_request)
+        model.Session.commit()
+
+        ids = [self.container_request.id, external_request.id]
+        mock_mailer = mock.Mock()
+        with mock.patch('ckanext.unhcr.mailer.mail_user_by_id', mock_mailer):
+            with pytest.raises(toolkit.ValidationError):
+                toolkit.get_action("access_request_update_many")(
+                    {"model": model, "user": self.container1_admin["name"]},
+                    {'ids': ids, 'status': 'approved'}
+                )
+
+            # The request actioned before the failure is kept and notified
+            mock_mailer.assert_called_once()
+            assert self.requesting_user["id"] == mock_mailer.call_args[0][0]
+
+        model.Session.expire_all()
+        assert 'approved' == model.Session.query(AccessRequest).get(self.container_request.id).status
+        assert 'requested' == model.Session.query(AccessRequest).get(external_request.id).status
+
+    def test_access_request_update_many_not_authorized(self):
+        # standard_user can't action any of them, so none is actioned
+        ids = [self.container_request.id, self.dataset_request.id]
+        action = toolkit.get_action("access_request_update_many")
+        with pytest.raises(toolkit.NotAuthorized):
+            action(
+                {"model": model, "user": self.standard_user["name"]},
+                {'ids': ids, 'status': 'approved'}
+            )
+        assert 'requested' == self.container_request.status
+        assert 'requested' == self.dataset_request.status
+
+    def test_access_request_update_many_invalid_inputs(self):
+        action = toolkit.get_action("access_request_update_many")
+        context = {"model": model, "user": self.container1_admin["name"]}
+        with pytest.raises(toolkit.ValidationError):
+            action(context, {'ids': [self.container_request.id], 'status': 'rejected'})
+        with pytest.raises(toolkit.ValidationError):
+            action(context, {'ids': [], 'status': 'approved'})
+        with pytest.raises(toolkit.ValidationError):
+            action(context, {'ids': [self.container_request.id], 'status': 'invalid'})
+        with pytest.raises(toolkit.ObjectNotFound):
+            action(context, {'ids': [self.container_request.id, 'invalid-id'], 'status': 'approved'})
+        assert 'requested' == self.container_request.status
+
     def test_access_request_update_invalid_inputs(self):
         action = toolkit.get_action("access_request_update")
         with pytest.raises(toolkit.ObjectNotFound):
@@ -418,6 +529,49 @@ class TestAccessRequestListForUser(object):
         )
         assert 4 == len(access_requests)
 
+    def test_access_request_list_for_user_pagination(self):
+        context = {"model": model, "user": self.sysadmin["name"]}
+        action = toolkit.get_action("access_request_list_for_user")
+        all_ids = [req["id"] for req in action(context, {})]
+
+        # offset
+        page1 = action(context, {"limit": 3})
+        page2 = action(context, {"limit": 3, "offset": 3})
+        assert [req["id"] for req in page1 + page2] == all_ids
+
+        # keyset
+        page1 = action(context, {"limit": 3})
+        page2 = action(context, {"limit": 3, "after": page1[-1]["id"]})
+        assert [req["id"] for req in page1 + page2] == all_ids
+
+        with pytest.raises(toolkit.ValidationError):
+            action(context, {"limit": -1})
+        with pytest.raises(toolkit.ObjectNotFound):
+            action(context, {"after": "invalid-id"})
+
+    def test_access_request_list_for_user_fields(self):
+        context = {"model": model, "user": self.sysadmin["name"]}
+        access_requests = toolkit.get_action("access_request_list_for_user")(
+            context, {}
+        )
+        for req in access_requests:
+            assert req["user"]["id"] == self.requesting_user["id"]
+            assert req["user"]["name"] == self.requesting_user["name"]
+            assert "password" not in req["user"]
+            assert "apikey" not in req["user"]
+            assert req["object"]["id"] == req["object_id"]
+            assert req["object"]["name"]
+
+    def test_access_request_count_for_user(self):
+        action = toolkit.get_action("access_request_count_for_user")
+        assert 4 == action({"model": model, "user": self.sysadmin["name"]}, {})
+        assert 1 == action(
+            {"model": model, "user": self.sysadmin["name"]}, {"status": "approved"})
+        assert 2 == action({"model": model, "user": self.container1_admin["name"]}, {})
+        assert 4 == action({"model": model, "user": self.multi_container_admin["name"]}, {})
+        with pytest.raises(toolkit.NotAuthorized):
+            action({"model": model, "user": self.container_member["name"]}, {})
+
     def test_access_request_list_for_user_standard_users(self):
         # standard_user is a member of a container, but not an admin
         # they shouldn't be able to see any requests
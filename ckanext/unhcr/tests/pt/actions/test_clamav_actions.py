@@ -6,8 +6,11 @@ import mock
 import pytest
 import re
 import responses
+from ckan import model
 from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import jobs, utils
+from ckanext.unhcr.models import MailOutbox
 from ckanext.unhcr.tests import factories
 
 
@@ -197,10 +200,15 @@ class TestClamAVActions(object):
         assert u'error' == task['state']
         assert u'{"message": "oh no"}' == task['error']
 
-        assert 2 == mock_mailer.call_count
-        assert 'errors@okfn.org' == mock_mailer.call_args_list[0][0][1]
-        assert 'fred@example.com' == mock_mailer.call_args_list[1][0][1]
-        assert '[UNHCR RIDL] Error performing Clam AV Scan' == mock_mailer.call_args[0][2]
+        # The emails are queued, not sent within the request
+        mock_mailer.assert_not_called()
+        messages = model.Session.query(MailOutbox).order_by(MailOutbox.recipient_email).all()
+        assert ['errors@okfn.org', 'fred@example.com'] == [
+            message.recipient_email for message in messages]
+        assert all(
+            '[UNHCR RIDL] Error performing Clam AV Scan' == message.subject
+            for message in messages)
+        assert 'oh no' in messages[0].body
 
     def test_scan_hook_other(self):
         self.insert_pending_task()
@@ -322,3 +330,232 @@ class TestClamAVActions(object):
                     "metadata": {}
                 }
             )
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestClamAVScanAll(object):
+
+    def setup(self):
+        self.sysadmin = core_factories.Sysadmin()
+        dataset = factories.Dataset()
+        self.resource = factories.Resource(
+            package_id=dataset['id'],
+            url_type='upload',
+        )
+
+    def insert_task(self, state, last_updated):
+        return toolkit.get_action('task_status_update')(
+            {'ignore_auth': True},
+            {
+                'entity_id': self.resource['id'],
+                'entity_type': 'resource',
+                'task_type': 'clamav',
+                'last_updated': str(last_updated),
+                'state': state,
+                'key': 'clamav',
+                'value': '{}',
+                'error': 'null',
+            }
+        )
+
+    def test_get_resource_ids_to_scan_no_task(self):
+        ids = utils.get_resource_ids_to_scan(datetime.timedelta(days=30))
+        assert [self.resource['id']] == ids
+
+    def test_get_resource_ids_to_scan_recent_verdict(self):
+        self.insert_task('complete', datetime.datetime.utcnow())
+        ids = utils.get_resource_ids_to_scan(datetime.timedelta(days=30))
+        assert [] == ids
+
+    def test_get_resource_ids_to_scan_old_verdict(self):
+        self.insert_task(
+            'complete', datetime.datetime.utcnow() - datetime.timedelta(days=31))
+        ids = utils.get_resource_ids_to_scan(datetime.timedelta(days=30))
+        assert [self.resource['id']] == ids
+
+    def test_get_resource_ids_to_scan_after(self):
+        ids = utils.get_resource_ids_to_scan(
+            datetime.timedelta(days=30), after=self.resource['id'])
+        assert [] == ids
+
+    def test_scan_all_not_authorized(self):
+        user = core_factories.User()
+        with pytest.raises(toolkit.NotAuthorized):
+            toolkit.get_action('scan_all')({'user': user['name']}, {})
+
+    def test_scan_all_not_configured(self):
+        with pytest.raises(toolkit.ValidationError):
+            toolkit.get_action('scan_all')({'user': self.sysadmin['name']}, {})
+
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_all_invalid_params(self):
+        with pytest.raises(toolkit.ValidationError):
+            toolkit.get_action('scan_all')(
+                {'user': self.sysadmin['name']}, {'limit': 'foo'})
+        with pytest.raises(toolkit.ValidationError):
+            toolkit.get_action('scan_all')(
+                {'user': self.sysadmin['name']}, {'max_in_flight': 0})
+
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_all_enqueues_job(self, mock_enqueue):
+        result = toolkit.get_action('scan_all')(
+            {'user': self.sysadmin['name']}, {'max_in_flight': 5})
+
+        assert 1 == result['count']
+        mock_enqueue.assert_called_once()
+        assert 'scan_all_resources' == mock_enqueue.call_args[0][0].__name__
+        assert 5 == mock_enqueue.call_args[1]['kwargs']['max_in_flight']
+
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_all_count_resume(self, mock_enqueue):
+        jobs._save_scan_all_progress({
+            'total': 1,
+            'submitted': 1,
+            'skipped': 0,
+            'failed': 0,
+            'last_id': self.resource['id'],
+        })
+
+        # The count matches what the resumed job will process
+        result = toolkit.get_action('scan_all')(
+            {'user': self.sysadmin['name']}, {'resume': True})
+        assert 0 == result['count']
+        result = toolkit.get_action('scan_all')(
+            {'user': self.sysadmin['name']}, {})
+        assert 1 == result['count']
+
+    def test_count_resources_to_scan(self):
+        max_age = datetime.timedelta(days=30)
+        assert 1 == utils.count_resources_to_scan(max_age)
+        assert 1 == utils.count_resources_to_scan(max_age, limit=5)
+        assert 0 == utils.count_resources_to_scan(max_age, after=self.resource['id'])
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_all_resources(self):
+        responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
+        responses.add(responses.POST, 'http://clamav:1234/job', status=200)
+
+        progress = jobs.scan_all_resources(rate=0)
+
+        assert 1 == progress['total']
+        assert 1 == progress['submitted']
+        assert self.resource['id'] == progress['last_id']
+        assert responses.assert_call_count('http://clamav:1234/job', 1)
+
+        # The resource has a pending task now so it is not submitted again
+        progress = jobs.scan_all_resources(rate=0)
+        assert 0 == progress['total']
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_scan_all_resources_resume(self):
+        responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
+        responses.add(responses.POST, 'http://clamav:1234/job', status=200)
+
+        jobs._save_scan_all_progress({
+            'total': 1,
+            'submitted': 1,
+            'skipped': 0,
+            'failed': 0,
+            'last_id': self.resource['id'],
+        })
+        progress = jobs.scan_all_resources(rate=0, resume=True)
+
+        assert 0 == progress['total']
+        assert responses.assert_call_count('http://clamav:1234/job', 0)
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestClamAVSweepStaleTasks(object):
+
+    def setup(self):
+        self.sysadmin = core_factories.Sysadmin()
+        dataset = factories.Dataset()
+        self.resource = factories.Resource(
+            package_id=dataset['id'],
+            url_type='upload',
+        )
+
+    def get_task(self):
+        return toolkit.get_action('task_status_show')(
+            {'user': self.sysadmin['name']},
+            {
+                'entity_id': self.resource['id'],
+                'task_type': 'clamav',
+                'key': 'clamav'
+            }
+        )
+
+    def insert_task(self, state, last_updated):
+        return toolkit.get_action('task_status_update')(
+            {'ignore_auth': True},
+            {
+                'entity_id': self.resource['id'],
+                'entity_type': 'resource',
+                'task_type': 'clamav',
+                'last_updated': str(last_updated),
+                'state': state,
+                'key': 'clamav',
+                'value': '{}',
+                'error': 'null',
+            }
+        )
+
+    def test_get_stale_clamav_tasks(self):
+        self.insert_task('pending', datetime.datetime.utcnow())
+        assert [] == utils.get_stale_clamav_tasks()
+        assert 1 == utils.count_clamav_tasks_in_flight()
+
+        self.insert_task(
+            'pending', datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+        tasks = utils.get_stale_clamav_tasks()
+        assert 1 == len(tasks)
+        assert self.resource['id'] == tasks[0].entity_id
+        assert 'active' == tasks[0].resource_state
+        assert 0 == utils.count_clamav_tasks_in_flight()
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_sweep_resubmits(self):
+        responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
+        responses.add(responses.POST, 'http://clamav:1234/job', status=200)
+        self.insert_task(
+            'pending', datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+
+        counts = jobs.sweep_stale_clamav_tasks()
+
+        assert 1 == counts['stale']
+        assert 1 == counts['resubmitted']
+        assert 0 == counts['failed']
+        assert 1 == counts['in_flight']
+        assert responses.assert_call_count('http://clamav:1234/job', 1)
+        assert u'pending' == self.get_task()['state']
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.unhcr.clamav_url', 'http://clamav:1234')
+    def test_sweep_defers_when_scanner_busy(self):
+        responses.add_passthru(re.compile(r'^http:\/\/.*solr/.*$'))
+        self.insert_task(
+            'submitting', datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+
+        with mock.patch('ckanext.unhcr.utils.count_clamav_tasks_in_flight', return_value=10):
+            counts = jobs.sweep_stale_clamav_tasks(max_in_flight=10)
+
+        assert 1 == counts['deferred']
+        assert 0 == counts['resubmitted']
+        assert u'submitting' == self.get_task()['state']
+
+    def test_sweep_fails_when_not_configured(self):
+        self.insert_task(
+            'pending', datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+
+        counts = jobs.sweep_stale_clamav_tasks()
+
+        assert 1 == counts['stale']
+        assert 1 == counts['failed']
+        task = self.get_task()
+        assert u'error' == task['state']
+        assert 'stale' in task['error']
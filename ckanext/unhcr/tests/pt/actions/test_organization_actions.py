@@ -47,6 +47,60 @@ class TestOrganizationActions(object):
                 **{'order_by': 'foobar'}
             )
 
+    def test_organization_list_organization_list_all_fields_order_by_extra(self):
+        factories.DataContainer(name='af', title='Afghanistan', geographic_area='asia')
+        orgs = call_action(
+            'organization_list_all_fields',
+            {'ignore_auth': True},
+            **{'order_by': 'geographic_area'}
+        )
+        assert [org['name'] for org in orgs][0] == 'af'
+        assert orgs[0]['geographic_area'] == 'asia'
+
+    def test_organization_list_organization_list_all_fields_order_by_column_uses_cached_keys(self):
+        with mock.patch('ckanext.unhcr.actions.utils.get_group_extra_keys') as get_keys:
+            get_keys.return_value = ['country', 'visible_external']
+            call_action('organization_list_all_fields', {'ignore_auth': True})
+            call_action(
+                'organization_list_all_fields',
+                {'ignore_auth': True},
+                **{'order_by': 'name'}
+            )
+        for call in get_keys.call_args_list:
+            assert not call[1].get('refresh')
+
+    def test_organization_list_organization_list_all_fields_order_by_new_extra_refreshes_keys(self):
+        with mock.patch('ckanext.unhcr.actions.utils.get_group_extra_keys') as get_keys:
+            get_keys.side_effect = lambda refresh=False: (
+                ['geographic_area'] if refresh else [])
+            call_action(
+                'organization_list_all_fields',
+                {'ignore_auth': True},
+                **{'order_by': 'geographic_area'}
+            )
+        get_keys.assert_called_with(refresh=True)
+
+    def test_organization_list_organization_list_all_fields_extras(self):
+        factories.DataContainer(
+            name='ke', title='Kenya', country=['KEN', 'SOM'], visible_external=False)
+        orgs = call_action(
+            'organization_list_all_fields',
+            {'ignore_auth': True},
+        )
+        orgs = dict((org['name'], org) for org in orgs)
+        assert orgs['ke']['country'] == ['KEN', 'SOM']
+        assert orgs['ke']['visible_external'] is False
+        assert orgs['za']['country'] == ['SVN']
+        assert orgs['za']['visible_external'] is True
+
+    def test_organization_list_organization_list_all_fields_returns_copies(self):
+        orgs = call_action('organization_list_all_fields', {'ignore_auth': True})
+        orgs[0]['country'].append('XXX')
+        orgs[0]['title'] = 'Changed'
+        orgs = call_action('organization_list_all_fields', {'ignore_auth': True})
+        assert orgs[0]['country'] == ['SVN']
+        assert orgs[0]['title'] == 'Somalia'
+
 
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestOrganizationMemberCreate(object):
@@ -89,6 +143,89 @@ class TestOrganizationMemberCreate(object):
             )
 
 
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestOrganizationMemberCreateMany(object):
+
+    def setup(self):
+        self.sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        self.user = core_factories.User(name='user1')
+        self.container1 = factories.DataContainer(name='container1', title='Container 1')
+        self.container2 = factories.DataContainer(
+            name='container2',
+            title='Container 2',
+            users=[{'name': 'user1', 'capacity': 'member'}],
+        )
+
+    @mock.patch('ckanext.unhcr.mailer.mail_user_by_id')
+    def test_organization_member_create_many(self, mock_mail_user_by_id):
+        containers = call_action(
+            'organization_member_create_many',
+            {'user': 'sysadmin'},
+            username='user1',
+            ids=['container1', self.container2['id']],
+            role='editor',
+        )
+        assert [c['name'] for c in containers] == ['container1', 'container2']
+
+        org_list = call_action('organization_list_for_user', {'user': 'sysadmin'}, id='user1')
+        assert sorted((o['name'], o['capacity']) for o in org_list) == [
+            ('container1', 'editor'),
+            ('container2', 'editor'),
+        ]
+
+        # one email for all the containers
+        assert mock_mail_user_by_id.call_count == 1
+
+    @mock.patch('ckanext.unhcr.mailer.mail_user_by_id')
+    def test_organization_member_create_many_not_notify(self, mock_mail_user_by_id):
+        call_action(
+            'organization_member_create_many',
+            {'user': 'sysadmin'},
+            username='user1',
+            ids=['container1'],
+            role='member',
+            not_notify=True,
+        )
+        assert mock_mail_user_by_id.call_count == 0
+
+    def test_organization_member_create_many_missing_container(self):
+        with pytest.raises(toolkit.ValidationError):
+            call_action(
+                'organization_member_create_many',
+                {'user': 'sysadmin'},
+                username='user1',
+                ids=['container1', 'not-a-container'],
+                role='member',
+                not_notify=True,
+            )
+
+        # nothing is saved
+        org_list = call_action('organization_list_for_user', {'user': 'sysadmin'}, id='user1')
+        assert [o['name'] for o in org_list] == ['container2']
+
+    def test_organization_member_create_many_external_user(self):
+        external_user = factories.ExternalUser()
+        with pytest.raises(toolkit.ValidationError):
+            call_action(
+                'organization_member_create_many',
+                {'user': 'sysadmin'},
+                username=external_user['name'],
+                ids=['container1'],
+                role='member',
+            )
+
+    def test_organization_member_create_many_not_authorized(self):
+        with pytest.raises(toolkit.NotAuthorized):
+            call_action(
+                'organization_member_create_many',
+                {'user': 'user1', 'ignore_auth': False},
+                username='user1',
+                ids=['container1'],
+                role='admin',
+                not_notify=True,
+            )
+
+
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestPendingRequestsList(object):
 
@@ -125,6 +262,45 @@ class TestPendingRequestsList(object):
         assert requests['count'] == 1
         assert requests['containers'][0]['name'] == 'container1'
 
+    def test_container_request_list_all_fields_creator_and_parent(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        creator = core_factories.User(name='creator', fullname='Creator')
+        parent = factories.DataContainer(name='parent')
+        factories.DataContainer(
+            name='container1',
+            state='approval_needed',
+            description='A pending container',
+            groups=[{'name': parent['name']}],
+            users=[{'capacity': 'admin', 'name': creator['name']}],
+        )
+        context = {'model': model, 'user': 'sysadmin'}
+        requests = toolkit.get_action("container_request_list")(
+            context, {'all_fields': True}
+        )
+        container = requests['containers'][0]
+        assert container['display_name'] == container['title']
+        assert container['description'] == 'A pending container'
+        assert container['country'] == ['SVN']
+        assert [u['name'] for u in container['users']] == ['creator']
+        assert container['users'][0]['fullname'] == 'Creator'
+        assert [g['name'] for g in container['groups']] == ['parent']
+
+    def test_container_request_list_pagination(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        for name in ['container1', 'container2', 'container3']:
+            factories.DataContainer(name=name, id=name, state='approval_needed')
+        context = {'model': model, 'user': 'sysadmin'}
+        requests = toolkit.get_action("container_request_list")(
+            context, {'all_fields': True, 'limit': 2, 'offset': 1}
+        )
+        assert requests['count'] == 3
+        assert [c['name'] for c in requests['containers']] == ['container2', 'container3']
+        requests = toolkit.get_action("container_request_list")(
+            context, {'limit': 1}
+        )
+        assert requests['count'] == 3
+        assert requests['containers'] == ['container1']
+
     def test_container_request_list_empty(self):
         sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
         context = {'model': model, 'user': 'sysadmin'}
@@ -2,13 +2,15 @@
 
 import pytest
 import json
+import mock
+import requests
 import responses
 from ckan import model
 from ckan.plugins import toolkit
 from ckan.tests import helpers as core_helpers
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.tests import factories, mocks
-from ckanext.unhcr import helpers
+from ckanext.unhcr import helpers, jobs, microdata
 from ckanext.unhcr.activity import log_download_activity
 
 
@@ -74,6 +76,25 @@ class TestMicrodata(object):
                 'nation': '',
             })
 
+    @responses.activate
+    def test_package_publish_microdata_server_error(self):
+        context = {'model': model, 'user': self.sysadmin['name']}
+
+        # Patch requests
+        url = 'https://microdata.unhcr.org/index.php/api/datasets/create/survey/DATASET'
+        responses.add_passthru('http')
+        responses.add(responses.POST, url, status=502,
+            body='<html>Bad Gateway</html>', content_type='text/html')
+
+        # Publish to microdata
+        with pytest.raises(RuntimeError):
+            toolkit.get_action('package_publish_microdata')(context, {
+                'id': self.dataset['id'],
+                'nation': '',
+            })
+        # Not retried as the survey could have been created anyway
+        assert len(responses.calls) == 1
+
     def test_package_publish_microdata_not_found(self):
         context = {'model': model, 'user': self.sysadmin['name']}
         action = toolkit.get_action('package_publish_microdata')
@@ -94,6 +115,202 @@ class TestMicrodata(object):
             action(context, {'id': self.dataset['id']})
 
 
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestMicrodataPublishResources(object):
+
+    # General
+
+    def setup(self):
+        # Config
+        toolkit.config['ckanext.unhcr.microdata_api_key'] = 'API-KEY'
+
+        # Users
+        self.sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+
+        # Datasets
+        self.dataset = factories.Dataset(name='dataset')
+        self.resources = [
+            factories.Resource(
+                package_id=self.dataset['id'],
+                upload=mocks.FakeFileStorage(),
+                url='http://fakeurl/test.txt',
+                url_type='upload',
+            ),
+            factories.Resource(
+                package_id=self.dataset['id'],
+                upload=mocks.FakeFileStorage(),
+                url='http://fakeurl/test.txt',
+                url_type='upload',
+            ),
+            factories.Resource(
+                package_id=self.dataset['id'],
+                url='http://example.com/link.csv',
+            ),
+        ]
+
+    def _get_status(self):
+        context = {'model': model, 'user': self.sysadmin['name']}
+        status = toolkit.get_action('package_get_microdata_publish_status')(
+            context, {'id': self.dataset['id']})
+        return dict((item['resource_id'], item) for item in status)
+
+    def test_package_publish_microdata_enqueues_resources(self, fake_microdata_server):
+        context = {'model': model, 'user': self.sysadmin['name']}
+
+        with mock.patch('ckan.plugins.toolkit.enqueue_job') as mock_enqueue_job:
+            survey = toolkit.get_action('package_publish_microdata')(context, {
+                'id': self.dataset['id'],
+                'nation': 'nation',
+                'repoid': 'repoid',
+            })
+
+            mock_enqueue_job.assert_called_once()
+            assert mock_enqueue_job.call_args[0][0] == jobs.publish_microdata_resources
+            assert mock_enqueue_job.call_args[0][1] == [self.dataset['id'], 'DATASET']
+
+        assert survey['url'] == '%s/catalog/1' % fake_microdata_server.url
+        assert len(fake_microdata_server.calls) == 1
+        status = self._get_status()
+        assert len(status) == 3
+        assert all(item['state'] == 'pending' for item in status.values())
+
+    def test_publish_microdata_resources(self, fake_microdata_server):
+        results = jobs.publish_microdata_resources(self.dataset['id'], 'DATASET')
+
+        # Check results
+        assert len(results) == 3
+        assert all(result['state'] == 'complete' for result in results)
+
+        # Check resource calls
+        calls = fake_microdata_server.get_calls('/api/datasets/DATASET/resources')
+        assert len(calls) == 3
+        assert all(call['headers']['x-api-key'] == 'API-KEY' for call in calls)
+
+        # Check file calls (streamed with a known length, de-duplicated names)
+        calls = fake_microdata_server.get_calls('/api/datasets/DATASET/files')
+        assert len(calls) == 2
+        for call in calls:
+            assert call['headers']['content-type'].startswith('multipart/form-data')
+            assert int(call['headers']['content-length']) == len(call['body'])
+            assert 'Some data' in call['body']
+        file_names = sorted(
+            call['body'].split('filename="')[1].split('"')[0] for call in calls)
+        assert file_names == ['test (1).txt', 'test.txt']
+
+        # Check status
+        status = self._get_status()
+        assert all(item['state'] == 'complete' for item in status.values())
+        assert all(item['error'] is None for item in status.values())
+
+    @mock.patch('ckanext.unhcr.microdata.RETRY_BACKOFF', 0)
+    def test_publish_microdata_resources_no_retry_after_server_errors(self, fake_microdata_server):
+        fake_microdata_server.failures['/index.php/api/datasets/DATASET/files'] = 1
+
+        results = jobs.publish_microdata_resources(self.dataset['id'], 'DATASET')
+
+        # Uploading a file is not retried as it could have been stored anyway
+        assert sorted(result['state'] for result in results) == ['complete', 'complete', 'error']
+        assert len(fake_microdata_server.get_calls('/api/datasets/DATASET/files')) == 2
+        status = self._get_status()
+        assert sorted(item['attempts'] for item in status.values()) == [1, 2, 2]
+
+    @mock.patch('ckanext.unhcr.microdata.RETRY_BACKOFF', 0)
+    def test_publish_microdata_resources_retries_connection_errors(self):
+        connection_error = requests.exceptions.ConnectionError('refused')
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'status': 'success'}
+        session = mock.Mock()
+        session.post.side_effect = [connection_error, response]
+
+        with mock.patch('ckanext.unhcr.microdata.get_session', return_value=session):
+            response, attempts = microdata._post('http://microdata/api', 'API-KEY',
+                payload={}, idempotent=False)
+
+        assert attempts == 2
+        assert response.json() == {'status': 'success'}
+
+    @mock.patch('ckanext.unhcr.microdata.RETRY_BACKOFF', 0)
+    def test_publish_microdata_resources_gives_up(self, fake_microdata_server):
+        fake_microdata_server.failures['/index.php/api/datasets/DATASET/resources'] = 100
+
+        results = jobs.publish_microdata_resources(self.dataset['id'], 'DATASET')
+
+        assert all(result['state'] == 'error' for result in results)
+        # Creating a resource is not retried on server errors as it could
+        # have been created anyway
+        assert len(fake_microdata_server.get_calls('/api/datasets/DATASET/resources')) == 3
+        assert len(fake_microdata_server.get_calls('/api/datasets/DATASET/files')) == 0
+        status = self._get_status()
+        assert all(item['state'] == 'error' for item in status.values())
+        assert all(item['error'] == 'Server error' for item in status.values())
+
+    def test_package_get_microdata_publish_status_not_sysadmin(self):
+        user = core_factories.User()
+        context = {'model': model, 'user': user['name']}
+        action = toolkit.get_action('package_get_microdata_publish_status')
+        with pytest.raises(toolkit.NotAuthorized):
+            action(context, {'id': self.dataset['id']})
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestMicrodataCollections(object):
+
+    def setup(self):
+        toolkit.config['ckanext.unhcr.microdata_api_key'] = 'API-KEY'
+        self.sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        self.context = {'model': model, 'user': self.sysadmin['name']}
+
+    def teardown(self):
+        toolkit.config.pop('ckanext.unhcr.microdata_collections_ttl', None)
+
+    def test_package_get_microdata_collections_cached(self, fake_microdata_server):
+        action = toolkit.get_action('package_get_microdata_collections')
+
+        assert action(self.context, {}) == [{'id': 1, 'title': 'Collection'}]
+        assert action(self.context, {}) == [{'id': 1, 'title': 'Collection'}]
+
+        assert len(fake_microdata_server.get_calls('/api/collections')) == 1
+
+    def test_package_get_microdata_collections_stale_while_revalidate(self, fake_microdata_server):
+        action = toolkit.get_action('package_get_microdata_collections')
+        action(self.context, {})
+        toolkit.config['ckanext.unhcr.microdata_collections_ttl'] = -1
+
+        # The stale list is served and refreshed in the background
+        fake_microdata_server.failures['/index.php/api/collections'] = 1
+        assert action(self.context, {}) == [{'id': 1, 'title': 'Collection'}]
+        refresh = microdata._collections_cache['API-KEY']['refresh']
+        if refresh:
+            refresh.join()
+        assert action(self.context, {}) == [{'id': 1, 'title': 'Collection'}]
+        refresh = microdata._collections_cache['API-KEY']['refresh']
+        if refresh:
+            refresh.join()
+
+        assert len(fake_microdata_server.get_calls('/api/collections')) == 3
+
+    def test_package_get_microdata_collections_failed_refresh(self, fake_microdata_server):
+        action = toolkit.get_action('package_get_microdata_collections')
+        action(self.context, {})
+        microdata._collections_cache['API-KEY']['fetched'] -= 3601
+
+        # The failed refresh is not retried before the next period
+        fake_microdata_server.failures['/index.php/api/collections'] = 100
+        for i in range(3):
+            assert action(self.context, {}) == [{'id': 1, 'title': 'Collection'}]
+            refresh = microdata._collections_cache['API-KEY']['refresh']
+            if refresh:
+                refresh.join()
+
+        assert len(fake_microdata_server.get_calls('/api/collections')) == 2
+
+    def test_package_get_microdata_collections_not_sysadmin(self):
+        user = core_factories.User()
+        action = toolkit.get_action('package_get_microdata_collections')
+        with pytest.raises(toolkit.NotAuthorized):
+            action({'model': model, 'user': user['name']}, {})
+
+
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestPackageActivityList(object):
 
@@ -124,6 +341,11 @@ class TestPackageActivityList(object):
             message='asdf'
         )
         log_download_activity({'user': self.sysadmin['name']}, self.resource1['id'])
+        # The factories act as the site user, whose activities are hidden
+        for title in ['Title 1', 'Title 2']:
+            self._create_changed_activity([
+                ('Package', {'package': {'id': self.dataset1['id'], 'title': title}}),
+            ])
 
     def test_container_admin(self):
         context = {
@@ -190,6 +412,99 @@ class TestPackageActivityList(object):
         with pytest.raises(toolkit.NotAuthorized):
             action(context, data_dict)
 
+    def test_normal_activities(self):
+        context = {'user': self.container1_admin['name']}
+        activities = toolkit.get_action('package_activity_list')(
+            context, {'id': self.dataset1['id']})
+        # only the dataset changes, no curation or downloads
+        assert len(activities) > 0
+        for activity in activities:
+            assert 'curation_activity' not in activity['data']
+            assert 'download resource' != activity['activity_type']
+
+    def test_normal_activities_full_pages(self):
+        for i in range(3):
+            log_download_activity({'user': self.sysadmin['name']}, self.resource1['id'])
+        context = {'user': self.container1_admin['name']}
+        activities = toolkit.get_action('package_activity_list')(
+            context, {'id': self.dataset1['id'], 'limit': 2})
+        # the internal activities don't take up room in the page
+        assert 2 == len(activities)
+        for activity in activities:
+            assert 'download resource' != activity['activity_type']
+
+    def test_user_activity_list_full_pages(self):
+        for i in range(3):
+            log_download_activity({'user': self.sysadmin['name']}, self.resource1['id'])
+        activities = toolkit.get_action('user_activity_list')(
+            {'user': self.sysadmin['name']}, {'id': self.sysadmin['id'], 'limit': 1})
+        assert 1 == len(activities)
+        assert 'download resource' != activities[0]['activity_type']
+        assert 'curation_activity' not in activities[0]['data']
+
+
+    def _create_changed_activity(self, details):
+        activity = model.Activity(
+            self.sysadmin['id'], self.dataset1['id'], None, 'changed package',
+            {'package': {'id': self.dataset1['id']}})
+        model.Session.add(activity)
+        model.Session.flush()
+        for object_type, data in details:
+            model.Session.add(model.ActivityDetail(
+                activity.id, self.dataset1['id'], object_type, 'changed', data))
+        model.Session.commit()
+        return activity.id
+
+    def test_normal_activities_curation_details(self):
+        curation_id = self._create_changed_activity([
+            ('Package', {'package': {'id': self.dataset1['id']}}),
+            ('PackageExtra', {'package_extra': {'key': 'curation_state', 'value': 'review'}}),
+            ('PackageExtra', {'package_extra': {'key': 'curator_id', 'value': 'sysadmin'}}),
+        ])
+        mixed_id = self._create_changed_activity([
+            ('Package', {'package': {'id': self.dataset1['id']}}),
+            ('PackageExtra', {'package_extra': {'key': 'curation_state', 'value': 'draft'}}),
+            ('PackageExtra', {'package_extra': {'key': 'keywords', 'value': '["1"]'}}),
+        ])
+        context = {'user': self.container1_admin['name']}
+        activities = toolkit.get_action('package_activity_list')(
+            context, {'id': self.dataset1['id']})
+        ids = [activity['id'] for activity in activities]
+        # only the updates that just changed the curation extras are hidden
+        assert curation_id not in ids
+        assert mixed_id in ids
+
+    def test_dashboard_activity_list(self):
+        follower = core_factories.User()
+        core_helpers.call_action(
+            'follow_dataset', {'user': follower['name']}, id=self.dataset1['id'])
+        for i in range(3):
+            log_download_activity({'user': self.sysadmin['name']}, self.resource1['id'])
+
+        activities = toolkit.get_action('dashboard_activity_list')(
+            {'user': follower['name']}, {})
+        assert len(activities) > 0
+        assert self.dataset1['id'] in [a['object_id'] for a in activities]
+        for activity in activities:
+            assert 'curation_activity' not in activity['data']
+            assert 'download resource' != activity['activity_type']
+            assert 'is_new' in activity
+
+        # the internal activities don't take up room in the page
+        activities = toolkit.get_action('dashboard_activity_list')(
+            {'user': follower['name']}, {'limit': 1})
+        assert 1 == len(activities)
+        assert 'download resource' != activities[0]['activity_type']
+
+    def test_dashboard_activity_list_no_duplicates(self):
+        core_helpers.call_action(
+            'follow_dataset', {'user': self.sysadmin['name']}, id=self.dataset1['id'])
+        activities = toolkit.get_action('dashboard_activity_list')(
+            {'user': self.sysadmin['name']}, {})
+        # the sysadmin's changes to the followed dataset are listed once
+        ids = [activity['id'] for activity in activities]
+        assert len(ids) == len(set(ids))
+
 
 @pytest.mark.usefixtures('clean_db', 'clean_index', 'unhcr_migrate')
 class TestPackageSearch(object):
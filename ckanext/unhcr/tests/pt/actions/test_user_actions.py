@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import time
+import mock
 import pytest
 from ckan import model
 from ckan.plugins import toolkit
 from ckan.tests.helpers import call_action
 from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr import actions
 from ckanext.unhcr.tests import factories
 
 
@@ -116,6 +120,102 @@ class TestUserAutocomplete(object):
         result = action(context, {'q': 'foobar'})
         assert 0 == len(result)
 
+    def test_user_autocomplete_ranking(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        core_factories.User(name='maria-santos', fullname='Maria Santos')
+        core_factories.User(name='ana-maria', fullname='Ana Maria')
+        core_factories.User(name='mario', fullname='Mario Rossi')
+
+        action = toolkit.get_action('user_autocomplete')
+        context = {'user': sysadmin['name']}
+
+        # prefix matches come first
+        result = action(context, {'q': 'Maria'})
+        assert [r['name'] for r in result] == ['maria-santos', 'ana-maria']
+
+        # short queries only match prefixes
+        result = action(context, {'q': 'ma'})
+        assert [r['name'] for r in result] == ['maria-santos', 'mario']
+
+    def test_user_autocomplete_wildcards(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        core_factories.User(fullname='Bob Internal')
+
+        action = toolkit.get_action('user_autocomplete')
+        context = {'user': sysadmin['name']}
+
+        assert 0 == len(action(context, {'q': '%%%'}))
+        assert 0 == len(action(context, {'q': '___'}))
+
+
+    def test_user_autocomplete_new_user(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        action = toolkit.get_action('user_autocomplete')
+        context = {'user': sysadmin['name']}
+
+        assert 0 == len(action(context, {'q': 'bob'}))
+        core_factories.User(name='bob', fullname='Bob Internal')
+        assert ['bob'] == [r['name'] for r in action(context, {'q': 'bob'})]
+
+    def test_user_autocomplete_cache_expires(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        action = toolkit.get_action('user_autocomplete')
+        context = {'user': sysadmin['name']}
+        user = core_factories.User(name='bob', fullname='Bob Internal')
+        assert 1 == len(action(context, {'q': 'bob'}))
+
+        # Users changed by core actions are seen once the query expires,
+        # even if other queries keep being cached
+        user_obj = model.User.get(user['id'])
+        user_obj.name = 'robert'
+        user_obj.fullname = 'Robert Internal'
+        model.Session.commit()
+        now = time.time()
+        with mock.patch('ckanext.unhcr.cache.time.time', return_value=now + 20):
+            action(context, {'q': 'rob'})
+        with mock.patch('ckanext.unhcr.cache.time.time',
+                return_value=now + actions.USER_AUTOCOMPLETE_CACHE_TTL + 1):
+            assert 0 == len(action(context, {'q': 'bob'}))
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestMembershipUserList(object):
+
+    def setup(self):
+        self.sysadmin = core_factories.Sysadmin(name='sysadmin', fullname='Zoe Sysadmin')
+        core_factories.User(name='bob', fullname='Bob Internal')
+        core_factories.User(name='carla', fullname='')
+        factories.ExternalUser(name='alice', fullname='Alice External')
+
+    def test_membership_user_list(self):
+        result = call_action('membership_user_list', {'user': 'sysadmin'})
+        assert result['count'] == 3
+        assert [u['name'] for u in result['users']] == ['bob', 'carla', 'sysadmin']
+        assert result['users'][1]['display_name'] == 'carla'
+        assert set(result['users'][0].keys()) == set(['id', 'name', 'display_name', 'external'])
+        assert not any(u['external'] for u in result['users'])
+
+    def test_membership_user_list_include_external(self):
+        result = call_action(
+            'membership_user_list', {'user': 'sysadmin'}, include_external=True)
+        assert result['count'] == 4
+        assert result['users'][0]['name'] == 'alice'
+        assert result['users'][0]['external'] is True
+
+    def test_membership_user_list_search_and_pages(self):
+        result = call_action('membership_user_list', {'user': 'sysadmin'}, q='internal')
+        assert [u['name'] for u in result['users']] == ['bob']
+
+        result = call_action(
+            'membership_user_list', {'user': 'sysadmin'}, limit=1, offset=1)
+        assert result['count'] == 3
+        assert [u['name'] for u in result['users']] == ['carla']
+
+    def test_membership_user_list_not_authorized(self):
+        user = core_factories.User()
+        with pytest.raises(toolkit.NotAuthorized):
+            call_action('membership_user_list', {'user': user['name'], 'ignore_auth': False})
+
 
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestUpdateSysadmin(object):
@@ -311,3 +411,25 @@ class TestExternalUserUpdateState(object):
             {"ignore_auth": True}, {"id": target_user['id']}
         )
         assert model.State.ACTIVE == user['state']
+
+    def test_reactivate_expired_user(self):
+        sysadmin = core_factories.Sysadmin()
+        target_user = factories.ExternalUser()
+        user_obj = model.User.get(target_user['id'])
+        user_obj.state = model.State.DELETED
+        user_obj.plugin_extras = {
+            'unhcr': {'expiry_date': '2020-05-31', 'expired': '2020-06-01'}}
+        model.Session.commit()
+
+        action = toolkit.get_action("external_user_update_state")
+        action(
+            {"user": sysadmin["name"]},
+            {'id': target_user['id'], 'state': model.State.ACTIVE}
+        )
+
+        user = toolkit.get_action("user_show")(
+            {"ignore_auth": True}, {"id": target_user['id']}
+        )
+        assert model.State.ACTIVE == user['state']
+        assert None is user['expired']
+        assert user['expiry_date'] > datetime.date.today().isoformat()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+from ckantoolkit.tests import factories as core_factories
+from ckanext.unhcr.tests import factories
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get('UNHCR_BENCHMARKS'),
+    reason='Set UNHCR_BENCHMARKS=1 to run the benchmarks',
+)
+
+CHECKS = 1000
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestBenchmarkAuth(object):
+
+    def test_check_access(self):
+        user = core_factories.User()
+        container = factories.DataContainer(
+            users=[{'name': user['name'], 'capacity': 'editor'}])
+        dataset = factories.Dataset(owner_org=container['id'])
+        user_obj = model.User.get(user['id'])
+
+        for action in ['package_show', 'package_update']:
+            timings = []
+            for auth_user_obj in [None, user_obj]:
+                start = time.time()
+                for check in range(CHECKS):
+                    context = {'user': user['name'], 'auth_user_obj': auth_user_obj}
+                    toolkit.check_access(action, context, {'id': dataset['id']})
+                timings.append(time.time() - start)
+
+            print('\n{} x {}: {:.3f}s, with auth_user_obj: {:.3f}s'.format(
+                action, CHECKS, timings[0], timings[1]))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import uuid
+import pytest
+from ckan import model
+from ckan.tests.helpers import call_action
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get('UNHCR_BENCHMARKS'),
+    reason='Set UNHCR_BENCHMARKS=1 to run the benchmarks',
+)
+
+CONTAINERS = 1000
+EXTRAS = 30
+
+
+def _create_containers(containers, extras):
+    group_table = model.meta.metadata.tables['group']
+    group_extra_table = model.meta.metadata.tables['group_extra']
+    groups = []
+    group_extras = []
+    for index in range(containers):
+        group_id = str(uuid.uuid4())
+        groups.append({
+            'id': group_id,
+            'name': 'container-{}'.format(index),
+            'title': 'Container {}'.format(index),
+            'type': 'data-container',
+            'is_organization': True,
+            'approval_status': 'approved',
+            'state': 'active',
+        })
+        values = {
+            'country': json.dumps(['SVN']),
+            'geographic_area': 'southern_africa',
+            'visible_external': 'True',
+        }
+        for extra in range(EXTRAS - len(values)):
+            values['extra_{}'.format(extra)] = 'value {}'.format(extra)
+        for key, value in values.items():
+            group_extras.append({
+                'id': str(uuid.uuid4()),
+                'group_id': group_id,
+                'key': key,
+                'value': value,
+                'state': 'active',
+            })
+    model.Session.execute(group_table.insert(), groups)
+    model.Session.execute(group_extra_table.insert(), group_extras)
+    model.Session.commit()
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestBenchmarkOrganizationList(object):
+
+    def test_organization_list_all_fields(self):
+        _create_containers(CONTAINERS, EXTRAS)
+
+        timings = []
+        for run in range(3):
+            start = time.time()
+            orgs = call_action('organization_list_all_fields', {'ignore_auth': True})
+            timings.append(time.time() - start)
+            assert len(orgs) == CONTAINERS
+
+        print('\norganization_list_all_fields ({} containers x {} extras): {}'.format(
+            CONTAINERS, EXTRAS, ', '.join('{:.3f}s'.format(t) for t in timings)))
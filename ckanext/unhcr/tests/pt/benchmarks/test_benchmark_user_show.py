@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import pytest
+from ckan.tests.helpers import call_action
+from ckanext.unhcr.tests import factories
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get('UNHCR_BENCHMARKS'),
+    reason='Set UNHCR_BENCHMARKS=1 to run the benchmarks',
+)
+
+CALLS = 500
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestBenchmarkUserShow(object):
+
+    def test_user_show(self):
+        container = factories.DataContainer()
+        user = factories.ExternalUser(default_containers=[container['id']])
+
+        start = time.time()
+        for call in range(CALLS):
+            user_dict = call_action('user_show', {'ignore_auth': True}, id=user['id'])
+            assert user_dict['default_containers'] == [container['id']]
+        elapsed = time.time() - start
+
+        print('\nuser_show x {}: {:.3f}s ({:.0f} calls/s)'.format(
+            CALLS, elapsed, CALLS / elapsed))
@@ -176,6 +176,47 @@ class TestAccessRequests(object):
         assert 'rejected' == self.container1_request.status
         assert 'Access Request Rejected' in resp2.body
 
+    def test_access_requests_bulk_approve_container_admin(self, app):
+        env = {'REMOTE_USER': self.container1_admin["name"].encode('ascii')}
+        with mock.patch('ckan.plugins.toolkit.enqueue_job') as mock_enqueue_job:
+            resp = app.post(
+                '/access-requests/bulk',
+                {
+                    'request_ids': [self.container1_request.id, self.dataset_request.id],
+                    'status': 'approved',
+                },
+                extra_environ=env,
+                status=302,
+            )
+            assert 2 == mock_enqueue_job.call_count
+
+        resp2 = resp.follow(extra_environ=env, status=200)
+        assert '2 Access Requests Approved' in resp2.body
+        assert 'approved' == self.container1_request.status
+        assert 'approved' == self.dataset_request.status
+
+    def test_access_requests_bulk_not_authorized(self, app):
+        env = {'REMOTE_USER': self.container1_admin["name"].encode('ascii')}
+        app.post(
+            '/access-requests/bulk',
+            {
+                'request_ids': [self.container1_request.id, self.container2_request.id],
+                'status': 'approved',
+            },
+            extra_environ=env,
+            status=403,
+        )
+        assert 'requested' == self.container1_request.status
+
+    def test_access_requests_bulk_reject_missing_message(self, app):
+        env = {'REMOTE_USER': self.container1_admin["name"].encode('ascii')}
+        app.post(
+            '/access-requests/bulk',
+            {'request_ids': [self.container1_request.id], 'status': 'rejected'},
+            extra_environ=env,
+            status=400,
+        )
+
     def test_access_requests_list_invalid_user(self, app):
         for user in [None, self.standard_user["name"]]:
             self.make_list_request(app, user=user, status=403)
@@ -204,6 +245,30 @@ class TestAccessRequests(object):
             in resp.body
         )
 
+    @mock.patch('ckanext.unhcr.controllers.extended_user.ACCESS_REQUESTS_PER_PAGE', 2)
+    def test_access_requests_list_pagination(self, app):
+        requests = [
+            self.container1_request,
+            self.container2_request,
+            self.dataset_request,
+            self.user_request_container1,
+            self.user_request_container2,
+        ]
+        shown = []
+        for page in [1, 2, 3]:
+            resp = self.make_list_request(
+                app, user=self.sysadmin['name'], status=200,
+                params={'requests_page': page})
+            page_requests = [
+                req.id for req in requests
+                if '/access-requests/approve/{}'.format(req.id) in resp.body
+            ]
+            assert len(page_requests) == (2 if page < 3 else 1)
+            assert ('requests_page={}'.format(page + 1) in resp.body) == (page < 3)
+            shown.extend(page_requests)
+
+        assert sorted(shown) == sorted(req.id for req in requests)
+
     def test_access_requests_list_container_admin(self, app):
         resp = self.make_list_request(app, user=self.container1_admin['name'], status=200)
         assert (
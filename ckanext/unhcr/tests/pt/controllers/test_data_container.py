@@ -250,6 +250,19 @@ class TestDataContainerController(object):
         }
         resp = self.post_request(app, '/data-container/membership_add', data, user='user3', status=403)
 
+    def test_membership_add_invalid_role(self, app):
+        data = {
+            'username': 'user1',
+            'contnames': 'container1',
+            'role': 'invalid-role',
+        }
+        resp = self.post_request(app, '/data-container/membership_add', data, user='sysadmin')
+        resp = resp.follow(extra_environ={'REMOTE_USER': 'sysadmin'})
+        assert 'NOT added' in resp.body
+        assert 'invalid-role' in resp.body
+        assert 'does not exist' in resp.body
+        assert len(self.container1['users']) == 1
+
     # Remove Container
 
     def test_membership_remove(self, app):
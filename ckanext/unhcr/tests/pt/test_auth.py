@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import mock
 import pytest
 import ckan.plugins as plugins
+from ckan import model
 from ckan.plugins import toolkit
 from ckan.tests import helpers
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr import auth
 from ckanext.unhcr.helpers import convert_deposited_dataset_to_regular_dataset
-from ckanext.unhcr.plugin import ALLOWED_ACTIONS
+from ckanext.unhcr.plugin import ALLOWED_ACTIONS, restrict_external
 from ckanext.unhcr.tests import factories
 from ckanext.unhcr.utils import get_module_functions
 
@@ -373,6 +375,17 @@ class TestAuthUnit(object):
         for action in actions:
             assert True == toolkit.check_access(action, context)
 
+    def test_restrict_external_uses_auth_user_obj(self):
+        external_user = factories.ExternalUser()
+        user_obj = model.User.get(external_user['id'])
+        auth_function = restrict_external(lambda action, context, data_dict: {'success': True})
+        context = {'user': external_user['name'], 'auth_user_obj': user_obj}
+
+        with mock.patch('ckanext.unhcr.plugin.User.by_name') as by_name:
+            assert auth_function('package_show', context)['success'] is True
+            assert auth_function('package_list', context)['success'] is False
+            assert by_name.call_count == 0
+
     def test_organization_show(self):
         external_user = factories.ExternalUser()
         internal_user = core_factories.User()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import time
+import mock
+from ckan.lib.redis import connect_to_redis
+from ckanext.unhcr import cache
+
+
+class TestCache(object):
+
+    def test_put_get(self):
+        cache.put('test', 'field', {'a': 1})
+        assert cache.get('test', 'field') == {'a': 1}
+        assert cache.get('test', 'other') is None
+
+    def test_invalidate(self):
+        cache.put('test', 'field', 1)
+        cache.invalidate('test')
+        assert cache.get('test', 'field') is None
+
+    def test_values_expire_on_their_own(self):
+        now = time.time()
+        with mock.patch('ckanext.unhcr.cache.time.time', return_value=now):
+            cache.put('test', 'old', 1, ttl=60)
+        with mock.patch('ckanext.unhcr.cache.time.time', return_value=now + 50):
+            cache.put('test', 'new', 2, ttl=60)
+        with mock.patch('ckanext.unhcr.cache.time.time', return_value=now + 70):
+            assert cache.get('test', 'old') is None
+            assert cache.get('test', 'new') == 2
+
+    def test_hash_ttl_not_extended(self):
+        cache.put('test', 'first', 1, ttl=60)
+        key = cache._get_key('test')
+        connect_to_redis().expire(key, 10)
+        cache.put('test', 'second', 2, ttl=60)
+        # Later writes don't push back the expiry of the hash
+        assert connect_to_redis().ttl(key) <= 10
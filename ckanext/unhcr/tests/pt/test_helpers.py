@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import os
+import mock
 import pytest
 from ckan import model
 from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.models import AccessRequest
 from ckanext.unhcr.tests import factories
-from ckanext.unhcr import helpers
+from ckanext.unhcr import helpers, utils
 
 
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
@@ -339,6 +340,41 @@ class TestPendingRequests(object):
         count = helpers.get_pending_requests_total(context=context)
         assert count == 0
 
+    def test_get_pending_requests_total_cached(self):
+        sysadmin = core_factories.Sysadmin(name='sysadmin', id='sysadmin')
+        requesting_user = core_factories.User()
+        container1 = factories.DataContainer()
+        container2 = factories.DataContainer()
+        context = {'model': model, 'user': 'sysadmin'}
+        assert helpers.get_pending_requests_total(context=context) == 0
+
+        # Not invalidated: the cached total is returned
+        model.Session.add(
+            AccessRequest(
+                user_id=requesting_user["id"],
+                object_id=container1["id"],
+                object_type="organization",
+                message="",
+                role="member",
+            )
+        )
+        model.Session.commit()
+        with mock.patch('ckan.plugins.toolkit.get_action') as mock_get_action:
+            assert helpers.get_pending_requests_total(context=context) == 0
+            mock_get_action.assert_not_called()
+
+        # Invalidated by access_request_create
+        toolkit.get_action('access_request_create')(
+            {'model': model, 'user': requesting_user['name']},
+            {
+                'object_id': container2['id'],
+                'object_type': 'organization',
+                'message': 'message',
+                'role': 'member',
+            }
+        )
+        assert helpers.get_pending_requests_total(context=context) == 2
+
 
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestDataDeposit(object):
@@ -353,6 +389,128 @@ class TestDataDeposit(object):
         assert result == {'id': 'data-deposit', 'name': 'data-deposit'}
 
 
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestRenderTree(object):
+
+    def setup(self):
+        factories.DataContainer(id='data-deposit', name='data-deposit')
+        factories.DataContainer(name='africa', title='Africa')
+        factories.DataContainer(
+            name='burundi', title='Burundi & Co', groups=[{'name': 'africa'}])
+
+    def test_render_tree(self):
+        html = helpers.render_tree()
+        assert html == (
+            '<ul class="hierarchy-tree-top">'
+            '<li id="node_africa"><a href="/data-container/africa">Africa</a>'
+            '<ul class="hierarchy-tree">'
+            '<li id="node_burundi"><a href="/data-container/burundi">Burundi &amp; Co</a></li>'
+            '</ul></li></ul>'
+        )
+
+    def test_render_tree_updated(self):
+        assert 'Africa' in helpers.render_tree()
+
+        toolkit.get_action('organization_patch')(
+            {'ignore_auth': True}, {'id': 'africa', 'title': 'Afrique'})
+
+        html = helpers.render_tree()
+        assert 'Afrique' in html
+        assert 'Africa' not in html
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestCanDownload(object):
+
+    def setup(self):
+        self.member = core_factories.User()
+        self.other_user = core_factories.User()
+        container = factories.DataContainer(
+            users=[{'name': self.member['name'], 'capacity': 'member'}])
+        self.dataset = factories.Dataset(
+            owner_org=container['id'],
+            visibility='restricted',
+        )
+        for i in range(2):
+            factories.Resource(package_id=self.dataset['id'], url_type='upload')
+        self.dataset = toolkit.get_action('package_show')(
+            {'ignore_auth': True}, {'id': self.dataset['id']})
+
+    def test_can_download(self, app):
+        with app.flask_app.test_request_context():
+            toolkit.c.user = self.member['name']
+            assert helpers.can_download(self.dataset)
+            toolkit.c.user = self.other_user['name']
+            assert not helpers.can_download(self.dataset)
+
+    def test_can_download_memoized(self, app):
+        with app.flask_app.test_request_context():
+            toolkit.c.user = self.member['name']
+            with mock.patch('ckan.plugins.toolkit.check_access') as check_access:
+                for i in range(5):
+                    helpers.can_download(self.dataset)
+                assert check_access.call_count == 1
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestCheckAccessMany(object):
+
+    def setup(self):
+        self.editor = core_factories.User()
+        container = factories.DataContainer(
+            users=[{'name': self.editor['name'], 'capacity': 'editor'}])
+        self.dataset = factories.Dataset(owner_org=container['id'])
+
+    def test_check_access_many(self, app):
+        with app.flask_app.test_request_context():
+            toolkit.c.user = self.editor['name']
+            toolkit.c.userobj = model.User.get(self.editor['id'])
+            permissions = helpers.check_access_many({
+                'edit': ('package_update', {'id': self.dataset['id']}),
+                'admin': 'sysadmin',
+            })
+        assert permissions == {'edit': True, 'admin': False}
+
+    def test_check_access_many_memoized(self, app):
+        with app.flask_app.test_request_context():
+            toolkit.c.user = self.editor['name']
+            toolkit.c.userobj = model.User.get(self.editor['id'])
+            with mock.patch('ckan.plugins.toolkit.check_access') as check_access:
+                for i in range(3):
+                    permissions = helpers.check_access_many([
+                        ('package_update', {'id': self.dataset['id']}),
+                        'sysadmin',
+                    ])
+                assert check_access.call_count == 2
+
+    def test_check_access_many_same_action(self, app):
+        other_dataset = factories.Dataset()
+        with app.flask_app.test_request_context():
+            toolkit.c.user = self.editor['name']
+            toolkit.c.userobj = model.User.get(self.editor['id'])
+            permissions = helpers.check_access_many([
+                ('package_update', {'id': self.dataset['id']}),
+                ('package_update', {'id': other_dataset['id']}),
+            ])
+        # a list of checks gets the results in the same order
+        assert permissions == [True, False]
+
+    def test_check_access_many_shares_permission_checks(self, app):
+        with app.flask_app.test_request_context():
+            toolkit.c.user = self.editor['name']
+            toolkit.c.userobj = model.User.get(self.editor['id'])
+            with mock.patch('ckan.authz._has_user_permission_for_groups',
+                    return_value=True) as has_permission:
+                helpers.check_access_many([
+                    ('package_update', {'id': self.dataset['id']}),
+                    ('package_activity_list', {
+                        'id': self.dataset['id'], 'get_internal_activities': True}),
+                ])
+            # package_activity_list checks package_update again
+            assert has_permission.call_count == 1
+            assert utils.get_shared_permission_checks() is None
+
+
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
 class TestDatasetValidationErrorOrNone(object):
 
@@ -821,6 +979,22 @@ class TestDepositedDatasetHelpers(object):
             assert 'review' == status['state']
             assert 'user' == status['role']
 
+    def test_get_deposited_dataset_user_curation_status_memoized(self, app):
+        with app.flask_app.test_request_context():
+            with mock.patch(
+                    'ckanext.unhcr.helpers.get_deposited_dataset_user_curation_role',
+                    return_value='depositor') as get_role:
+                for i in range(3):
+                    helpers.get_deposited_dataset_user_curation_status(
+                        self.draft_dataset, self.depositor['id'])
+                assert get_role.call_count == 1
+
+                # a change to the dataset is a new status
+                dataset = dict(self.draft_dataset, metadata_modified='2030-01-01T00:00:00')
+                helpers.get_deposited_dataset_user_curation_status(
+                    dataset, self.depositor['id'])
+                assert get_role.call_count == 2
+
     def test_get_data_curation_users_no_container_admin(self):
         curators = helpers.get_data_curation_users({})
         curator_names = [
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from ckan.tests.helpers import call_action
+from ckanext.unhcr.tests import factories
+from ckanext.unhcr import hierarchy
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestHierarchy(object):
+
+    def setup(self):
+        self.africa = factories.DataContainer(name='africa', title='Africa')
+        self.central_africa = factories.DataContainer(
+            name='central-africa',
+            title='Central Africa',
+            groups=[{'name': 'africa'}],
+        )
+        self.burundi = factories.DataContainer(
+            name='burundi',
+            title='Burundi',
+            groups=[{'name': 'central-africa'}],
+        )
+        self.angola = factories.DataContainer(
+            name='angola',
+            title='Angola',
+            groups=[{'name': 'africa'}],
+        )
+        self.europe = factories.DataContainer(name='europe', title='Europe')
+
+    def test_get_tree(self):
+        tree = hierarchy.get_tree()
+
+        assert [node['name'] for node in tree] == ['africa', 'europe']
+        assert [node['name'] for node in tree[0]['children']] == ['angola', 'central-africa']
+        assert [node['name'] for node in tree[0]['children'][1]['children']] == ['burundi']
+        assert tree[1]['children'] == []
+        assert tree[0]['highlighted'] is False
+
+    def test_get_root(self):
+        assert hierarchy.get_root(self.burundi['id'])['name'] == 'africa'
+        assert hierarchy.get_root('central-africa')['name'] == 'africa'
+        assert hierarchy.get_root('africa')['name'] == 'africa'
+        assert hierarchy.get_root('europe')['name'] == 'europe'
+        assert hierarchy.get_root('not-a-container') is None
+
+    def test_get_ancestors(self):
+        ancestors = hierarchy.get_ancestors('burundi')
+        assert [node['name'] for node in ancestors] == ['central-africa', 'africa']
+        assert hierarchy.get_ancestors('africa') == []
+
+    def test_get_descendants(self):
+        descendants = hierarchy.get_descendants(self.africa['id'])
+        assert [node['name'] for node in descendants] == ['angola', 'central-africa', 'burundi']
+        assert hierarchy.get_descendants('europe') == []
+
+    def test_invalidated_on_update(self):
+        assert hierarchy.get_descendants('europe') == []
+
+        call_action('organization_patch', id='angola', groups=[{'name': 'europe'}])
+
+        assert [node['name'] for node in hierarchy.get_descendants('europe')] == ['angola']
+        assert hierarchy.get_root('angola')['name'] == 'europe'
+
+    def test_invalidated_on_delete(self):
+        assert hierarchy.get_root('burundi') is not None
+
+        call_action('organization_delete', id='burundi')
+
+        assert hierarchy.get_root('burundi') is None
+        assert [node['name'] for node in hierarchy.get_descendants('central-africa')] == []
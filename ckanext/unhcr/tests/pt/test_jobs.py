@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import pytest
-from ckanext.unhcr.jobs import _modify_package
+from ckan import model
+from ckantoolkit.tests import factories as core_factories
+from ckanext.collaborators.model import DatasetMember
+from ckanext.unhcr.jobs import _modify_package, expire_external_users
+from ckanext.unhcr.models import MailOutbox
+from ckanext.unhcr.tests import factories
 
 
 @pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
@@ -152,3 +158,59 @@ class TestJobs(object):
         })
         assert package['identifiability'] is None
         assert package['visibility'] == 'public'
+
+    # expire_external_users
+
+    def _set_expiry_date(self, user_id, expiry_date):
+        user = model.User.get(user_id)
+        plugin_extras = dict(user.plugin_extras or {})
+        plugin_extras['unhcr'] = dict(
+            plugin_extras.get('unhcr', {}), expiry_date=expiry_date)
+        user.plugin_extras = plugin_extras
+        model.Session.commit()
+
+    def test_expire_external_users(self):
+        today = datetime.date(2020, 6, 1)
+        expired = factories.ExternalUser()
+        not_expired = factories.ExternalUser()
+        internal = core_factories.User()
+        self._set_expiry_date(expired['id'], '2020-05-31')
+        self._set_expiry_date(not_expired['id'], '2020-06-01')
+        self._set_expiry_date(internal['id'], '2020-05-31')
+
+        assert expire_external_users(today=today) == 1
+
+        model.Session.expire_all()
+        assert model.User.get(expired['id']).state == 'deleted'
+        assert model.User.get(expired['id']).plugin_extras['unhcr']['expired'] == '2020-06-01'
+        assert model.User.get(not_expired['id']).plugin_extras['unhcr'].get('expired') is None
+        assert model.User.get(not_expired['id']).state == 'active'
+        assert model.User.get(internal['id']).state == 'active'
+        message = model.Session.query(MailOutbox).one()
+        assert message.recipient_email == expired['email']
+        assert 'expired' in message.subject
+
+        # Already deactivated users are left alone
+        assert expire_external_users(today=today) == 0
+
+    def test_expire_external_users_memberships(self):
+        today = datetime.date(2020, 6, 1)
+        expired = factories.ExternalUser()
+        container = factories.DataContainer(
+            users=[{'name': expired['name'], 'capacity': 'member'}])
+        dataset = factories.Dataset(owner_org=container['id'])
+        model.Session.add(DatasetMember(
+            dataset_id=dataset['id'], user_id=expired['id'], capacity='member'))
+        model.Session.commit()
+        self._set_expiry_date(expired['id'], '2020-05-31')
+
+        assert expire_external_users(today=today) == 1
+
+        assert 0 == (model.Session.query(model.Member)
+            .filter(model.Member.table_name == 'user')
+            .filter(model.Member.table_id == expired['id'])
+            .filter(model.Member.state == 'active')
+            .count())
+        assert 0 == (model.Session.query(DatasetMember)
+            .filter(DatasetMember.user_id == expired['id'])
+            .count())
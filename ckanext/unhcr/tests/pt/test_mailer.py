@@ -1,3 +1,4 @@
+import mock
 import pytest
 from datetime import datetime, timedelta
 import ckan.model as model
@@ -7,6 +8,7 @@ from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.tests import factories
 from ckanext.unhcr import mailer
+from ckanext.unhcr.models import MailOutbox
 
 
 @pytest.mark.usefixtures('clean_db', 'clean_index', 'unhcr_migrate')
@@ -196,6 +198,36 @@ class TestSummaryMailer(object):
             not in regularised_body
         )
 
+    @pytest.mark.ckan_config('ckanext.unhcr.summary_email_processes', '1')
+    def test_emails_share_searches(self):
+        user = core_factories.User(name='user1')
+        public_org = factories.DataContainer(
+            name='public-org', users=[{'name': 'user1', 'capacity': 'member'}])
+        private_org = factories.DataContainer(name='private-org')
+        factories.Dataset(name='visible-dataset', owner_org=public_org['id'], private=True)
+        factories.Dataset(name='hidden-dataset', owner_org=private_org['id'], private=True)
+
+        data = mailer.get_summary_email_data()
+        emails = mailer.compose_summary_emails([self.sysadmin, user], data)
+
+        assert 2 == emails[0]['total_events']
+        assert 1 == emails[1]['total_events']
+        assert 'visible-dataset' in emails[1]['body']
+        assert 'hidden-dataset' not in emails[1]['body']
+
+    @mock.patch('ckanext.unhcr.mailer.SUMMARY_SEARCH_ROWS', 2)
+    def test_email_data_pages_through_searches(self):
+        org = factories.DataContainer(name='test-org')
+        for i in range(5):
+            factories.Dataset(name='dataset-{}'.format(i), owner_org=org['id'])
+
+        data = mailer.get_summary_email_data()
+
+        assert (
+            sorted(['dataset-{}'.format(i) for i in range(5)]) ==
+            sorted([package['name'] for package in data['new_datasets']])
+        )
+
     def test_email_recipients(self):
         user1 = core_factories.User(name='user1', id='user1')
         curator = core_factories.User(name='curator', id='curator')
@@ -451,3 +483,104 @@ class TestInfectedFileMailer(object):
         assert '<a href="{}">infected resource</a>'.format(resource_link) in regularised_body
         assert 'scanned and found to be infected.' in regularised_body
         assert 'Win.Test.EICAR_HDB-1 FOUND' in regularised_body
+
+
+@pytest.mark.usefixtures('clean_db', 'unhcr_migrate')
+class TestMailQueue(object):
+
+    def setup(self):
+        self.user1 = core_factories.User(name='user1', email='user1@example.com')
+        self.user2 = core_factories.User(name='user2', email='user2@example.com')
+
+    def test_mail_user_queues_email(self):
+        mailer.mail_user_by_id(self.user1['id'], 'Subject', '<p>Body</p>')
+
+        status = mailer.get_mail_queue_status()
+        assert status['pending'] == 1
+        assert status['oldest_pending'] is not None
+        message = model.Session.query(MailOutbox).one()
+        assert message.recipient_email == 'user1@example.com'
+        assert message.headers['Content-Type'] == 'text/html; charset=UTF-8'
+
+    def test_send_queued_mail(self, smtp_server):
+        mailer.mail_user_by_id(self.user1['id'], 'Subject 1', '<p>Body 1</p>')
+        mailer.mail_user_by_id(self.user2['id'], 'Subject 2', '<p>Body 2</p>')
+        mailer.mail_user_by_id(self.user1['id'], 'Subject 3', '<p>Body 3</p>')
+
+        counts = mailer.send_queued_mail()
+
+        assert counts == {'sent': 3, 'retried': 0, 'failed': 0}
+        assert smtp_server.connections == 1
+        assert [m['to'] for m in smtp_server.messages] == [
+            ['user1@example.com'], ['user2@example.com'], ['user1@example.com']]
+        assert 'Content-Type: text/html; charset=UTF-8' in smtp_server.messages[0]['data']
+        status = mailer.get_mail_queue_status()
+        assert status['pending'] == 0
+        assert status['sent'] == 3
+
+    @pytest.mark.ckan_config('smtp.test_server', '127.0.0.1:1')
+    def test_send_queued_mail_retry(self):
+        mailer.mail_user_by_id(self.user1['id'], 'Subject', '<p>Body</p>')
+
+        counts = mailer.send_queued_mail()
+
+        assert counts == {'sent': 0, 'retried': 1, 'failed': 0}
+        message = model.Session.query(MailOutbox).one()
+        assert message.status == 'pending'
+        assert message.attempts == 1
+        assert message.last_error
+        assert message.next_attempt > datetime.utcnow()
+
+        # not due yet
+        assert mailer.send_queued_mail() == {'sent': 0, 'retried': 0, 'failed': 0}
+
+    @pytest.mark.ckan_config('smtp.test_server', '127.0.0.1:1')
+    def test_send_queued_mail_max_attempts(self):
+        mailer.mail_user_by_id(self.user1['id'], 'Subject', '<p>Body</p>')
+        message = model.Session.query(MailOutbox).one()
+        message.attempts = mailer.MAIL_MAX_ATTEMPTS - 1
+        model.Session.commit()
+
+        counts = mailer.send_queued_mail()
+
+        assert counts == {'sent': 0, 'retried': 0, 'failed': 1}
+        assert mailer.get_mail_queue_status()['failed'] == 1
+
+    def test_send_queued_mail_unexpected_error(self, smtp_server):
+        mailer.mail_user_by_id(self.user1['id'], 'Subject 1', '<p>Body 1</p>')
+        mailer.mail_user_by_id(self.user2['id'], 'Subject 2', '<p>Body 2</p>')
+        broken = model.Session.query(MailOutbox).filter_by(subject='Subject 1').one()
+
+        compose = mailer._compose_mime_message
+        def compose_mime_message(message):
+            if message.id == broken.id:
+                raise UnicodeEncodeError('ascii', u'', 0, 1, 'broken')
+            return compose(message)
+
+        with mock.patch('ckanext.unhcr.mailer._compose_mime_message', compose_mime_message):
+            counts = mailer.send_queued_mail()
+
+        # The broken email is retried later and doesn't block the queue
+        assert counts == {'sent': 1, 'retried': 1, 'failed': 0}
+        model.Session.expire_all()
+        broken = model.Session.query(MailOutbox).filter_by(subject='Subject 1').one()
+        assert broken.status == 'pending'
+        assert broken.attempts == 1
+        assert broken.last_error
+
+    def test_purge_sent_mail(self, smtp_server):
+        mailer.mail_user_by_id(self.user1['id'], 'Subject', '<p>Body</p>')
+        mailer.send_queued_mail()
+
+        assert mailer.purge_sent_mail(timedelta(days=1)) == 0
+        assert mailer.purge_sent_mail(timedelta(days=-1)) == 1
+
+    def test_mail_queue_status_action(self):
+        sysadmin = core_factories.Sysadmin()
+        mailer.mail_user_by_id(self.user1['id'], 'Subject', '<p>Body</p>')
+
+        status = toolkit.get_action('mail_queue_status')({'user': sysadmin['name']}, {})
+        assert status['pending'] == 1
+
+        with pytest.raises(toolkit.NotAuthorized):
+            toolkit.get_action('mail_queue_status')({'user': self.user1['name']}, {})
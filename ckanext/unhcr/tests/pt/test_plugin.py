@@ -146,3 +146,40 @@ class TestHooks(object):
         action = toolkit.get_action("package_delete")
         action({'user': self.user['name'], 'job': True}, self.dataset)
         mock_hook.assert_not_called()
+
+
+@pytest.mark.usefixtures('clean_db', 'clean_index', 'unhcr_migrate')
+class TestContainerAncestry(object):
+
+    def setup(self):
+        self.africa = factories.DataContainer(name='africa')
+        self.europe = factories.DataContainer(name='europe')
+        self.burundi = factories.DataContainer(
+            name='burundi', groups=[{'name': 'africa'}])
+        self.dataset = factories.Dataset(owner_org=self.burundi['id'])
+
+    def test_ancestor_containers_indexed(self):
+        search = lambda container: toolkit.get_action('package_search')(
+            {'ignore_auth': True},
+            {'fq': 'vocab_ancestor_containers:"%s"' % container['id']},
+        )['results']
+
+        assert [d['id'] for d in search(self.africa)] == [self.dataset['id']]
+        assert [d['id'] for d in search(self.burundi)] == [self.dataset['id']]
+        assert search(self.europe) == []
+
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    def test_moved_container_reindexed(self, mock_enqueue_job):
+        toolkit.get_action('organization_patch')(
+            {'ignore_auth': True}, {'id': 'burundi', 'groups': [{'name': 'europe'}]})
+
+        mock_enqueue_job.assert_called_once()
+        assert 'reindex_datasets' == mock_enqueue_job.call_args[0][0].__name__
+        assert [self.dataset['id']] == mock_enqueue_job.call_args[0][1][0]
+
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    def test_renamed_container_not_reindexed(self, mock_enqueue_job):
+        toolkit.get_action('organization_patch')(
+            {'ignore_auth': True}, {'id': 'burundi', 'title': 'Burundi'})
+
+        mock_enqueue_job.assert_not_called()
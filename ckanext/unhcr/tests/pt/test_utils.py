@@ -2,6 +2,7 @@
 
 import datetime
 import pytest
+from ckan import model
 from ckan.plugins import toolkit
 from ckantoolkit.tests import factories as core_factories
 from ckanext.unhcr.tests import factories
@@ -17,6 +18,44 @@ class TestUtils(object):
         assert utils.normalize_list('{name1,name2}') == value
         assert utils.normalize_list('') == []
 
+    def test_get_email_domain(self):
+        assert utils.get_email_domain('alice@UNHCR.org') == 'unhcr.org'
+        assert utils.get_email_domain('alice') is None
+        assert utils.get_email_domain(None) is None
+
+    @pytest.mark.ckan_config('ckanext.unhcr.internal_domains', 'unhcr.org, Example.com')
+    def test_get_internal_domain_set(self):
+        assert utils.get_internal_domain_set() == frozenset(['unhcr.org', 'example.com'])
+
+    def test_internal_users_filter(self):
+        sysadmin = core_factories.Sysadmin(email='admin@example.com')
+        internal_user = core_factories.User(email='bob@UNHCR.org')
+        external_user = factories.ExternalUser(email='alice@example.com')
+        names = [
+            user.name for user in
+            model.Session.query(model.User).filter(utils.internal_users_filter())
+        ]
+        assert sysadmin['name'] in names
+        assert internal_user['name'] in names
+        assert external_user['name'] not in names
+        assert not utils.user_is_external(model.User.get(internal_user['id']))
+        assert utils.user_is_external(model.User.get(external_user['id']))
+
+    def test_get_user_extras(self):
+        internal_user = core_factories.User()
+        external_user = factories.ExternalUser(focal_point='Alice', default_containers=['c1'])
+
+        extras = utils.get_user_extras(model.User.get(internal_user['id']))
+        assert extras == {
+            'focal_point': '', 'expiry_date': None, 'expired': None, 'default_containers': []}
+
+        user_obj = model.User.get(external_user['id'])
+        extras = utils.get_user_extras(user_obj)
+        assert extras['focal_point'] == 'Alice'
+        assert extras['expiry_date'] is not None
+        extras['default_containers'].append('c2')
+        assert user_obj.plugin_extras['unhcr']['default_containers'] == ['c1']
+
     def test_resource_is_blocked_no_task_status(self):
         user = core_factories.User()
         dataset = factories.Dataset()
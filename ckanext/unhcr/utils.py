@@ -1,4 +1,9 @@
+import contextlib
+import datetime
 import json
+import time
+from sqlalchemy import and_, case, func, or_, select
+from ckan import model
 import ckan.plugins.toolkit as toolkit
 # TODO: move here helpers not used in templates?
 
@@ -12,6 +17,57 @@ def get_internal_domains():
     )
 
 
+_internal_domain_set = {'config': None, 'domains': frozenset()}
+def get_internal_domain_set():
+    '''
+    Returns the internal domains as a (lower case) frozenset,
+    only parsed again when the config changes
+    '''
+    value = toolkit.config.get('ckanext.unhcr.internal_domains', INTERNAL_DOMAINS)
+    if value != _internal_domain_set['config']:
+        _internal_domain_set.update({
+            'config': value,
+            'domains': frozenset(
+                domain.strip().lower() for domain in get_internal_domains()),
+        })
+    return _internal_domain_set['domains']
+
+
+def get_email_domain(email):
+    '''
+    Returns the lower case domain of an email address (or None),
+    the same value as the `user_email_domain` SQL expression for
+    users who are not sysadmins
+    '''
+    try:
+        return email.split('@')[1].lower() or None
+    except (AttributeError, IndexError):
+        return None
+
+
+# Sysadmins are always internal, they get a value no email domain can have
+SYSADMIN_DOMAIN = '@sysadmin'
+
+
+def user_email_domain():
+    # Matches the idx_user_internal_domain index (see models)
+    return case(
+        [(model.User.sysadmin == True, SYSADMIN_DOMAIN)],
+        else_=func.lower(func.split_part(model.User.email, '@', 2)),
+    )
+
+
+def internal_users_filter():
+    '''
+    Returns an SQL condition matching the internal users (see `user_is_external`)
+
+    Sysadmins and internal domains are matched by the same indexed
+    expression, so the condition can use its index.
+    '''
+    return user_email_domain().in_(
+        [SYSADMIN_DOMAIN] + sorted(get_internal_domain_set()))
+
+
 def normalize_list(value):
     if isinstance(value, list):
         return value
@@ -43,12 +99,118 @@ def user_is_external(user):
     if user.sysadmin:
         return False
 
+    return get_email_domain(user.email) not in get_internal_domain_set()
+
+
+def get_request_memo(name):
+    '''
+    Returns a dict living as long as the current web request,
+    or None when running outside of a request (jobs, commands)
+    '''
+    try:
+        memos = getattr(toolkit.c, '_unhcr_memos', None)
+        if memos is None:
+            memos = {}
+            toolkit.c._unhcr_memos = memos
+    except (TypeError, RuntimeError, AttributeError):
+        return None
+    return memos.setdefault(name, {})
+
+
+@contextlib.contextmanager
+def shared_permission_checks():
+    '''
+    Share the user permission checks on groups and organizations made
+    within the block, so a batch of auth checks looks up the memberships
+    of the user only once (see :py:func:`get_shared_permission_checks`)
+    '''
+    try:
+        toolkit.c._unhcr_permission_checks = {}
+    except (TypeError, RuntimeError, AttributeError):
+        yield
+        return
+    try:
+        yield
+    finally:
+        toolkit.c._unhcr_permission_checks = None
+
+
+def get_shared_permission_checks():
+    '''
+    Returns the dict of the permission checks shared by the current
+    :py:func:`shared_permission_checks` block, or None outside of one
+    '''
     try:
-        domain = user.email.split('@')[1]
-    except AttributeError:
-        return True
+        return getattr(toolkit.c, '_unhcr_permission_checks', None)
+    except (TypeError, RuntimeError, AttributeError):
+        return None
+
 
-    return domain not in get_internal_domains()
+def escape_like(value):
+    '''
+    Escapes the LIKE wildcards of a user provided string
+    '''
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_users(q, include_external=False, limit=20):
+    '''
+    Returns the not deleted users whose name or full name contain `q`
+
+    The users with a name or full name starting with `q` come first, then
+    the rest by similarity. Queries shorter than three characters only
+    look for prefixes (trigrams can't help with them).
+    '''
+    q = q.strip().lower()
+    pattern = escape_like(q)
+    name = func.lower(model.User.name)
+    fullname = func.lower(model.User.fullname)
+    is_prefix = or_(name.like(pattern + '%'), fullname.like(pattern + '%'))
+
+    query = model.Session.query(model.User)
+    query = query.filter(model.User.state != model.State.DELETED)
+    if len(q) < 3:
+        query = query.filter(is_prefix)
+    else:
+        query = query.filter(or_(
+            model.User.name.ilike('%' + pattern + '%'),
+            model.User.fullname.ilike('%' + pattern + '%'),
+        ))
+    if not include_external:
+        query = query.filter(internal_users_filter())
+
+    order_by = [case([(is_prefix, 0)], else_=1)]
+    if len(q) >= 3 and has_trigram_extension():
+        order_by.append(func.greatest(
+            func.similarity(model.User.name, q),
+            func.similarity(func.coalesce(model.User.fullname, ''), q),
+        ).desc())
+    order_by.append(model.User.name)
+
+    return query.order_by(*order_by).limit(limit).all()
+
+
+_trigram_extension = {}
+def has_trigram_extension():
+    # Checked once per process, see models.create_user_search_indexes
+    if 'installed' not in _trigram_extension:
+        _trigram_extension['installed'] = bool(model.Session.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar())
+    return _trigram_extension['installed']
+
+
+def get_user_extras(user):
+    '''
+    Returns the UNHCR fields kept in the plugin_extras of a user object
+    ("focal_point", "expiry_date", "expired" and "default_containers")
+    '''
+    extras = (user.plugin_extras or {}).get('unhcr') or {}
+    return {
+        'focal_point': extras.get('focal_point', ''),
+        'expiry_date': extras.get('expiry_date'),
+        'expired': extras.get('expired'),
+        'default_containers': list(extras.get('default_containers') or []),
+    }
 
 
 def resource_is_blocked(context, resource_id):
@@ -68,3 +230,255 @@ def resource_is_blocked(context, resource_id):
         pass
 
     return False
+
+
+# Data Containers
+
+GROUP_EXTRA_KEYS_TTL = 600  # seconds
+
+_group_extra_keys = {'keys': None, 'fetched': 0}
+def get_group_extra_keys(refresh=False):
+    '''
+    Return the distinct keys used in group extras
+
+    The list is cached for GROUP_EXTRA_KEYS_TTL seconds
+    (not cached when testing).
+    '''
+    now = time.time()
+    if (refresh or
+            toolkit.config.get('testing') or
+            _group_extra_keys['keys'] is None or
+            now - _group_extra_keys['fetched'] > GROUP_EXTRA_KEYS_TTL):
+        keys = [row[0] for row in model.Session.query(model.GroupExtra.key).distinct()]
+        _group_extra_keys.update({'keys': keys, 'fetched': now})
+    return _group_extra_keys['keys']
+
+
+def select_organizations_with_extras(group_type=None, order_by=None, state='active'):
+    '''
+    Return a select of the organizations of a given type (any type if
+    `group_type` is None) and state
+
+    All the active extras of every organization are pivoted into a single
+    "extras" JSON column with one aggregated join, so the query doesn't
+    grow with the number of extra keys. `order_by` can be either a group
+    column or an extra key.
+    '''
+    group_table = model.meta.metadata.tables['group']
+    group_extra_table = model.meta.metadata.tables['group_extra']
+
+    extras = func.json_object_agg(
+        group_extra_table.c.key, group_extra_table.c.value
+    ).filter(group_extra_table.c.key != None)
+    sql = select(
+        list(group_table.columns) + [extras.label('extras')]
+    ).select_from(
+        group_table.outerjoin(
+            group_extra_table,
+            and_(
+                group_table.c.id == group_extra_table.c.group_id,
+                group_extra_table.c.state == 'active',
+            )
+        )
+    ).where(
+        and_(
+            group_table.c.state == state,
+            group_table.c.is_organization == True,
+        )
+    ).group_by(
+        group_table.c.id
+    )
+
+    if group_type:
+        sql = sql.where(group_table.c.type == group_type)
+
+    if not order_by:
+        pass
+    elif order_by in group_table.c:
+        sql = sql.order_by(group_table.c[order_by])
+    else:
+        sql = sql.order_by(func.max(case(
+            [(group_extra_table.c.key == order_by, group_extra_table.c.value)])))
+
+    return sql
+
+
+def select_organizations_with_members(group_type=None, order_by=None, state='approval_needed'):
+    '''
+    Return :py:func:`select_organizations_with_extras` with two more
+    JSON columns: "users", the admins of every organization (its creator
+    for a pending request), and "groups", its parent organizations
+
+    Both are correlated subqueries so the page of organizations
+    is still fetched with a single query.
+    '''
+    group_table = model.meta.metadata.tables['group']
+    user_table = model.meta.metadata.tables['user']
+    member_table = model.meta.metadata.tables['member']
+    user_member = member_table.alias('user_member')
+    parent_member = member_table.alias('parent_member')
+    parent_group = group_table.alias('parent_group')
+
+    users = select([
+        func.json_agg(func.json_build_object(
+            'id', user_table.c.id,
+            'name', user_table.c.name,
+            'fullname', user_table.c.fullname,
+            'capacity', user_member.c.capacity,
+        ))
+    ]).select_from(
+        user_member.join(user_table, user_table.c.id == user_member.c.table_id)
+    ).where(
+        and_(
+            user_member.c.group_id == group_table.c.id,
+            user_member.c.table_name == 'user',
+            user_member.c.capacity == 'admin',
+            user_member.c.state == 'active',
+            user_table.c.state == 'active',
+        )
+    ).correlate(group_table).as_scalar()
+
+    groups = select([
+        func.json_agg(func.json_build_object(
+            'id', parent_group.c.id,
+            'name', parent_group.c.name,
+            'title', parent_group.c.title,
+        ))
+    ]).select_from(
+        parent_member.join(parent_group, parent_group.c.id == parent_member.c.group_id)
+    ).where(
+        and_(
+            parent_member.c.table_id == group_table.c.id,
+            parent_member.c.table_name == 'group',
+            parent_member.c.capacity == 'parent',
+            parent_member.c.state == 'active',
+        )
+    ).correlate(group_table).as_scalar()
+
+    sql = select_organizations_with_extras(group_type, order_by=order_by, state=state)
+    return sql.column(users.label('users')).column(groups.label('groups'))
+
+
+def organization_row_to_dict(row, extra_keys):
+    '''
+    Return a raw organization dict from a row of
+    :py:func:`select_organizations_with_extras`. Extras missing
+    for this organization are set to None.
+    '''
+    data = dict((key, None) for key in extra_keys)
+    data.update((key, value) for key, value in row.items() if key != 'extras')
+    extras = row['extras'] or {}
+    if not isinstance(extras, dict):
+        extras = json.loads(extras)
+    data.update(extras)
+    return data
+
+
+# Clam AV
+
+CLAMAV_TASK_STALE_AFTER = datetime.timedelta(seconds=3600)
+
+
+def get_resource_ids_to_scan(max_age, after=None, limit=None):
+    '''
+    Returns the ids of the uploaded resources that lack a Clam AV task
+    updated within ``max_age`` (a timedelta), ordered by id.
+
+    This is a single query joining ``resource`` to ``task_status`` so it
+    can be used to walk the whole store. Pass the last id of a previous
+    run as ``after`` to resume from there.
+    '''
+    query = _resources_to_scan_query(max_age, after).order_by(model.Resource.id)
+    if limit:
+        query = query.limit(limit)
+    return [row[0] for row in query]
+
+
+def count_resources_to_scan(max_age, after=None, limit=None):
+    '''
+    Returns the number of resources :py:func:`get_resource_ids_to_scan`
+    would return for the same arguments, with a single COUNT query
+    '''
+    count = _resources_to_scan_query(max_age, after).count()
+    return min(count, limit) if limit else count
+
+
+def _resources_to_scan_query(max_age, after=None):
+    cutoff = datetime.datetime.utcnow() - max_age
+    query = (model.Session
+        .query(model.Resource.id)
+        .join(model.Package, model.Package.id == model.Resource.package_id)
+        .outerjoin(
+            model.TaskStatus,
+            and_(
+                model.TaskStatus.entity_id == model.Resource.id,
+                model.TaskStatus.task_type == 'clamav',
+                model.TaskStatus.key == 'clamav',
+            )
+        )
+        .filter(model.Resource.state == 'active')
+        .filter(model.Resource.url_type == 'upload')
+        .filter(model.Package.state != 'deleted')
+        .filter(or_(
+            model.TaskStatus.id == None,
+            model.TaskStatus.last_updated < cutoff,
+        )))
+    if after:
+        query = query.filter(model.Resource.id > after)
+    return query
+
+
+def count_clamav_tasks_in_flight():
+    '''
+    Returns the number of Clam AV tasks which have been submitted
+    but have not received a callback yet (ignoring stale tasks)
+    '''
+    cutoff = datetime.datetime.utcnow() - CLAMAV_TASK_STALE_AFTER
+    return (model.Session
+        .query(model.TaskStatus.id)
+        .filter(model.TaskStatus.task_type == 'clamav')
+        .filter(model.TaskStatus.key == 'clamav')
+        .filter(model.TaskStatus.state.in_(['submitting', 'pending']))
+        .filter(model.TaskStatus.last_updated > cutoff)
+        .count())
+
+
+def get_stale_clamav_tasks():
+    '''
+    Returns the Clam AV tasks stuck in "submitting" or "pending" for longer
+    than ``CLAMAV_TASK_STALE_AFTER``, along with the state of their resource
+    (``None`` if the resource no longer exists)
+    '''
+    cutoff = datetime.datetime.utcnow() - CLAMAV_TASK_STALE_AFTER
+    return (model.Session
+        .query(
+            model.TaskStatus.id,
+            model.TaskStatus.entity_id,
+            model.TaskStatus.state,
+            model.Resource.state.label('resource_state'),
+        )
+        .outerjoin(model.Resource, model.Resource.id == model.TaskStatus.entity_id)
+        .filter(model.TaskStatus.task_type == 'clamav')
+        .filter(model.TaskStatus.key == 'clamav')
+        .filter(model.TaskStatus.state.in_(['submitting', 'pending']))
+        .filter(model.TaskStatus.last_updated < cutoff)
+        .order_by(model.TaskStatus.last_updated)
+        .all())
+
+
+def fail_clamav_tasks(task_ids, error):
+    '''
+    Marks all the given Clam AV tasks as failed with a single UPDATE
+    '''
+    if not task_ids:
+        return 0
+    count = (model.Session
+        .query(model.TaskStatus)
+        .filter(model.TaskStatus.id.in_(task_ids))
+        .update({
+            'state': 'error',
+            'error': json.dumps(error),
+            'last_updated': datetime.datetime.utcnow(),
+        }, synchronize_session=False))
+    model.Session.commit()
+    return count